@@ -5,151 +5,165 @@
 
 # Flask / Functionality Imports
 import sqlite3 # For database operations
-from flask import Flask, render_template, request, redirect, session, flash # Flask imports
+import json # For passing lists of names to SQLite
+import hashlib # For ETags
+import time # For ETags
+import gzip # For compressing deck API responses
+import os # For removing uploads that couldn't be queued
+from flask import Flask, Blueprint, Response, current_app, render_template, request, redirect, session, flash, jsonify, make_response, url_for, stream_with_context # Flask imports
 
 # Security Imports
-from werkzeug.security import generate_password_hash, check_password_hash # For hashing passwords
-from markupsafe import escape # For escaping user input
+import password_hashing # For hashing passwords, and verifying them off the request thread
+from markupsafe import escape, Markup # For escaping user input, and inserting cached table rows
 from flask_wtf import CSRFProtect # For CSRF protection
-from forms import LoginForm, RegisterForm, ListForm, UserEditForm, ListEditForm, AssignListForm, MFAVerificationForm, LogoutForm, DeleteItemForm # For input validation and CSRF protection
+from forms import LoginForm, RegisterForm, ListForm, UserEditForm, ListEditForm, AssignListForm, MFAVerificationForm, LogoutForm, DeleteItemForm, ImportListForm, BulkAssignForm, ShuffleForm # For input validation and CSRF protection
 from flask_limiter import Limiter # For rate limiting
 from flask_limiter.util import get_remote_address # For rate limiting
-from datetime import timedelta # For session timeout
+import rate_limit_storage # Registers the shared SQLite rate limit storage with flask-limiter
+from datetime import timedelta, datetime, timezone # For session timeout and Last-Modified headers
+from werkzeug.http import is_resource_modified # For conditional GETs
 import logging # For logging
+import logging_config # For the queued, rotating JSON log setup
+import metrics # For request and query instrumentation
 from error_handlers import register_error_handlers # For error handling
+import db # For database connection management
+import deck_import # For bulk deck imports
+import deck_export # For streaming deck exports
+import pagination # For paging the admin tables
+import search # For flashcard search
+import scheduler # For spaced repetition reviews
+import shuffle # For shuffle mode
+import study_events # For recording study events in the background
+import session_store # For server-side sessions
+import fragment_cache # For caching the admin table rows
+import static_assets # For serving the hashed, precompressed static files
+import jobs # For running long admin operations in the background
+from db import get_db_connection # Per-thread, reused database connections
+from config import get_config # For the per-environment app config
 
 # MFA Imports
 import pyotp # For MFA
-import qrcode # For generating QR codes
+import io # For rendering QR codes in memory
+import base64 # For inlining QR codes as data URIs
+from functools import lru_cache # For caching rendered QR codes
+# qrcode (which pulls in PIL) is only needed for MFA setup, so it's imported there - not by every worker on boot
 
-app = Flask(__name__)
-app.secret_key = 'placeholder_secret_key' #change this for deployment >:(
+bp = Blueprint('main', __name__) # Every route - registered on the app by create_app()
 
-# Session Timeout
-app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(minutes=15)
+# Bulk Operations
+MAX_BULK_ASSIGN_NAMES = 5000 # Most usernames (or list names) one bulk assignment can take
+
+# Study API - deck chunk sizes and study event limits
+DECK_CHUNK_SIZE = 200 # Default chunk - most decks fit in one
+MAX_DECK_CHUNK_SIZE = 1000
+MAX_EVENT_BATCH = 100 # Most study events per request
+MAX_EVENT_AGE = 24 * 60 * 60 # Seconds - older client timestamps are replaced with the time they arrived
+
+# Admin Tables - sortable columns (all indexed) and typeahead sources
+LIST_SORT_COLUMNS = {'id': 'list_id', 'name': 'list_name'}
+USER_SORT_COLUMNS = {'id': 'id', 'username': 'username'}
+TYPEAHEAD_FIELDS = {'username': ('users', 'username', 'deleted_at IS NULL'), 'listname': ('flashcard_lists', 'list_name', None)} # table, column, condition
 
 # Rate Limiting
-limiter = Limiter(get_remote_address, app=app, default_limits=["10 per minute"])
+# Counters are kept in a small SQLite database shared by every worker process (see rate_limit_storage.py), so a limit means the same thing
+# however many workers are running and survives restarts. The sliding window stops a burst at the end of one minute doubling up with the start of the next.
+RATE_LIMITS = { # Limit profiles - routes pick the profile that matches how often they're legitimately hit
+    'default': "10 per minute", # Anything without its own profile
+    'pre_auth': "10 per minute", # Login, MFA and registration attempts - per address and account (see pre_auth_key), so guessing is slow for each account
+    'pre_auth_ip': "100 per minute", # ...and per address, loose enough for a classroom behind one NAT address all logging in at once
+    'study': "120 per minute", # Flipping through cards - a quick student can easily manage a card every couple of seconds
+    'api': "60 per minute", # Study API reads (deck chunks are 200 cards, so a whole deck is a handful of requests)
+    'api_write': "120 per minute", # Grading cards and sending study events
+    'typeahead': "120 per minute", # One lookup per keystroke (debounced) - the default limit would cut typeahead off almost straight away
+    'admin_write': "5 per minute",
+    'destructive': "4 per minute",
+}
+
+def rate_limit_key():
+    # Signed in users are limited per user rather than per IP - a classroom behind one NAT address would otherwise share a single limit
+    if session.get('logged_in') and session.get('user_id') is not None:
+        return f"user:{session['user_id']}"
+    return get_remote_address()
+
+def pre_auth_key():
+    # Before sign in there's no user to limit, and limiting by IP alone locks a whole classroom out after a few typos - so attempts are limited per
+    # address and account: the submitted username, or the user waiting on MFA
+    if session.get('pending_user') is not None and request.endpoint == 'main.verify_mfa':
+        account = f"user:{session['pending_user']}"
+    else:
+        account = request.form.get('username', '').strip().lower()[:64]
+    return f'{get_remote_address()}|{account}'
+
+limiter = Limiter(rate_limit_key, default_limits=[RATE_LIMITS['default']])
 
 # CSRF Protection
-csrf = CSRFProtect(app)
-
-# Logging
-logging.basicConfig(
-    filename='app.log', # Log file
-    level=logging.DEBUG, # Log level
-    format='%(asctime)s - %(levelname)s - %(message)s' # Log format
-)
-
-# Cookie Security
-app.config.update( 
-    SESSION_COOKIE_SECURE=True, # Enforces HTTPS
-    SESSION_COOKIE_HTTPONLY=True, # Prevents client-side JS from accessing session cookies
-    SESSION_COOKIE_SAMESITE="Strict" # Prevents CSRF attacks - cookies can only be sent to the same site that set them
-    )
+csrf = CSRFProtect()
 
 # Enforcing HTTPS usage
-@app.before_request
 def enforce_https():
-    if not request.is_secure and app.env != "development":
+    if not request.is_secure and current_app.config['ENFORCE_HTTPS']:
         return redirect(request.url.replace("http://", "https://")) # NOTE: THIS IS A TEMPORARY SOLUTION FOR OFFLINE TESTING PURPOSES. PLEASE USE redirect("https://domain_name.com/" + request.path) FOR PRODUCTION!
 
 def make_session_permanent():
     session.permanent = True 
 
-# Error Handlers
-register_error_handlers(app) # Register the error handlers - from error_handlers.py
-
 # Context Processor to make Logout Form available Globally
-@app.context_processor
 def inject_logout_form():
     return dict(logout_form=LogoutForm()) # This will make the logout form available in all templates
 
-def init_db():
-    conn = sqlite3.connect('database.db')
-    conn.execute("PRAGMA foreign_keys = ON") # Enable foreign key constraints - this is important for cascading deletes
-    c = conn.cursor()
+## APP FACTORY ##
+# Builds the app. Nothing here touches the database - schema setup is 'python migrate_db.py', run once per deploy, not by every worker as it starts.
+# config: an environment name ('development', 'testing', 'production'), a config class/object, or None for KANACARD_ENV - see config.py
 
-    try:
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.from_object(get_config(config) if config is None or isinstance(config, str) else config)
 
-        # Schema Code
-        # | users     | students       | flashcard_lists | list_students  | flashcards  |
-        # |-----------|----------------|-----------------|----------------|-------------|
-        # | id   (P)  | student_id (P) | list_id (P)     | list_id (F)    | card_id (P) |
-        # | username  | user_id (F)    | list_name       | student_id (F) | list_id (F) |
-        # | password  |                |                 |                | question    |
-        # | f_name    |                |                 |                | answer      |
-        # | l_name    |                |                 |                |             |
-        # | email     |                |                 |                |             |
-        # | admin     |                |                 |                |             |
-        # | mfa_secret|                |                 |                |             |
-        # |-----------|----------------|-----------------|----------------|-------------|
-        
-        c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT NOT NULL,
-            password TEXT NOT NULL,
-            f_name TEXT NOT NULL,
-            l_name TEXT NOT NULL,
-            email TEXT NOT NULL,
-            admin BOOLEAN DEFAULT FALSE,
-            mfa_secret TEXT
-        );
-        ''')
-
-        c.execute('''
-        CREATE TABLE IF NOT EXISTS students (
-            student_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER UNIQUE NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-        ''')
-
-        c.execute('''
-        CREATE TABLE IF NOT EXISTS flashcard_lists (
-            list_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            list_name TEXT NOT NULL
-        )
-        ''')
-
-        c.execute('''
-        CREATE TABLE IF NOT EXISTS list_students (
-            list_id INTEGER NOT NULL,
-            student_id INTEGER NOT NULL,
-            PRIMARY KEY (list_id, student_id),
-            FOREIGN KEY (list_id) REFERENCES flashcard_lists(list_id) ON DELETE CASCADE,
-            FOREIGN KEY (student_id) REFERENCES students(student_id) ON DELETE CASCADE
-        )
-        ''')
-
-        c.execute('''
-        CREATE TABLE IF NOT EXISTS flashcards (
-            card_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            list_id INTEGER NOT NULL,
-            question TEXT NOT NULL,
-            answer TEXT NOT NULL,
-            FOREIGN KEY (list_id) REFERENCES flashcard_lists(list_id) ON DELETE CASCADE
-        )
-        ''')
-
-        conn.commit()
-    except sqlite3.Error as e:
-        logging.error(f"Database error: {e}")
-        conn.rollback()
-        # Handle the error appropriately (e.g., log it, display an error message)
-        # It might be appropriate to re-raise the exception in some cases
-    finally:
-        conn.close()
+    # Database Connections
+    db.init_app(app) # Database path (KANACARD_DATABASE) and connection tuning come from app.config - see db.py
+
+    # Sessions
+    session_store.init_app(app) # The cookie only carries a session id - sessions live in the database, cached per process. See session_store.py
+
+    # Static Files
+    static_assets.init_app(app) # Hashed, precompressed copies built by build_static.py - url_for('static', ...) picks them up when they've been built
+
+    # Fragment Cache
+    fragment_cache.init_app(app) # Rendered admin table rows, keyed by table version - size comes from app.config. See fragment_cache.py
+
+    # Metrics
+    metrics.init_app(app) # Times every request and every query made through get_db_connection() - served at /metrics
+
+    # Password Hashing
+    password_hashing.init_app(app) # KDF cost and verification pool size come from app.config - see password_hashing.py
+
+    # Study Events
+    study_events.init_app(app) # Buffer size and flush timing come from app.config - see study_events.py
+
+    # Background Jobs
+    jobs.init_app(app) # Worker threads for chunked deletes and imports - pool size and chunk size come from app.config. See jobs.py
+
+    # Rate Limiting
+    app.config.setdefault('RATELIMIT_STORAGE_URI', rate_limit_storage.default_uri())
+    app.config.setdefault('RATELIMIT_STRATEGY', 'sliding-window-counter')
+    limiter.init_app(app)
+
+    # CSRF Protection
+    csrf.init_app(app)
 
-init_db()
+    # Logging
+    logging_config.init_app(app) # Queued JSON logs with rotation - level per environment (LOG_ENV), file and sampling come from app.config - see logging_config.py
 
-def get_db_connection():
-    conn = sqlite3.connect('database.db')
-    conn.execute("PRAGMA foreign_keys = ON")  # Enable foreign key constraints
-    return conn
+    app.before_request(enforce_https)
 
-@app.route('/')
+    # Error Handlers
+    register_error_handlers(app) # Register the error handlers - from error_handlers.py
+
+    app.context_processor(inject_logout_form)
+    app.register_blueprint(bp)
+    return app
+
+@bp.route('/')
 def index():
     # This will probably be like a massive 'redirect' function. Something like:
     # If user is a student, redirect to student dashboard. If user is an admin, redirect to admin dashboard. Else, redirect to the login page.
@@ -163,7 +177,9 @@ def index():
 
 ## ACCOUNT MANAGEMENT ##
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
+@limiter.limit(RATE_LIMITS['pre_auth'], key_func=pre_auth_key, methods=['POST'])
+@limiter.limit(RATE_LIMITS['pre_auth_ip'], key_func=get_remote_address)
 def login():
     login_form = LoginForm()
     mfa_form = MFAVerificationForm()
@@ -173,15 +189,30 @@ def login():
 
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
+            cursor.execute('SELECT id, username, password, mfa_secret FROM users WHERE username = ? AND deleted_at IS NULL', (username,)) # Deleted users can't log in, even before their deletion job has run
             user = cursor.fetchone()
 
-        if user and check_password_hash(user[2], password):
+        password_matches = False
+        if user:
+            try:
+                password_matches, new_hash = password_hashing.verify_password(user[2], password) # Runs on the bounded verification pool, not this thread
+            except password_hashing.VerifierBusy:
+                logging.warning(f'Login for user {username} refused - password verification is at capacity')
+                flash('Lots of people are logging in right now. Please try again in a few seconds.', 'error')
+                response = make_response(render_template('login.html', login_form=login_form, mfa_form=mfa_form, show_mfa_modal=False), 503)
+                response.headers['Retry-After'] = '5'
+                return response
+            if new_hash: # The stored hash used an older KDF/cost - replace it now that the password has been confirmed
+                with get_db_connection() as conn:
+                    conn.execute('UPDATE users SET password = ? WHERE id = ?', (new_hash, user[0]))
+                logging.info(f"Rehashed password for user {username}")
+
+        if password_matches:
             # MFA
             session['pending_user'] = user[0]
             session['username'] = user[1]
             logging.info(f"User {username} logged in")
-            if not user[7]:  # if the user's first time logging in, therefore no MFA secret
+            if not user[3]:  # if the user's first time logging in, therefore no MFA secret
                 return redirect('/mfa_setup')
             return render_template('login.html', login_form=login_form, mfa_form=mfa_form, show_mfa_modal=True)
         else:
@@ -191,7 +222,7 @@ def login():
     return render_template('login.html', login_form=login_form, mfa_form=mfa_form, show_mfa_modal=False)
 
 ## MFA ##
-@app.route('/mfa_setup', methods=['GET', 'POST'])
+@bp.route('/mfa_setup', methods=['GET', 'POST'])
 def mfa_setup():
     if 'pending_user' not in session:
         logging.warning("User attempted to access MFA setup without logging in")
@@ -202,8 +233,12 @@ def mfa_setup():
     # Retrieves the current MFA secret key for the user
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT mfa_secret FROM users WHERE id = ?", (user_id,))
-        secret = cursor.fetchone()[0]
+        cursor.execute("SELECT mfa_secret FROM users WHERE id = ? AND deleted_at IS NULL", (user_id,))
+        row = cursor.fetchone()
+        if row is None: # Deleted since they entered their password
+            session.clear()
+            return redirect('/login')
+        secret = row[0]
 
         # If they don't have one, generate an MFA secret key
         if not secret:
@@ -215,12 +250,20 @@ def mfa_setup():
     totp = pyotp.TOTP(secret)
     uri = totp.provisioning_uri(name=session['username'], issuer_name='Flashcard App')
 
-    qr = qrcode.make(uri)
-    qr_path = 'static/qrcode.png'
-    qr.save(qr_path)
-    return render_template('mfa_setup.html', qr_path=qr_path)
+    response = make_response(render_template('mfa_setup.html', qr_data_uri=qr_code_data_uri(uri)))
+    response.headers['Cache-Control'] = 'no-store' # The QR code contains the user's MFA secret - never cache it
+    return response
+
+@lru_cache(maxsize=64) # Refreshing the setup page reuses the encoded image. Keyed by the provisioning URI, so each user gets their own code.
+def qr_code_data_uri(uri): # Renders the QR code as a PNG in memory and inlines it - nothing is written to disk or shared between users
+    import qrcode # Only needed the first time each user sets up MFA
+    buffer = io.BytesIO()
+    qrcode.make(uri).save(buffer)
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
 
-@app.route('/verify_mfa', methods=['POST'])
+@bp.route('/verify_mfa', methods=['POST'])
+@limiter.limit(RATE_LIMITS['pre_auth'], key_func=pre_auth_key, methods=['POST'])
+@limiter.limit(RATE_LIMITS['pre_auth_ip'], key_func=get_remote_address)
 def verify_mfa():
     if 'pending_user' not in session:
         return redirect('/login')
@@ -231,8 +274,12 @@ def verify_mfa():
         otp_code = form.verification_code.data
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT mfa_secret FROM users WHERE id = ?", (user_id,))
-            secret = cursor.fetchone()[0]
+            cursor.execute("SELECT mfa_secret FROM users WHERE id = ? AND deleted_at IS NULL", (user_id,))
+            row = cursor.fetchone()
+        if row is None or not row[0]: # Deleted since they entered their password (which clears the MFA secret too)
+            session.clear()
+            return redirect('/login')
+        secret = row[0]
 
         totp = pyotp.TOTP(secret)
         if totp.verify(otp_code):
@@ -260,7 +307,9 @@ def verify_mfa():
     return redirect('/login')
 
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
+@limiter.limit(RATE_LIMITS['pre_auth'], key_func=pre_auth_key, methods=['POST'])
+@limiter.limit(RATE_LIMITS['pre_auth_ip'], key_func=get_remote_address)
 def register():
     register_form = RegisterForm()
     if register_form.validate_on_submit():  # i.e. if it's a form submission
@@ -270,7 +319,7 @@ def register():
         l_name = escape(register_form.last_name.data)
         email = escape(register_form.email.data)
 
-        hashed_password = generate_password_hash(password)
+        hashed_password = password_hashing.hash_password(password)
         try:
             with get_db_connection() as conn:
                 cursor = conn.cursor()
@@ -318,7 +367,7 @@ def register():
 
     return render_template('register.html', register_form=register_form)
 
-@app.route('/logout', methods=['POST']) # POST request to prevent CSRF
+@bp.route('/logout', methods=['POST']) # POST request to prevent CSRF
 def logout():
     form = LogoutForm()
     if form.submit.data:
@@ -332,98 +381,355 @@ def logout():
         return redirect('/')
 
 ## STUDENT ROUTES ##
-@app.route('/student_dashboard')
+@bp.route('/student_dashboard')
+@limiter.limit(RATE_LIMITS['study'])
 def student_dashboard():
     if not session.get('logged_in') or session.get('admin'):
         logging.warning(f'User attempted to access student dashboard without logging in as a student')
         return redirect('/login')
     
-    def get_student_lists(user_id): # Get all of the lists assigned to the student
+    def get_lists_version(user_id): # The student's id, and the version/timestamp of their assigned lists (kept up to date by triggers - see migrate_db.py)
         with get_db_connection() as conn:
-            cursor = conn.cursor()
-            try:
-                cursor.execute('SELECT student_id FROM students WHERE user_id = ?', (user_id,)) # get the student_id of the student, since student_id and user_id are different
-                student_id = cursor.fetchone()[0]
-                logging.debug("Session user_id:", session.get('user_id'))
-                logging.debug("Fetched Student_id", student_id)
+            return conn.execute('SELECT student_id, lists_version, lists_updated_at FROM students WHERE user_id = ?', (user_id,)).fetchone()
 
+    def get_student_lists(student_id): # Get all of the lists assigned to the student, with their card counts
+        with get_db_connection() as conn:
+            try:
+                cursor = conn.cursor()
                 cursor.execute('''
-                SELECT list_id, list_name
-                FROM flashcard_lists
-                WHERE list_id IN (
-                    SELECT list_id
-                    FROM list_students
-                    WHERE student_id = ?
-                )
-                ''', (student_id,)) # get all of the lists assigned to the student.
-
-                lists = [{'id': row[0], 'name': row[1]} for row in cursor.fetchall()]
+                SELECT flashcard_lists.list_id, flashcard_lists.list_name,
+                       (SELECT COALESCE(MAX(position) + 1, 0) FROM flashcards WHERE list_id = flashcard_lists.list_id)
+                FROM list_students
+                JOIN flashcard_lists ON flashcard_lists.list_id = list_students.list_id
+                WHERE list_students.student_id = ?
+                ORDER BY flashcard_lists.list_id
+                ''', (student_id,))
+                lists = [{'id': row[0], 'name': row[1], 'cards': row[2]} for row in cursor.fetchall()]
             except sqlite3.Error as e:
                 flash(f'Database error: {e}', 'error')
                 logging.error(f'Database error: {e} on fetching student lists')
                 lists = []
         return lists
-    logging.info(f"User {session['username']} accessed the student dashboard")
-    return render_template('student_dashboard.html', lists = get_student_lists(session.get('user_id'))) 
 
-@app.route('/student_list/<int:list_id>/<int:card_index>', methods=['GET', 'POST']) # The list_id and card_index are passed as arguments.
+    def dashboard_etag(student_id, lists_version):
+        # The page also shows the session's profile details and a CSRF token, so those are part of the tag too. The token is time limited,
+        # so the tag changes every half token lifetime - a cached page never serves a token that has expired.
+        token_window = int(time.time() // max(1, (current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600) // 2))
+        page_state = json.dumps([session.get('username'), session.get('f_name'), session.get('l_name'), session.get('email'), session.get('csrf_token'), token_window])
+        return f"{student_id}-{lists_version}-{hashlib.sha1(page_state.encode()).hexdigest()[:16]}"
+
+    student = get_lists_version(session.get('user_id'))
+    if student is None:
+        logging.error(f"User {session['username']} accessed the student dashboard but has no student record")
+        return render_template('student_dashboard.html', lists=[])
+    student_id, lists_version, lists_updated_at = student
+    etag = dashboard_etag(student_id, lists_version)
+    last_modified = datetime.fromtimestamp(lists_updated_at, timezone.utc)
+    if not session.get('_flashes') and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified): # Nothing has changed - the browser's copy is still good
+        response = make_response('', 304)
+    else:
+        logging.info(f"User {session['username']} accessed the student dashboard")
+        response = make_response(render_template('student_dashboard.html', lists=get_student_lists(student_id)))
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache' # Only the student's own browser may keep it, and it must check back each time
+    return response
+
+@bp.route('/student_list/<int:list_id>/<int:card_index>', methods=['GET', 'POST']) # The list_id and card_index are passed as arguments.
+@limiter.limit(RATE_LIMITS['study'])
 def list_card(list_id, card_index=0): #card_index is set to 0 by default, since the first card is the default card.
     if not session.get('logged_in') or session.get('admin'):
         logging.warning(f'User attempted to access flashcard view without logging in as a student')
         return redirect('/login')
     
-    def get_list_name(list_id): # Get the name of the list being viewed
-        with get_db_connection() as conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute('SELECT list_name FROM flashcard_lists WHERE list_id = ?', (list_id,))
-                list_name = cursor.fetchone()[0] # Get the name of the list
-            except sqlite3.Error as e:
-                flash(f'Database error, unable to fetch list name: {e}', 'error')
-                logging.error(f'Database error: {e} on fetching list name')
-                list_name = None
-            except Exception as e:
-                flash(f'An error has occured, please try again later', 'error')
-                logging.error(f'error: {e} on fetching listname for list {list_id} in viewing flashcards')
-                list_name = None
-        return list_name # Return the name of the list
-
-    def get_flashcards(list_id): # Get all of the flashcards in the list
+    def get_flashcard(list_id, card_index): # Get the list name, the number of cards, the student's shuffle seed and the single card being viewed in one query
         with get_db_connection() as conn:
             try:
                 cursor = conn.cursor()
-                cursor.execute('SELECT question, answer FROM flashcards WHERE list_id = ?', (list_id,))
-                flashcards = cursor.fetchall()
+                cursor.execute('''
+                SELECT flashcard_lists.list_name,
+                       (SELECT COALESCE(MAX(position) + 1, 0) FROM flashcards WHERE list_id = flashcard_lists.list_id),
+                       (SELECT list_students.shuffle_seed FROM list_students JOIN students ON students.student_id = list_students.student_id
+                        WHERE list_students.list_id = flashcard_lists.list_id AND students.user_id = ?),
+                       flashcards.question,
+                       flashcards.answer
+                FROM flashcard_lists
+                LEFT JOIN flashcards ON flashcards.list_id = flashcard_lists.list_id AND flashcards.position = ?
+                WHERE flashcard_lists.list_id = ?
+                ''', (session.get('user_id'), card_index, list_id)) # positions run 0..n-1 within a list, so MAX(position) + 1 is the card count and comes straight off the index
+                row = cursor.fetchone()
+                if row is not None and row[2] is not None: # Shuffled - card_index is the student's own order, so the card is at another position
+                    position = shuffle.position(row[2], card_index, row[1])
+                    if position != card_index:
+                        card = cursor.execute('SELECT question, answer FROM flashcards WHERE list_id = ? AND position = ?', (list_id, position)).fetchone()
+                        row = row[:3] + (card or (None, None))
             except sqlite3.Error as e:
-                flash(f'Database error, unable to fetch flashcards: {e}', 'error')
-                logging.error(f'Database error: {e} on fetching flashcards')
-                flashcards = []
+                flash(f'Database error, unable to fetch flashcard: {e}', 'error')
+                logging.error(f'Database error: {e} on fetching flashcard')
+                row = None
             except Exception as e:
                 flash(f'An error has occured, please try again later', 'error')
-                logging.error(f'error: {e} on fetching flashcards')
-                flashcards = []
-        return flashcards
+                logging.error(f'error: {e} on fetching flashcard {card_index} for list {list_id}')
+                row = None
+        return row
 
-    flashcards = get_flashcards(list_id) # Get all of the flashcards in the list
-    total_cards = len(flashcards) # Get the total number of flashcards in the list
+    row = get_flashcard(list_id, card_index) # Get the list name, card count and the requested flashcard
 
-    if total_cards == 0 or card_index < 0 or card_index >= total_cards: # If the list is empty or the card index is out of bounds
+    if row is None or row[3] is None: # If the list doesn't exist, is empty, or the card index is out of bounds
         logging.error(f"User {session['username']} attempted to access a non-existent flashcard. List ID: {list_id}, Card Index: {card_index}")
         return "No flashcards found", 404
     
-    logging.info(f"User {session['username']} accessed flashcard {card_index} in list {list_id}")
+    list_name, total_cards, seed = row[0], row[1], row[2]
+    position = shuffle.position(seed, card_index, total_cards) # The card's place in the list - the same as card_index unless the list is shuffled
+    logging.info(f"User {session['username']} accessed flashcard {card_index} in list {list_id}", extra={'sample': 'card_view'}) # Sampled - one of these per card view
+    study_events.record(session.get('user_id'), list_id, position, 'view') # Queued - written in the background. Events record the card's position, not where it came up in a shuffle
 
     return render_template( # Render the list.html template
         'list.html',
-        list_name=get_list_name(list_id), # The list name for this page
-        flashcard=flashcards[card_index],  # Single flashcard for this page
+        list_name=list_name, # The list name for this page
+        flashcard=(row[3], row[4]),  # Single flashcard for this page
         list_id=list_id, # The list ID for this page
         card_index=card_index, # The card index for this page - what's currently being shown
-        total_cards=total_cards
+        card_position=position, # Where that card is in the list - for the study events script.js sends
+        total_cards=total_cards,
+        shuffled=seed is not None, # Whether the student has shuffle mode on for this list
+        shuffle_form=ShuffleForm(),
+        deck_chunk_size=DECK_CHUNK_SIZE # For loading the rest of the deck through the study API
     )
 
+@bp.route('/student_list/<int:list_id>/shuffle', methods=['POST'])
+@limiter.limit(RATE_LIMITS['study'])
+def toggle_shuffle(list_id):
+    # Turns shuffle mode on or off for one of the student's lists, then starts the list again from the first card.
+    # Turning it on picks a new seed, so every shuffle is a fresh order - see shuffle.py
+    if not session.get('logged_in') or session.get('admin'):
+        logging.warning(f'User attempted to shuffle a list without logging in as a student')
+        return redirect('/login')
+    shuffle_form = ShuffleForm()
+    if not shuffle_form.validate_on_submit():
+        logging.warning(f"User {session['username']} made an invalid request to shuffle list {list_id}")
+        flash('Invalid request', 'error')
+        return redirect(url_for('main.list_card', list_id=list_id, card_index=0))
+    try:
+        with get_db_connection() as conn:
+            row = conn.execute('''
+            UPDATE list_students SET shuffle_seed = CASE WHEN shuffle_seed IS NULL THEN ? END
+            WHERE list_id = ? AND student_id = (SELECT student_id FROM students WHERE user_id = ?)
+            RETURNING shuffle_seed
+            ''', (shuffle.new_seed(), list_id, session.get('user_id'))).fetchone()
+    except sqlite3.Error as e:
+        flash(f'Database error: {e}', 'error')
+        logging.error(f'Database error: {e} on shuffling list {list_id}')
+        return redirect(url_for('main.list_card', list_id=list_id, card_index=0))
+    if row is None:
+        flash('You can only shuffle lists you have been assigned', 'error')
+        logging.warning(f"User {session['username']} attempted to shuffle list {list_id}, which they haven't been assigned")
+        return redirect(url_for('main.student_dashboard'))
+    logging.info(f"User {session['username']} turned shuffle {'on' if row[0] is not None else 'off'} for list {list_id}")
+    return redirect(url_for('main.list_card', list_id=list_id, card_index=0))
+
+def get_student_id(conn): # The logged in user's student_id (None for admins and missing students) - student_id and user_id are different
+    row = conn.execute('SELECT student_id FROM students WHERE user_id = ?', (session.get('user_id'),)).fetchone()
+    return row[0] if row else None
+
+@bp.route('/search')
+@limiter.limit(RATE_LIMITS['api'])
+def search_flashcards():
+    # Full text search over flashcards: ?q=<text>. Students only see cards from their assigned lists; admins search every list.
+    if not session.get('logged_in'):
+        return jsonify(error='Not logged in'), 401
+    query = request.args.get('q', '').strip()
+    if not query or len(query) > 200:
+        return jsonify(error='Search for between 1 and 200 characters'), 400
+
+    try:
+        conn = get_db_connection()
+        student_id = None
+        if not session.get('admin'):
+            student_id = get_student_id(conn)
+            if student_id is None:
+                return jsonify(results=[], complete=True)
+        results, complete = search.search_cards(conn, query, student_id)
+        shuffled = {} # list_id -> (seed, card count) for the student's shuffled lists - their results link to where the card comes up in the shuffle
+        if student_id is not None and results:
+            shuffled = {row[0]: (row[1], row[2]) for row in conn.execute('''
+            SELECT list_id, shuffle_seed, (SELECT COALESCE(MAX(position) + 1, 0) FROM flashcards WHERE flashcards.list_id = list_students.list_id)
+            FROM list_students WHERE student_id = ? AND shuffle_seed IS NOT NULL
+            ''', (student_id,))}
+    except sqlite3.Error as e:
+        logging.error(f'Database error: {e} on searching flashcards')
+        return jsonify(error='Search is unavailable right now, please try again later'), 500
+
+    for result in results:
+        if result['list_id'] in shuffled:
+            seed, total_cards = shuffled[result['list_id']]
+            result['card_index'] = shuffle.card_index(seed, result['card_index'], total_cards)
+        result['url'] = url_for('main.list_card', list_id=result['list_id'], card_index=result['card_index'])
+    logging.info(f"User {session['username']} searched flashcards ({len(results)} results{'' if complete else ', scan limit reached'})")
+    return jsonify(results=results, complete=complete) # complete is false when a short-term search stopped at search.MAX_SCAN cards - a longer term searches everything
+
+## STUDY API ##
+# Versioned JSON endpoints for the study pages. script.js loads a deck from here in chunks and flips through it locally,
+# instead of loading a page per card - list_card still serves each card on its own as the fallback.
+
+def get_deck_chunk(conn, list_id, seed, total_cards, offset, limit):
+    # Cards offset..offset+limit of a deck, in the student's order: list order, or their shuffle of it if the list has a seed (see shuffle.py)
+    if seed is None:
+        rows = conn.execute(
+            'SELECT position, question, answer FROM flashcards WHERE list_id = ? AND position >= ? AND position < ? ORDER BY position',
+            (list_id, offset, offset + limit)
+        ).fetchall() # A range seek on the (list_id, position) index - as cheap at the end of a deck as at the start
+        return [{'index': row[0], 'position': row[0], 'question': row[1], 'answer': row[2]} for row in rows]
+    indexes = {shuffle.position(seed, index, total_cards): index for index in range(offset, min(offset + limit, total_cards))} # Position -> where it comes up
+    if not indexes:
+        return []
+    rows = conn.execute(
+        f"SELECT position, question, answer FROM flashcards WHERE list_id = ? AND position IN ({', '.join('?' * len(indexes))})",
+        (list_id, *indexes)
+    ).fetchall() # One index seek per card - the shuffled deck is never loaded or stored as a whole
+    return sorted(({'index': indexes[row[0]], 'position': row[0], 'question': row[1], 'answer': row[2]} for row in rows), key=lambda card: card['index'])
+
+@bp.route('/api/v1/lists/<int:list_id>/cards')
+@limiter.limit(RATE_LIMITS['api'])
+def deck_cards(list_id):
+    # A chunk of a deck: ?offset=<index of the first card>&limit=<number of cards>. Students can only load lists they've been assigned.
+    if not session.get('logged_in') or session.get('admin'):
+        return jsonify(error='Not logged in as a student'), 401
+    offset = request.args.get('offset', 0, type=int)
+    limit = min(request.args.get('limit', DECK_CHUNK_SIZE, type=int), MAX_DECK_CHUNK_SIZE)
+    if offset < 0 or limit < 1:
+        return jsonify(error='offset must be 0 or more, and limit at least 1'), 400
+
+    try:
+        conn = get_db_connection()
+        deck = conn.execute('''
+        SELECT flashcard_lists.list_name, flashcard_lists.version,
+               (SELECT COALESCE(MAX(position) + 1, 0) FROM flashcards WHERE list_id = flashcard_lists.list_id),
+               list_students.shuffle_seed
+        FROM flashcard_lists
+        JOIN list_students ON list_students.list_id = flashcard_lists.list_id
+        JOIN students ON students.student_id = list_students.student_id
+        WHERE flashcard_lists.list_id = ? AND students.user_id = ?
+        ''', (list_id, session.get('user_id'))).fetchone()
+        if deck is None:
+            return jsonify(error='List not found'), 404
+        list_name, version, total_cards, seed = deck
+
+        gzipped = 'gzip' in request.accept_encodings
+        etag = f"{list_id}-{version}-{seed if seed is not None else 'ordered'}-{offset}-{limit}{'-gzip' if gzipped else ''}" # The list's version changes with every card edit, and the seed with every reshuffle, so this identifies the chunk's contents
+        if not is_resource_modified(request.environ, etag=etag): # The browser's copy is still current - no need to read the cards
+            response = make_response('', 304)
+        else:
+            response = jsonify(
+                list_id=list_id,
+                list_name=list_name,
+                version=version,
+                total=total_cards,
+                offset=offset,
+                shuffled=seed is not None,
+                cards=get_deck_chunk(conn, list_id, seed, total_cards, offset, limit),
+                next_offset=offset + limit if offset + limit < total_cards else None,
+            )
+            if gzipped:
+                response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+                response.headers['Content-Encoding'] = 'gzip'
+    except sqlite3.Error as e:
+        logging.error(f'Database error: {e} on fetching cards for list {list_id}')
+        return jsonify(error='Unable to load this list right now, please try again later'), 500
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache' # The browser keeps it, but checks back (a cheap 304) each time
+    response.vary.add('Accept-Encoding')
+    return response
+
+@bp.route('/api/v1/reviews/due')
+@limiter.limit(RATE_LIMITS['api'])
+def due_reviews():
+    # The next session's worth of due cards across all of the student's lists: ?limit=<number of cards>
+    if not session.get('logged_in') or session.get('admin'):
+        return jsonify(error='Not logged in as a student'), 401
+    limit = min(max(request.args.get('limit', scheduler.SESSION_SIZE, type=int), 1), scheduler.MAX_SESSION_SIZE)
+    try:
+        conn = get_db_connection()
+        student_id = get_student_id(conn)
+        if student_id is None:
+            return jsonify(cards=[], due=0)
+        cards, due = scheduler.due_cards(conn, student_id, limit), scheduler.due_count(conn, student_id)
+    except sqlite3.Error as e:
+        logging.error(f'Database error: {e} on fetching due reviews')
+        return jsonify(error='Unable to load your reviews right now, please try again later'), 500
+    logging.info(f"User {session['username']} fetched {len(cards)} due reviews ({due} due in total)")
+    return jsonify(cards=cards, due=due)
+
+@bp.route('/api/v1/reviews/<int:card_id>', methods=['POST'])
+@limiter.limit(RATE_LIMITS['api_write'])
+def grade_review(card_id):
+    # Grades a card (JSON: {"grade": 0-5}) and schedules its next review. Needs the CSRF token in an X-CSRFToken header (see the csrf-token meta tag in layout.html).
+    if not session.get('logged_in') or session.get('admin'):
+        return jsonify(error='Not logged in as a student'), 401
+    grade = (request.get_json(silent=True) or {}).get('grade')
+    if not isinstance(grade, int) or isinstance(grade, bool) or not 0 <= grade <= scheduler.MAX_GRADE:
+        return jsonify(error=f'grade must be a whole number from 0 to {scheduler.MAX_GRADE}'), 400
+    try:
+        conn = get_db_connection()
+        student_id = get_student_id(conn)
+        if student_id is None:
+            return jsonify(error='Card not found'), 404
+        review = scheduler.record_review(conn, student_id, card_id, grade)
+    except scheduler.ReviewNotFound:
+        return jsonify(error='Card not found'), 404
+    except sqlite3.Error as e:
+        logging.error(f'Database error: {e} on grading card {card_id}')
+        return jsonify(error='Unable to save your review right now, please try again later'), 500
+    logging.info(f"User {session['username']} graded card {card_id} {grade}, next due in {review['interval_days']} days")
+    return jsonify(review)
+
+@bp.route('/api/v1/events', methods=['POST'])
+@limiter.limit(RATE_LIMITS['api_write'])
+def record_study_events():
+    # Records study events: one {"type", "list_id", "card_index", "at"} object, or {"events": [...]} with up to MAX_EVENT_BATCH of them.
+    # Events are queued and written in batches in the background (see study_events.py). Answers 503 if the queue is full, so clients back off and retry.
+    if not session.get('logged_in') or session.get('admin'):
+        return jsonify(error='Not logged in as a student'), 401
+    payload = request.get_json(silent=True)
+    events = payload.get('events') if isinstance(payload, dict) and 'events' in payload else [payload]
+    if not isinstance(events, list) or not 1 <= len(events) <= MAX_EVENT_BATCH:
+        return jsonify(error=f'Send between 1 and {MAX_EVENT_BATCH} events'), 400
+
+    now = time.time()
+    parsed = []
+    for event in events:
+        if (not isinstance(event, dict) or event.get('type') not in study_events.EVENT_TYPES
+                or type(event.get('list_id')) is not int or type(event.get('card_index')) is not int):
+            return jsonify(error=f"Each event needs a type ({', '.join(study_events.EVENT_TYPES)}), a list_id and a card_index"), 400
+        at = event.get('at')
+        occurred_at = at if type(at) in (int, float) and now - MAX_EVENT_AGE <= at <= now else now # The client's clock, unless it's missing or implausible
+        parsed.append((event['list_id'], event['card_index'], event['type'], occurred_at))
+
+    list_ids = sorted({event[0] for event in parsed})
+    try: # Students can only record events for lists they've been assigned, as with the deck API
+        assigned = {row[0] for row in get_db_connection().execute(f'''
+        SELECT list_students.list_id FROM list_students
+        JOIN students ON students.student_id = list_students.student_id
+        WHERE students.user_id = ? AND list_students.list_id IN ({', '.join('?' * len(list_ids))})
+        ''', [session.get('user_id')] + list_ids)}
+    except sqlite3.Error as e:
+        logging.error(f'Database error: {e} on recording study events')
+        return jsonify(error='Unable to record your progress right now, please try again later'), 500
+    if len(assigned) < len(list_ids):
+        return jsonify(error='List not found'), 404
+
+    accepted = sum(study_events.record(session.get('user_id'), list_id, card_index, event_type, occurred_at) for list_id, card_index, event_type, occurred_at in parsed)
+    if accepted < len(parsed):
+        logging.warning(f"Study event buffer full - dropped {len(parsed) - accepted} events from user {session['username']}")
+        response = jsonify(accepted=accepted, dropped=len(parsed) - accepted)
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    return jsonify(accepted=accepted), 202
+
 ## ADMIN ROUTES ##
-@app.route('/admin_dashboard')
+@bp.route('/admin_dashboard')
 def admin_dashboard():
     if not session.get('logged_in') or not session.get('admin'):
         logging.warning(f'User attempted to access admin dashboard without logging in as an admin')
@@ -433,92 +739,133 @@ def admin_dashboard():
 
 ## LIST MANAGEMENT ##
 
-@app.route('/admin_dashboard/lists', methods=['GET', 'POST'])
+def get_page_args(sort_columns, default_sort): # Reads the table paging/sorting arguments from the query string
+    sort = request.args.get('sort', default_sort)
+    if sort not in sort_columns: # Only indexed columns can be sorted on, so every page stays an index seek
+        sort = default_sort
+    return {
+        'sort': sort,
+        'dir': 'desc' if request.args.get('dir') == 'desc' else 'asc',
+        'after': request.args.get('after'),
+        'before': request.args.get('before'),
+        'q': request.args.get('q', '').strip(),
+    }
+
+def get_cached_rows(table, template, name, args, get_page):
+    # The page of rows and their rendered HTML, from the fragment cache if the table hasn't changed since they were rendered
+    try:
+        version = fragment_cache.table_version(get_db_connection(), table)
+    except sqlite3.Error as e:
+        logging.error(f'Database error: {e} on reading the {table} table version')
+        version = None
+    key = tuple(sorted(args.items()))
+    cached = fragment_cache.get(table, version, key) if version is not None else None
+    if cached is not None:
+        return cached
+    page = get_page(args)
+    rows_html = Markup(render_template(template, **{name: page['rows']}))
+    if version is not None and not page.get('error'):
+        fragment_cache.put(table, version, key, (page, rows_html), len(rows_html))
+    return page, rows_html
+
+@bp.route('/metrics')
+@limiter.exempt
+def metrics_endpoint():
+    # Prometheus metrics - for admins, or a scraper with METRICS_TOKEN (or on METRICS_ALLOWED_IPS) - see metrics.py
+    if not (session.get('logged_in') and session.get('admin')) and not metrics.scrape_allowed():
+        logging.warning(f'Metrics requested from {request.remote_addr} without logging in as an admin or a valid scrape token')
+        return 'Forbidden', 403
+    response = make_response(metrics.render({
+        'password': password_hashing.get_stats,
+        'study_events': study_events.get_stats,
+        'sessions': session_store.get_stats,
+        'fragment_cache': fragment_cache.get_stats,
+        'jobs': jobs.get_stats,
+        'log': lambda: dict(logging_config.stats),
+    }))
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@bp.route('/admin_dashboard/lists', methods=['GET', 'POST'])
 def list_management():
     if not session.get('logged_in') or not session.get('admin'):
         logging.warning(f'User attempted to access list management without logging in as an admin')
         return redirect('/login')
 
-    def get_all_lists():
-        with get_db_connection() as conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute('SELECT list_id, list_name FROM flashcard_lists')
-                lists = cursor.fetchall()
-            except sqlite3.Error as e:
-                flash(f'Database error - Unable to fetch Lists: {e}', 'error')
-                logging.error(f'Database error: {e} on fetching lists')
-                lists = []
-        return lists
-    
-    def get_all_usernames(): # Get all usernames for the assign list form
-        with get_db_connection() as conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute('SELECT username FROM users')
-                usernames = [row[0] for row in cursor.fetchall()]
-            except sqlite3.Error as e:
-                flash(f'Database error - Unable to fetch Usernames: {e}', 'error')
-                logging.error(f'Database error: {e} on fetching usernames')
-                usernames = []
-        return usernames
+    def get_lists_page(args): # One page of lists, sorted by list_id or list_name
+        try:
+            page = pagination.fetch_page(get_db_connection(), 'flashcard_lists', ['list_id', 'list_name'], 'list_id', LIST_SORT_COLUMNS[args['sort']],
+                                         descending=args['dir'] == 'desc', after=args['after'], before=args['before'], prefix_column='list_name', prefix=args['q'])
+        except sqlite3.Error as e:
+            flash(f'Database error - Unable to fetch Lists: {e}', 'error')
+            logging.error(f'Database error: {e} on fetching lists')
+            page = {'rows': [], 'next': None, 'prev': None, 'error': True}
+        return page
 
-    def get_all_listnames():
-        with get_db_connection() as conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute('SELECT list_name FROM flashcard_lists')
-                listnames = [row[0] for row in cursor.fetchall()]
-            except sqlite3.Error as e:
-                flash(f'Database error - Unable to fetch Listnames: {e}', 'error')
-                logging.error(f'Database error: {e} on fetching listnames')
-                listnames = []
-        return listnames
-    
+    args = get_page_args(LIST_SORT_COLUMNS, 'id')
+    page, rows_html = get_cached_rows('flashcard_lists', 'list_rows.html', 'lists', args, get_lists_page)
     list_form = ListEditForm()
     delete_form = DeleteItemForm()
     add_list_form = ListForm()
     assign_form = AssignListForm()
+    import_form = ImportListForm()
+    bulk_assign_form = BulkAssignForm()
     logging.info(f"User {session['username']} accessed the list management page")
-    return render_template('list_management.html', lists = get_all_lists(), usernames = get_all_usernames(), listnames = get_all_listnames(), list_form=list_form, delete_form=delete_form, add_list_form=add_list_form, assign_form=assign_form)
+    return render_template('list_management.html', rows_html=rows_html, page=page, page_args=args, list_form=list_form, delete_form=delete_form, add_list_form=add_list_form, assign_form=assign_form, import_form=import_form, bulk_assign_form=bulk_assign_form)
 
 ## USER MANAGEMENT ##
 
-@app.route('/admin_dashboard/users', methods=['GET', 'POST'])
+@bp.route('/admin_dashboard/users', methods=['GET', 'POST'])
 def user_management():
     if not session.get('logged_in') or not session.get('admin'):
         logging.warning(f'User attempted to access user management without logging in as an admin')
         return redirect('/login')
     
-    def get_all_users():
-        with get_db_connection() as conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute('SELECT id, username, f_name, l_name, email, admin FROM users')
-                users = cursor.fetchall()
-            except sqlite3.Error as e:
-                flash(f'Database error - Unable to fetch Users: {e}', 'error')
-                logging.error(f'Database error: {e} on fetching users')
-                users = []
-        return users
+    def get_users_page(args): # One page of users, sorted by id or username
+        try:
+            page = pagination.fetch_page(get_db_connection(), 'users', ['id', 'username', 'f_name', 'l_name', 'email', 'admin'], 'id', USER_SORT_COLUMNS[args['sort']],
+                                         descending=args['dir'] == 'desc', after=args['after'], before=args['before'], prefix_column='username', prefix=args['q'],
+                                         where='deleted_at IS NULL') # Deleted users are gone as far as admins are concerned, even before their deletion job has run
+        except sqlite3.Error as e:
+            flash(f'Database error - Unable to fetch Users: {e}', 'error')
+            logging.error(f'Database error: {e} on fetching users')
+            page = {'rows': [], 'next': None, 'prev': None, 'error': True}
+        return page
     
+    args = get_page_args(USER_SORT_COLUMNS, 'id')
+    page, rows_html = get_cached_rows('users', 'user_rows.html', 'users', args, get_users_page)
     user_form = UserEditForm()
     delete_form = DeleteItemForm(request.form)
     logging.info(f"User {session['username']} accessed the user management page")
-    return render_template('user_management.html', users=get_all_users(), user_form=user_form, delete_form=delete_form)
+    return render_template('user_management.html', rows_html=rows_html, page=page, page_args=args, user_form=user_form, delete_form=delete_form)
+
+@bp.route('/admin_dashboard/typeahead')
+@limiter.limit(RATE_LIMITS['typeahead'])
+def typeahead():
+    # Suggestions for the assign forms: ?field=username|listname&q=<prefix>. Returns a JSON list of names.
+    if not session.get('logged_in') or not session.get('admin'):
+        return jsonify(error='Forbidden'), 403
+    field = request.args.get('field')
+    prefix = request.args.get('q', '').strip()
+    if field not in TYPEAHEAD_FIELDS or len(prefix) > 255:
+        return jsonify(error='Invalid typeahead request'), 400
+    table, column, condition = TYPEAHEAD_FIELDS[field]
+    try:
+        names = pagination.prefix_search(get_db_connection(), table, column, prefix, where=condition)
+    except sqlite3.Error as e:
+        logging.error(f'Database error: {e} on typeahead for {field}')
+        return jsonify(error='Database error'), 500
+    return jsonify(names)
 
 
-@app.route('/edit_item', methods=["POST"])
-@limiter.limit("5 per minute")
+@bp.route('/edit_item', methods=["POST"])
+@limiter.limit(RATE_LIMITS['admin_write'])
 def edit_item():
     user_form = UserEditForm()
     list_form = ListEditForm()
 
-    # Debug statements
-    logging.debug("User Form Data:", user_form.data)
-    logging.debug("List Form Data:", list_form.data)
-    logging.debug("User Form Validation:", user_form.validate_on_submit())
-    logging.debug("List Form Validation:", list_form.validate_on_submit())
+    logging.debug(f"Edit item request: user edit index {user_form.edit_index.data}, list edit index {list_form.edit_index.data}")
 
     # User Edit Form
     if user_form.validate_on_submit() and user_form.edit_index.data:
@@ -534,10 +881,11 @@ def edit_item():
             admin_value = 1 if new_role == 'admin' else 0
             try:
                 cursor.execute(
-                    "UPDATE users SET username = ?, f_name = ?, l_name = ?, email = ?, admin = ? WHERE id = ?",
+                    "UPDATE users SET username = ?, f_name = ?, l_name = ?, email = ?, admin = ? WHERE id = ? AND deleted_at IS NULL",
                     (new_username, new_first_name, new_last_name, new_email, admin_value, id)
                 )
                 conn.commit()
+                session_store.invalidate_user(int(id)) # Their sessions hold the old details and role - sign them out
                 logging.info(f"User {session['username']} updated user {id} with new values: {new_username}, {new_first_name}, {new_last_name}, {new_email}, {new_role}")
             except sqlite3.Error as e:
                 flash(f'Database error: {e}', 'error')
@@ -569,36 +917,38 @@ def edit_item():
     logging.warning(f"User {session['username']} made an invalid request to edit an item")
     return redirect('/admin_dashboard')
 
-@app.route('/delete_item', methods=["POST"])
-@limiter.limit("4 per minute")
+@bp.route('/delete_item', methods=["POST"])
+@limiter.limit(RATE_LIMITS['destructive'])
 def delete_item():
     delete_form = DeleteItemForm(request.form)
-    logging.debug('Delete Index: ', delete_form.delete_index.data)
-    logging.debug('Delete Type: ', delete_form.delete_type.data)
+    logging.debug(f'Delete request: {delete_form.delete_type.data} {delete_form.delete_index.data}')
     if delete_form.validate_on_submit():
         id = delete_form.delete_index.data
         type = delete_form.delete_type.data
-        with get_db_connection() as conn:
-            try:
-                cursor = conn.cursor()
-                if type == "list":
-                    cursor.execute(
-                        "DELETE FROM flashcard_lists WHERE list_id = ?",
-                        (id,)
-                    ) # This will cascade delete the flashcards as well
-                    conn.commit()
-                    logging.info(f"User {session['username']} deleted list {id}")
-                elif type == "user":
-                    cursor.execute(
-                        "DELETE FROM users WHERE id = ?",
-                        (id,)
-                    ) # This will cascade delete the student record as well
-                    logging.info(f"User {session['username']} deleted user {id}")
-                conn.commit()
-            except sqlite3.Error as e:
-                flash(f'Database error: {e}', 'error')
-                logging.error(f'Database error: {e} on deleting item')
-                conn.rollback()
+        # Big lists and users take many transactions to delete - a background job does it in chunks (see jobs.py), so students aren't kept waiting
+        try:
+            conn = get_db_connection()
+            if type == "list":
+                list_name = conn.execute("SELECT list_name FROM flashcard_lists WHERE list_id = ?", (id,)).fetchone()
+                if list_name is None:
+                    flash('That list no longer exists', 'error')
+                else:
+                    jobs.submit('delete_list', {'list_id': int(id)}, f'Delete list {list_name[0]}', session.get('user_id'))
+                    flash(f'Deleting list {list_name[0]} in the background', 'success')
+                    logging.info(f"User {session['username']} queued the deletion of list {id}")
+            elif type == "user":
+                with conn: # Disables the account now - the job only removes what depends on it, and may be queued behind others
+                    username = conn.execute("UPDATE users SET deleted_at = ?, mfa_secret = NULL WHERE id = ? AND deleted_at IS NULL RETURNING username", (time.time(), id)).fetchone()
+                if username is None:
+                    flash('That user no longer exists', 'error')
+                else:
+                    session_store.invalidate_user(int(id)) # Signs them out everywhere, including halfway through MFA
+                    jobs.submit('delete_user', {'user_id': int(id)}, f'Delete user {username[0]}', session.get('user_id'))
+                    flash(f'Deleting user {username[0]} in the background', 'success')
+                    logging.info(f"User {session['username']} queued the deletion of user {id}")
+        except sqlite3.Error as e:
+            flash(f'Database error: {e}', 'error')
+            logging.error(f'Database error: {e} on deleting item')
         if type == "list":
             return redirect('/admin_dashboard/lists')
         elif type == "user":
@@ -608,8 +958,8 @@ def delete_item():
     flash('Invalid request', 'error')
     return redirect('/admin_dashboard')
 
-@app.route('/admin_dashboard/lists/add_list', methods=['GET', 'POST'])
-@limiter.limit("5 per minute")
+@bp.route('/admin_dashboard/lists/add_list', methods=['GET', 'POST'])
+@limiter.limit(RATE_LIMITS['admin_write'])
 def add_list():
     if not session.get('logged_in') or not session.get('admin'):
         logging.warning(f'User attempted to access list addition without logging in as an admin')
@@ -618,14 +968,15 @@ def add_list():
     add_list_form=ListForm()
     if add_list_form.validate_on_submit() and add_list_form.flashcards.data:
         list_name = add_list_form.list_name.data
-        flashcards = [{'question': fc.question.data, 'answer': fc.answer.data} for fc in add_list_form.flashcards]
+        flashcards = [{'question': search.normalise(fc.question.data), 'answer': search.normalise(fc.answer.data)} for fc in add_list_form.flashcards]
         with get_db_connection() as conn:
             try:
                 cursor = conn.cursor()
                 cursor.execute('INSERT INTO flashcard_lists (list_name) VALUES (?)', (list_name,))
                 list_id = cursor.lastrowid
-                for flashcard in flashcards:
-                    cursor.execute('INSERT INTO flashcards (list_id, question, answer) VALUES (?, ?, ?)', (list_id, flashcard['question'], flashcard['answer'] ))
+                for position, flashcard in enumerate(flashcards): # position keeps the cards in the order they were entered
+                    cursor.execute('INSERT INTO flashcards (list_id, question, answer, position) VALUES (?, ?, ?, ?)', (list_id, flashcard['question'], flashcard['answer'], position))
+                db.bump_student_lists(conn, list_id)
                 conn.commit()
                 flash('List Added', 'success')
                 logging.info(f"User {session['username']} added list {list_name}")
@@ -635,7 +986,129 @@ def add_list():
                 conn.rollback()
     return redirect('/admin_dashboard/lists')
 
-@app.route('/assign_lists', methods=['POST'])
+@bp.route('/admin_dashboard/lists/import', methods=['POST'])
+@limiter.limit(RATE_LIMITS['admin_write'])
+def import_list():
+    if not session.get('logged_in') or not session.get('admin'):
+        logging.warning(f'User attempted to access list import without logging in as an admin')
+        return redirect('/login')
+
+    import_form = ImportListForm()
+    if not import_form.validate_on_submit():
+        for errors in import_form.errors.values():
+            for error in errors:
+                flash(error, 'error')
+        logging.warning(f"User {session['username']} made an invalid request to import a list")
+        return redirect('/admin_dashboard/lists')
+
+    list_name = import_form.list_name.data
+    deck_file = import_form.deck_file.data
+    try:
+        path = jobs.save_upload(deck_file) # The upload is gone once this request ends - the job reads its own copy
+    except OSError as e:
+        flash('The upload could not be saved, please try again', 'error')
+        logging.error(f'Could not save uploaded deck {deck_file.filename}: {e}')
+        return redirect('/admin_dashboard/lists')
+    try:
+        jobs.submit('import_deck', {'path': path, 'list_name': list_name, 'fmt': deck_import.detect_format(deck_file.filename)},
+                    f'Import {deck_file.filename} as {list_name}', session.get('user_id'))
+    except sqlite3.Error as e:
+        os.unlink(path)
+        flash(f'Database error: {e}', 'error')
+        logging.error(f'Database error: {e} on importing list')
+        return redirect('/admin_dashboard/lists')
+
+    flash(f'Importing {list_name} in the background', 'success')
+    logging.info(f"User {session['username']} queued the import of list {list_name} from {deck_file.filename}")
+    return redirect('/admin_dashboard/lists')
+
+@bp.route('/admin_dashboard/jobs')
+@limiter.limit(RATE_LIMITS['api'])
+def list_jobs():
+    # Recent background jobs as JSON, newest first - ?active=1 for just the queued and running ones. Polled by the admin pages.
+    if not session.get('logged_in') or not session.get('admin'):
+        return jsonify(error='Forbidden'), 403
+    try:
+        return jsonify(jobs=jobs.list_jobs(active_only=request.args.get('active') == '1'))
+    except sqlite3.Error as e:
+        logging.error(f'Database error: {e} on listing jobs')
+        return jsonify(error='Jobs are unavailable right now, please try again later'), 500
+
+@bp.route('/admin_dashboard/jobs/<int:job_id>')
+@limiter.limit(RATE_LIMITS['api'])
+def job_progress(job_id):
+    # One job's status and progress as JSON
+    if not session.get('logged_in') or not session.get('admin'):
+        return jsonify(error='Forbidden'), 403
+    try:
+        job = jobs.get_job(job_id)
+    except sqlite3.Error as e:
+        logging.error(f'Database error: {e} on fetching job {job_id}')
+        return jsonify(error='Jobs are unavailable right now, please try again later'), 500
+    if job is None:
+        return jsonify(error='No such job'), 404
+    return jsonify(job)
+
+@bp.route('/admin_dashboard/jobs/<int:job_id>/cancel', methods=['POST'])
+@limiter.limit(RATE_LIMITS['admin_write'])
+def cancel_job(job_id):
+    # Stops a job after its current chunk. Returns the job as JSON, or 409 if it had already finished.
+    if not session.get('logged_in') or not session.get('admin'):
+        return jsonify(error='Forbidden'), 403
+    try:
+        cancelled = jobs.cancel(job_id)
+        job = jobs.get_job(job_id)
+    except sqlite3.Error as e:
+        logging.error(f'Database error: {e} on cancelling job {job_id}')
+        return jsonify(error='Jobs are unavailable right now, please try again later'), 500
+    if job is None:
+        return jsonify(error='No such job'), 404
+    if not cancelled:
+        return jsonify(job), 409
+    logging.info(f"User {session['username']} cancelled job {job_id}")
+    return jsonify(job)
+
+@bp.route('/admin_dashboard/lists/export')
+@limiter.limit(RATE_LIMITS['admin_write'])
+def export_lists():
+    # Downloads one list (?list_id=<id>) or every list as ?format=csv|jsonl|anki. The file is streamed as it's read - see deck_export.py
+    if not session.get('logged_in') or not session.get('admin'):
+        logging.warning(f'User attempted to export lists without logging in as an admin')
+        return redirect('/login')
+
+    fmt = request.args.get('format', 'csv')
+    if fmt not in deck_export.FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(deck_export.FORMATS)}"}), 400
+    list_id = request.args.get('list_id', type=int)
+    conn = db.connect() # Its own connection - the response outlives the request's use of get_db_connection()
+    try:
+        found = deck_export.find_list(conn, list_id) if list_id is not None else None
+    except sqlite3.Error as e:
+        conn.close()
+        flash(f'Database error: {e}', 'error')
+        logging.error(f'Database error: {e} on exporting lists')
+        return redirect('/admin_dashboard/lists')
+    if list_id is not None and found is None:
+        conn.close()
+        flash('List not found', 'error')
+        return redirect('/admin_dashboard/lists')
+
+    def generate():
+        try:
+            for chunk in deck_export.export_deck(conn, fmt, list_id):
+                yield chunk.encode('utf-8')
+        except sqlite3.Error as e: # Too late for an error page - the download just ends early
+            logging.error(f'Database error: {e} on exporting lists')
+        finally:
+            conn.close()
+
+    logging.info(f"User {session['username']} exported {f'list {list_id}' if list_id is not None else 'every list'} as {fmt}")
+    response = Response(stream_with_context(generate()), mimetype=deck_export.FORMATS[fmt][0])
+    response.headers.set('Content-Disposition', 'attachment', **deck_export.content_disposition(fmt, found[1] if found else None, list_id)) # Kana list names go in filename*, with an ASCII filename for older clients
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@bp.route('/assign_lists', methods=['POST'])
 def assign_lists():
     if not session.get('logged_in') or not session.get('admin'):
         logging.warning(f'User attempted to access list assignment without logging in as an admin')
@@ -651,7 +1124,7 @@ def assign_lists():
             with get_db_connection() as conn:
                 cursor = conn.cursor()
 
-                user_result = cursor.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
+                user_result = cursor.execute('SELECT id FROM users WHERE username = ? AND deleted_at IS NULL', (username,)).fetchone()
                 if user_result is None:
                     flash('The specified user does not exist. Please check the username and try again.', 'error')
                     logging.warning(f'User {session["username"]} attempted to assign a list to a non-existent user')
@@ -699,6 +1172,89 @@ def assign_lists():
         logging.error(f'An error occurred: {e} on assigning list')
     return redirect('/admin_dashboard/lists')
 
-# Making Flask run on SSL
-if __name__ == '__main__':
-    app.run(debug=True, ssl_context=('cert.pem', 'key.pem'), host="0.0.0.0", port=443) # Change to debug=False for production
\ No newline at end of file
+@bp.route('/assign_lists/bulk', methods=['POST'])
+@limiter.limit(RATE_LIMITS['admin_write'])
+def bulk_assign_lists():
+    # Assigns every given list to every given student in one transaction. Accepts the bulk assign form, or JSON: {"usernames": [...], "listnames": [...]}
+    if not session.get('logged_in') or not session.get('admin'):
+        logging.warning(f'User attempted to access bulk list assignment without logging in as an admin')
+        return redirect('/login')
+
+    def parse_names(value): # Names can be given as a list, or as one string separated by new lines and/or commas
+        if isinstance(value, str):
+            value = value.replace(',', '\n').splitlines()
+        names = dict.fromkeys(str(escape(name.strip())) for name in value or [] if str(name).strip()) # Dedupes, keeping order. Escaped to match how usernames are stored by register.
+        return list(names)
+
+    if request.is_json:
+        payload = request.get_json(silent=True) or {}
+        usernames, listnames = parse_names(payload.get('usernames')), parse_names(payload.get('listnames'))
+    else:
+        bulk_form = BulkAssignForm()
+        if not bulk_form.validate_on_submit():
+            flash('There was an error with your form submission. Please check your input and try again.', 'error')
+            logging.warning(f'User {session["username"]} made an invalid request to bulk assign lists')
+            return redirect('/admin_dashboard/lists')
+        usernames, listnames = parse_names(bulk_form.usernames.data), parse_names(bulk_form.listnames.data)
+
+    if not usernames or not listnames or len(usernames) > MAX_BULK_ASSIGN_NAMES or len(listnames) > MAX_BULK_ASSIGN_NAMES:
+        message = f'Give between 1 and {MAX_BULK_ASSIGN_NAMES} usernames and list names.'
+        if request.is_json:
+            return jsonify(error=message), 400
+        flash(message, 'error')
+        return redirect('/admin_dashboard/lists')
+
+    def assign(conn, usernames, listnames):
+        usernames_json, listnames_json = json.dumps(usernames), json.dumps(listnames)
+        conn.execute('BEGIN IMMEDIATE') # Summary and insert see the same data
+        unknown_users = [row[0] for row in conn.execute('''
+            SELECT wanted.value FROM json_each(?) AS wanted
+            LEFT JOIN users ON users.username = wanted.value AND users.deleted_at IS NULL
+            LEFT JOIN students ON students.user_id = users.id
+            WHERE students.student_id IS NULL
+            ''', (usernames_json,))] # Users that don't exist (or are being deleted), or aren't students
+        unknown_lists = [row[0] for row in conn.execute('''
+            SELECT wanted.value FROM json_each(?) AS wanted
+            WHERE NOT EXISTS (SELECT 1 FROM flashcard_lists WHERE list_name = wanted.value)
+            ''', (listnames_json,))]
+        pairs = '''
+            SELECT users.username, students.student_id, flashcard_lists.list_id
+            FROM json_each(?) AS wanted_user
+            JOIN users ON users.username = wanted_user.value AND users.deleted_at IS NULL
+            JOIN students ON students.user_id = users.id
+            CROSS JOIN json_each(?) AS wanted_list
+            JOIN flashcard_lists ON flashcard_lists.list_name = wanted_list.value
+            ''' # Every (student, list) pair to assign - resolved with index lookups, not a query per name
+        summary = {row[0]: {'assigned': row[1], 'already_assigned': row[2]} for row in conn.execute(f'''
+            SELECT pairs.username,
+                   SUM(list_students.list_id IS NULL),
+                   SUM(list_students.list_id IS NOT NULL)
+            FROM ({pairs}) AS pairs
+            LEFT JOIN list_students ON list_students.list_id = pairs.list_id AND list_students.student_id = pairs.student_id
+            GROUP BY pairs.username
+            ''', (usernames_json, listnames_json))}
+        conn.execute(f'INSERT OR IGNORE INTO list_students (student_id, list_id) SELECT student_id, list_id FROM ({pairs})', (usernames_json, listnames_json))
+        return summary, unknown_users, unknown_lists
+
+    conn = get_db_connection()
+    try:
+        with conn:
+            summary, unknown_users, unknown_lists = assign(conn, usernames, listnames)
+    except sqlite3.Error as e:
+        logging.error(f'Database error: {e} on bulk assigning lists')
+        if request.is_json:
+            return jsonify(error='An unexpected error occurred while processing your request. Please try again later.'), 500
+        flash('An unexpected error occurred while processing your request. Please try again later.', 'error')
+        return redirect('/admin_dashboard/lists')
+
+    assigned = sum(student['assigned'] for student in summary.values())
+    logging.info(f"User {session['username']} bulk assigned {len(listnames)} lists to {len(summary)} students ({assigned} new assignments)")
+    if request.is_json:
+        return jsonify(students=summary, assigned=assigned, unknown_users=unknown_users, unknown_lists=unknown_lists)
+
+    flash(f'Assigned {assigned} lists across {len(summary)} students', 'success')
+    if unknown_users:
+        flash(f"Not found or not students: {', '.join(unknown_users[:20])}{' ...' if len(unknown_users) > 20 else ''}", 'error')
+    if unknown_lists:
+        flash(f"Lists not found: {', '.join(unknown_lists[:20])}{' ...' if len(unknown_lists) > 20 else ''}", 'error')
+    return redirect('/admin_dashboard/lists')
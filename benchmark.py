@@ -0,0 +1,318 @@
+# This file contains the benchmark harness - seeds a scratch database with synthetic data, then drives the real routes and reports latency per route
+#   python benchmark.py                                           - default sizes, results written to benchmark_results.json
+#   python benchmark.py --students 2000 --lists 1000 --cards-per-list 1000 --threads 16
+#   python benchmark.py --compare old_results.json                - also print the change in p95 for each route (and in startup time)
+# Every seeded user has the same password and TOTP secret, so the benchmark can log in through login -> verify_mfa like a real user.
+# The scratch database (and the app's log file) go in a temporary directory that's removed afterwards, unless --database or --seed-only is given.
+import argparse # For the command line interface
+import json # For the results file
+import os # For the scratch database path
+import random # For synthetic data and request mixes
+import shutil # For removing the scratch directory
+import subprocess # For recording the git commit
+import sys # For exit codes
+import tempfile # For the scratch directory
+import threading # For the multi-threaded client
+import time # For timing
+from contextlib import contextmanager # For suspending triggers while seeding
+from datetime import datetime, timezone # For the results timestamp
+
+BENCH_PASSWORD = 'Bench-Password-1' # Every seeded user's password
+BENCH_MFA_SECRET = 'KANACARDBENCHMARKSECRET2345ABCD' # Every seeded user's TOTP secret (base32)
+ADMIN_USERNAME = 'bench_admin'
+BASE_URL = 'https://localhost' # The app redirects plain HTTP requests to HTTPS
+INSERT_BATCH = 50000 # Rows per executemany while seeding
+
+## SEEDING ##
+
+@contextmanager
+def suspended_triggers(conn, table):
+    # Drops the table's triggers for a bulk load and recreates them afterwards - indexing each row through its triggers is what makes large loads slow
+    triggers = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?", (table,)).fetchall()
+    for name, _ in triggers:
+        conn.execute(f'DROP TRIGGER {name}')
+    try:
+        yield
+    finally:
+        for _, sql in triggers:
+            conn.execute(sql)
+
+def batched(rows, size=INSERT_BATCH):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def seed(conn, students, lists, cards_per_list, lists_per_student, rng, search_index=True, echo=print):
+    # Fills a freshly migrated database. Returns {student username: [assigned list ids]} and the seeding times.
+    import password_hashing
+    timings = {}
+    password_hash = password_hashing.hash_password(BENCH_PASSWORD) # One real hash, shared - hashing every user would take longer than the benchmark
+    conn.execute('PRAGMA synchronous = OFF') # Scratch data - no need to survive a power cut
+
+    start = time.perf_counter()
+    with conn:
+        conn.execute('INSERT INTO users (username, password, f_name, l_name, email, admin, mfa_secret) VALUES (?, ?, ?, ?, ?, 1, ?)',
+                     (ADMIN_USERNAME, password_hash, 'Bench', 'Admin', 'admin@bench.invalid', BENCH_MFA_SECRET))
+        for batch in batched((f'student{i:06d}', password_hash, 'Bench', f'Student {i}', f'student{i}@bench.invalid', BENCH_MFA_SECRET) for i in range(students)):
+            conn.executemany('INSERT INTO users (username, password, f_name, l_name, email, admin, mfa_secret) VALUES (?, ?, ?, ?, ?, 0, ?)', batch)
+        conn.execute('INSERT INTO students (user_id) SELECT id FROM users WHERE admin = 0 ORDER BY id')
+    timings['users'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with conn, suspended_triggers(conn, 'flashcards'):
+        conn.executemany('INSERT INTO flashcard_lists (list_name) VALUES (?)', ((f'Bench List {i:05d}',) for i in range(lists)))
+        list_ids = [row[0] for row in conn.execute('SELECT list_id FROM flashcard_lists ORDER BY list_id')]
+        cards = ((list_id, f'Question {position} of list {list_id} かな', f'Answer {position} カナ', position) for list_id in list_ids for position in range(cards_per_list))
+        for batch in batched(cards):
+            conn.executemany('INSERT INTO flashcards (list_id, question, answer, position) VALUES (?, ?, ?, ?)', batch)
+    timings['cards'] = time.perf_counter() - start
+    echo(f'Seeded {lists * cards_per_list} cards in {timings["cards"]:.1f}s')
+
+    if search_index:
+        start = time.perf_counter()
+        with conn:
+            conn.execute("INSERT INTO flashcards_fts (flashcards_fts) VALUES ('rebuild')")
+        timings['search_index'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    student_ids = conn.execute("SELECT users.username, students.student_id FROM students JOIN users ON users.id = students.user_id ORDER BY students.student_id").fetchall()
+    assignments = {username: rng.sample(list_ids, min(lists_per_student, len(list_ids))) for username, _ in student_ids}
+    with conn:
+        for batch in batched((list_id, student_id) for username, student_id in student_ids for list_id in assignments[username]):
+            conn.executemany('INSERT INTO list_students (list_id, student_id) VALUES (?, ?)', batch) # The triggers seed each student's review queue
+    timings['assignments'] = time.perf_counter() - start
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('ANALYZE')
+    return assignments, timings
+
+## LOAD ##
+
+class Recorder:
+    # Collects (route, seconds, status) samples from every client thread
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def timed(self, route, send):
+        start = time.perf_counter()
+        response = send()
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.samples.setdefault(route, []).append((elapsed, response.status_code))
+        return response
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))]
+
+def summarise(samples, wall_seconds):
+    results = {}
+    for route, route_samples in sorted(samples.items()):
+        latencies = sorted(elapsed for elapsed, _ in route_samples)
+        results[route] = {
+            'requests': len(route_samples),
+            'errors': sum(1 for _, status in route_samples if status >= 400),
+            'throughput_rps': round(len(route_samples) / wall_seconds, 2) if wall_seconds else 0.0,
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        }
+    return results
+
+def log_in(app, recorder, username):
+    # login -> verify_mfa, the way a browser does it. Returns a logged in test client.
+    import pyotp
+    client = app.test_client()
+    recorder.timed('login', lambda: client.post('/login', base_url=BASE_URL, data={'username': username, 'password': BENCH_PASSWORD}))
+    code = pyotp.TOTP(BENCH_MFA_SECRET).now()
+    recorder.timed('verify_mfa', lambda: client.post('/verify_mfa', base_url=BASE_URL, data={'verification_code': code}))
+    return client
+
+def student_session(app, recorder, username, assigned, cards_per_list, iterations, rng):
+    client = log_in(app, recorder, username)
+    for _ in range(iterations):
+        recorder.timed('student_dashboard', lambda: client.get('/student_dashboard', base_url=BASE_URL))
+        list_id = rng.choice(assigned)
+        for _ in range(5): # A few cards per visit to the dashboard
+            card_index = rng.randrange(cards_per_list)
+            recorder.timed('list_card', lambda: client.get(f'/student_list/{list_id}/{card_index}', base_url=BASE_URL))
+
+def admin_session(app, recorder, students, lists, iterations, rng, thread_number):
+    client = log_in(app, recorder, ADMIN_USERNAME)
+    for i in range(iterations):
+        recorder.timed('list_management', lambda: client.get('/admin_dashboard/lists', base_url=BASE_URL))
+        assignment = {'username': f'student{rng.randrange(students):06d}', 'listname': f'Bench List {rng.randrange(lists):05d}'}
+        recorder.timed('assign_lists', lambda: client.post('/assign_lists', base_url=BASE_URL, data=assignment))
+        new_list = {'list_name': f'Added List {thread_number}-{i}'}
+        for card in range(10):
+            new_list[f'flashcards-{card}-question'] = f'Question {card}'
+            new_list[f'flashcards-{card}-answer'] = f'Answer {card}'
+        recorder.timed('add_list', lambda: client.post('/admin_dashboard/lists/add_list', base_url=BASE_URL, data=new_list))
+
+def run_phase(app, assignments, args, threads, rng):
+    # Runs 'threads' clients at once - every thread but the last is a student, the last one is the admin.
+    # With one thread, a student session and then an admin session run one after the other. Returns (samples, wall seconds).
+    recorder = Recorder()
+    usernames = list(assignments)
+    sessions = []
+    for client_number in range(max(threads, 2)):
+        client_rng = random.Random(rng.random())
+        if client_number == max(threads, 2) - 1:
+            sessions.append(lambda client_rng=client_rng, n=client_number: admin_session(app, recorder, args.students, args.lists, args.iterations, client_rng, n))
+        else:
+            username = usernames[client_number % len(usernames)]
+            sessions.append(lambda client_rng=client_rng, username=username: student_session(app, recorder, username, assignments[username], args.cards_per_list, args.iterations, client_rng))
+    if threads <= 1:
+        workers = [threading.Thread(target=lambda: [session() for session in sessions], name='bench-client-0')]
+    else:
+        workers = [threading.Thread(target=session, name=f'bench-client-{n}') for n, session in enumerate(sessions)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return recorder.samples, time.perf_counter() - start
+
+## STARTUP ##
+# A worker's boot cost: importing the app, create_app(), and the first request (which also opens the database and compiles the first templates).
+# Each run is a fresh interpreter, so nothing is already imported or cached.
+
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app('testing')
+created = time.perf_counter()
+status = app.test_client().get('/login', base_url=sys.argv[1]).status_code
+done = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000, 'create_app_ms': (created - imported) * 1000, 'first_request_ms': (done - created) * 1000, 'status': status}))
+'''
+
+def measure_startup(runs):
+    # Median of each startup stage over 'runs' fresh processes
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, BASE_URL], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        timings.append(json.loads(output.strip().splitlines()[-1]))
+    results = {}
+    for stage in ('import_ms', 'create_app_ms', 'first_request_ms'):
+        results[stage] = round(percentile(sorted(timing[stage] for timing in timings), 0.5), 3)
+    results['total_ms'] = round(results['import_ms'] + results['create_app_ms'] + results['first_request_ms'], 3)
+    results['errors'] = sum(timing['status'] >= 400 for timing in timings)
+    return results
+
+## REPORTING ##
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_table(phase, results):
+    print(f'\n{phase}')
+    print(f"{'route':<20}{'requests':>9}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, result in results.items():
+        print(f"{route:<20}{result['requests']:>9}{result['errors']:>8}{result['throughput_rps']:>10}{result['p50_ms']:>10}{result['p95_ms']:>10}{result['p99_ms']:>10}")
+
+def print_startup(runs, startup):
+    print(f'\nstartup (median of {runs} runs)')
+    print('  '.join(f'{stage} {value}' for stage, value in startup.items()))
+
+def print_comparison(previous, current):
+    print(f"\nChange in p95 against {previous.get('commit') or 'previous run'}")
+    for stage, value in current.get('startup', {}).items():
+        old = previous.get('startup', {}).get(stage)
+        if stage != 'errors' and old:
+            print(f"{'startup':<12}{stage:<20}{old:>10} -> {value:<10} ({(value - old) / old * 100:+.1f}%)")
+    for phase, results in current['phases'].items():
+        for route, result in results.items():
+            old = previous.get('phases', {}).get(phase, {}).get(route)
+            if old and old['p95_ms']:
+                change = (result['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100
+                print(f"{phase:<12}{route:<20}{old['p95_ms']:>10} -> {result['p95_ms']:<10} ({change:+.1f}%)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Seed a scratch database and benchmark the app\'s routes.')
+    parser.add_argument('--students', type=int, default=200, help='Student accounts to create (default: %(default)s)')
+    parser.add_argument('--lists', type=int, default=50, help='Flashcard lists to create (default: %(default)s)')
+    parser.add_argument('--cards-per-list', type=int, default=100, help='Cards in each list (default: %(default)s)')
+    parser.add_argument('--lists-per-student', type=int, default=5, help='Lists assigned to each student (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=8, help='Concurrent clients in the multi-threaded phase (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=20, help='Rounds of requests per client (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed, for repeatable runs (default: %(default)s)')
+    parser.add_argument('--database', help='Seed this database file instead of a temporary one (it must not exist yet)')
+    parser.add_argument('--no-search-index', action='store_true', help='Skip building the full text search index')
+    parser.add_argument('--seed-only', action='store_true', help='Seed the database and stop')
+    parser.add_argument('--output', default='benchmark_results.json', help='Where to write the results (default: %(default)s)')
+    parser.add_argument('--compare', help='A previous results file to compare against')
+    parser.add_argument('--startup-runs', type=int, default=5, help='Fresh processes to time app startup in, 0 to skip (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    scratch_dir = tempfile.mkdtemp(prefix='kanacard-bench-')
+    database = os.path.abspath(args.database or os.path.join(scratch_dir, 'bench.db'))
+    if os.path.exists(database):
+        print(f'{database} already exists - the benchmark needs a new database', file=sys.stderr)
+        return 1
+    os.environ['KANACARD_DATABASE'] = database # Must be set before the app is imported
+    os.environ.setdefault('KANACARD_LOG_FILE', os.path.join(scratch_dir, 'app.log'))
+    os.environ.setdefault('KANACARD_RATELIMIT_DATABASE', os.path.join(scratch_dir, 'ratelimits.db'))
+    os.environ.setdefault('KANACARD_ENV', 'testing') # Warnings and errors only, like a quiet production log
+    try:
+        import db
+        import migrate_db
+        rng = random.Random(args.seed)
+        conn = db.connect(database)
+        try:
+            migrate_db.migrate(conn, echo=lambda _: None)
+            assignments, seed_timings = seed(conn, args.students, args.lists, args.cards_per_list, args.lists_per_student, rng, not args.no_search_index)
+        finally:
+            conn.close()
+        print('Seeding: ' + ', '.join(f'{name} {seconds:.2f}s' for name, seconds in seed_timings.items()))
+        if args.seed_only:
+            print(f'Seeded {database}')
+            return 0
+
+        from app import create_app
+        app = create_app('testing') # No CSRF tokens (the test client doesn't render forms) and no rate limits - measure the routes, not the limiter
+        results = {
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'database')},
+            'seed_seconds': {name: round(seconds, 3) for name, seconds in seed_timings.items()},
+            'phases': {},
+        }
+        for phase, threads in (('sequential', 1), ('concurrent', max(2, args.threads))):
+            samples, wall_seconds = run_phase(app, assignments, args, threads, rng)
+            results['phases'][phase] = summarise(samples, wall_seconds)
+            print_table(f'{phase} ({threads} clients, {wall_seconds:.1f}s)', results['phases'][phase])
+        if args.startup_runs > 0:
+            results['startup'] = measure_startup(args.startup_runs)
+            print_startup(args.startup_runs, results['startup'])
+    finally:
+        if 'app' in sys.modules: # Let the app's background writers finish before their files go
+            sys.modules['study_events'].shutdown()
+            sys.modules['logging_config'].stop()
+            sys.modules['db'].close_db_connection()
+        if not args.database and not args.seed_only: # A seeded-only database is kept for running the app against
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nResults written to {args.output}')
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+# This file contains the static asset build step
+# Copies every file in static/ to static/dist/ under a content-hashed name (style.css -> style.1a2b3c4d5e6f.css), writes gzip and brotli versions of
+# the text files and resized WebP versions of the large side images, and records it all in static/dist/manifest.json.
+# The app (static_assets.py) reads the manifest: url_for('static', ...) points at the hashed names, and those are served with a year-long immutable
+# Cache-Control and the best precompressed version the browser accepts. A changed file gets a new name, so browsers never see a stale copy.
+# Run it once per deploy, alongside the migrations:
+#   python build_static.py
+# brotli and Pillow are optional - without them the .br files or the WebP images are skipped (and the app serves gzip / the original images).
+import argparse # For the command line interface
+import gzip # For .gz versions
+import hashlib # For content hashes
+import io # For encoding WebP images in memory
+import json # For the manifest
+import os # For walking the static folder
+import shutil # For clearing old builds
+import sys # For exit codes
+from static_assets import DIST, MANIFEST # Where the app looks for the build
+
+try:
+    import brotli # For .br versions
+except ImportError:
+    brotli = None
+try:
+    from PIL import Image # For WebP versions of the side images
+except ImportError:
+    Image = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+HASH_LENGTH = 12
+COMPRESSIBLE = ('.css', '.js', '.json', '.svg', '.txt', '.ico', '.webmanifest', '.html') # Images (other than .ico) are already compressed
+MIN_COMPRESS_SIZE = 256 # Bytes - smaller files aren't worth a compressed copy
+WEBP_IMAGES = ('login-side-img.jpg', 'register-side-img.jpg') # Large images to also serve as WebP
+WEBP_WIDTHS = (640, 960, 1440) # Each image's WebP versions, by width in pixels (never wider than the original)
+WEBP_QUALITY = 80
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+def hashed_name(filename, data):
+    root, ext = os.path.splitext(filename)
+    return f'{root}.{content_hash(data)}{ext}'
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def source_files(static_dir):
+    # Every file under the static folder except earlier builds, as paths relative to it with forward slashes (as url_for gets them)
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != os.path.join(static_dir, DIST))
+        for name in sorted(files):
+            yield os.path.relpath(os.path.join(root, name), static_dir).replace(os.sep, '/')
+
+def compressed_versions(data):
+    # {'br': bytes, 'gzip': bytes} - only the encodings that actually make the file smaller
+    versions = {}
+    if brotli is not None:
+        versions['br'] = brotli.compress(data, quality=11)
+    versions['gzip'] = gzip.compress(data, compresslevel=9, mtime=0) # mtime=0 - the same input always builds the same file
+    return {encoding: body for encoding, body in versions.items() if len(body) < len(data)}
+
+def webp_versions(path):
+    # [(width, bytes)] for each of WEBP_WIDTHS narrower than the image, plus the full width if the image is narrower than the widest
+    with Image.open(path) as image:
+        image.load()
+        widths = [width for width in WEBP_WIDTHS if width < image.width]
+        if image.width < max(WEBP_WIDTHS):
+            widths.append(image.width)
+        versions = []
+        for width in widths:
+            resized = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS) if width != image.width else image
+            buffer = io.BytesIO()
+            resized.convert('RGB').save(buffer, 'WEBP', quality=WEBP_QUALITY, method=6)
+            versions.append((width, buffer.getvalue()))
+        return versions
+
+def build(static_dir=STATIC_DIR, echo=print):
+    # Rebuilds static/dist from scratch and returns the manifest
+    dist_dir = os.path.join(static_dir, DIST)
+    shutil.rmtree(dist_dir, ignore_errors=True)
+    manifest = {'files': {}, 'encodings': {}, 'webp': {}}
+    original_bytes = built_bytes = 0
+    for filename in source_files(static_dir):
+        with open(os.path.join(static_dir, filename), 'rb') as f:
+            data = f.read()
+        hashed = hashed_name(filename, data)
+        write(os.path.join(dist_dir, hashed), data)
+        manifest['files'][filename] = hashed
+        smallest = len(data)
+        if filename.lower().endswith(COMPRESSIBLE) and len(data) >= MIN_COMPRESS_SIZE:
+            versions = compressed_versions(data)
+            for encoding, body in versions.items():
+                write(os.path.join(dist_dir, f"{hashed}.{'br' if encoding == 'br' else 'gz'}"), body)
+            if versions:
+                manifest['encodings'][hashed] = sorted(versions, key=lambda encoding: len(versions[encoding])) # Smallest first
+                smallest = min(len(body) for body in versions.values())
+        if filename in WEBP_IMAGES and Image is not None:
+            root = os.path.splitext(filename)[0]
+            manifest['webp'][filename] = []
+            for width, body in webp_versions(os.path.join(static_dir, filename)):
+                webp_name = hashed_name(f'{root}-{width}w.webp', body)
+                write(os.path.join(dist_dir, webp_name), body)
+                manifest['webp'][filename].append({'width': width, 'file': webp_name})
+                smallest = min(smallest, len(body))
+        original_bytes += len(data)
+        built_bytes += smallest
+        echo(f'{filename:<45} {len(data):>9} -> {smallest:>9} bytes  {hashed}')
+    write(os.path.join(dist_dir, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    echo(f"{len(manifest['files'])} files, {original_bytes} -> {built_bytes} bytes over the wire")
+    if brotli is None:
+        echo('brotli is not installed - skipped the .br versions')
+    if Image is None:
+        echo('Pillow is not installed - skipped the WebP images')
+    return manifest
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the content-hashed, precompressed static files for KanaCard.')
+    parser.add_argument('--static', default=STATIC_DIR, help='The static folder (default: %(default)s)')
+    args = parser.parse_args(argv)
+    build(args.static)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
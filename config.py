@@ -0,0 +1,43 @@
+# This file contains the app's configuration, one class per environment
+# create_app() (in app.py) picks the class named by KANACARD_ENV - development, testing or production (the default) - unless it's given one.
+# Anything the modules' init_app() functions read (DATABASE, LOG_LEVEL, SESSION_CACHE_SIZE, ...) can be set here too; unset keys keep the module defaults.
+import os # For environment variables
+from datetime import timedelta # For session timeout
+
+class Config:
+    SECRET_KEY = os.environ.get('KANACARD_SECRET_KEY', 'placeholder_secret_key') # Set KANACARD_SECRET_KEY for deployment >:(
+    PERMANENT_SESSION_LIFETIME = timedelta(minutes=15) # Session timeout
+    SESSION_COOKIE_SECURE = True # Enforces HTTPS
+    SESSION_COOKIE_HTTPONLY = True # Prevents client-side JS from accessing session cookies
+    SESSION_COOKIE_SAMESITE = 'Strict' # Prevents CSRF attacks - cookies can only be sent to the same site that set them
+    ENFORCE_HTTPS = True # Redirect plain HTTP requests to HTTPS
+    LOG_ENV = 'production' # Default log level - see logging_config.py
+    METRICS_TOKEN = os.environ.get('KANACARD_METRICS_TOKEN') # Bearer token for a Prometheus scraper - without it /metrics is for admins only
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+    ENFORCE_HTTPS = False # Lets the app run over plain HTTP locally
+    LOG_ENV = 'development'
+
+class TestingConfig(Config):
+    # For the benchmark and scripted clients: no CSRF tokens or rate limits to work around, quiet logs
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    RATELIMIT_ENABLED = False
+    LOG_ENV = 'testing'
+
+class ProductionConfig(Config):
+    pass
+
+CONFIGS = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+}
+
+def get_config(name=None):
+    # The config class for an environment name, defaulting to KANACARD_ENV
+    name = name or os.environ.get('KANACARD_ENV', 'production')
+    if name not in CONFIGS:
+        raise ValueError(f"Unknown environment '{name}' - expected one of {', '.join(CONFIGS)}")
+    return CONFIGS[name]
@@ -0,0 +1,100 @@
+# This file contains the database connection management for the application
+# Instead of opening a new connection (and re-running the PRAGMAs) for every query, each thread keeps one tuned connection open and reuses it across requests.
+import os # For resolving the database path
+import sqlite3 # For database operations
+import threading # For per-thread connections
+from contextlib import contextmanager # For savepoints
+import logging # For logging
+
+# Default database location - absolute, so the app doesn't depend on the directory it was started from
+DEFAULT_DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database.db')
+
+# Connection settings - can be overridden through the app config (see init_app)
+settings = {
+    'DATABASE': os.path.abspath(os.environ.get('KANACARD_DATABASE', DEFAULT_DATABASE)), # Path to the SQLite database file
+    'DATABASE_BUSY_TIMEOUT': 5.0, # Seconds to wait for another writer before raising 'database is locked'
+    'DATABASE_CACHE_SIZE_KB': 16384, # Page cache per connection, in KiB
+    'DATABASE_MMAP_SIZE': 128 * 1024 * 1024, # Bytes of the database file to memory-map for reads
+    'DATABASE_STATEMENT_CACHE': 256, # Number of prepared statements kept per connection
+}
+
+_local = threading.local() # Holds this thread's connection
+_connection_factory = sqlite3.Connection # Swapped for an instrumented subclass by metrics.py
+
+def set_connection_factory(factory):
+    # Connections opened from now on (by get_db_connection() and connect()) use this sqlite3.Connection subclass
+    global _connection_factory
+    _connection_factory = factory
+
+def connect(path=None):
+    # Opens a new connection with the app's PRAGMAs applied. Used directly by scripts; the app should use get_db_connection()
+    conn = sqlite3.connect(
+        path or settings['DATABASE'],
+        timeout=settings['DATABASE_BUSY_TIMEOUT'], # Also sets SQLite's busy_timeout
+        cached_statements=settings['DATABASE_STATEMENT_CACHE'], # Prepared statement cache - repeated queries skip re-parsing
+        check_same_thread=False, # Connections are only ever used by the thread that owns them, but scripts may hand them to worker threads
+        factory=_connection_factory
+    )
+    conn.execute("PRAGMA journal_mode = WAL") # Readers don't block the writer (and vice versa)
+    conn.execute("PRAGMA synchronous = NORMAL") # Safe with WAL, and avoids an fsync on every commit
+    conn.execute("PRAGMA foreign_keys = ON") # Enable foreign key constraints - this is important for cascading deletes
+    conn.execute(f"PRAGMA cache_size = -{int(settings['DATABASE_CACHE_SIZE_KB'])}") # Negative value = size in KiB
+    conn.execute(f"PRAGMA mmap_size = {int(settings['DATABASE_MMAP_SIZE'])}")
+    conn.execute("PRAGMA temp_store = MEMORY") # Sorts and temp tables stay in memory
+    return conn
+
+def get_db_connection():
+    # Returns this thread's connection, opening it on first use. The connection stays open across requests.
+    path = settings['DATABASE']
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and (_local.pid != os.getpid() or _local.path != path): # Connection inherited from a parent process, or the database moved
+        if _local.pid == os.getpid():
+            conn.close()
+        conn = None
+    if conn is None:
+        conn = connect(path)
+        _local.conn, _local.pid, _local.path = conn, os.getpid(), path
+    return conn
+
+def close_db_connection():
+    # Closes this thread's connection, if it has one
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        if _local.pid == os.getpid():
+            conn.close()
+        _local.conn = None
+
+@contextmanager
+def savepoint(conn, name='nested'):
+    # Like 'with conn:', but never commits a transaction it didn't start: on its own it's a transaction of its own, while inside a request's open
+    # transaction the changes just become part of it - so whatever happens to that transaction (including end_request's rollback) happens to them too
+    conn.execute(f'SAVEPOINT {name}')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute(f'ROLLBACK TO {name}')
+        conn.execute(f'RELEASE {name}')
+        raise
+    conn.execute(f'RELEASE {name}')
+
+def bump_student_lists(conn, list_id):
+    # Bumps the lists_version (the student dashboard's ETag) of everyone assigned to a list. Writers that add or remove a list's cards call this once
+    # per statement or chunk - a trigger per card would update every assigned student for every card.
+    conn.execute('''
+    UPDATE students SET lists_version = lists_version + 1, lists_updated_at = CAST(strftime('%s', 'now') AS INTEGER)
+    WHERE student_id IN (SELECT student_id FROM list_students WHERE list_id = ?)
+    ''', (list_id,))
+
+def end_request(exception=None):
+    # Makes sure a request never leaves a transaction open on the shared connection - that would hold the write lock for every other worker
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid() and conn.in_transaction:
+        logging.warning('Rolling back a database transaction left open at the end of a request')
+        conn.rollback()
+
+def init_app(app):
+    # Reads connection settings from the app config and registers the end-of-request cleanup
+    for key, value in settings.items():
+        settings[key] = app.config.setdefault(key, value)
+    settings['DATABASE'] = app.config['DATABASE'] = os.path.abspath(settings['DATABASE'])
+    app.teardown_appcontext(end_request)
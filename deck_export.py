@@ -0,0 +1,140 @@
+# This file contains the deck exporter - used by the list export route and from the command line (e.g. a nightly cron dump)
+# Cards are read in fixed-size batches, each batch starting after the last (list_id, position) of the one before - a short index seek per batch
+# rather than one long-running query - and each batch is written out before the next is read. Memory use stays the same however many cards are
+# exported, and a download starts straight away.
+#   python deck_export.py --all --format jsonl --output backups/cards.jsonl
+#   python deck_export.py --list-name "JLPT N5" --format anki > jlpt_n5.txt
+# Formats (one card per row/line):
+#   csv   - question, answer, list columns with a header row. deck_import.py reads it back.
+#   jsonl - one {"question", "answer", "list"} object per line. deck_import.py reads it back.
+#   anki  - tab separated with Anki's file headers (File > Import in Anki 2.1.55+): Front, Back and Deck columns, one deck per list
+import argparse # For the command line interface
+import csv # For CSV and Anki output
+import io # For writing each batch to a string
+import json # For JSON Lines output
+import os # For writing the output file safely
+import sys # For exit codes
+import tempfile # For writing the output file safely
+from urllib.parse import quote # For non-ASCII download names
+import logging # For logging
+import db # For database connections
+
+BATCH_SIZE = 1000 # Cards read (and sent) at a time
+FORMATS = { # format -> (content type, file extension)
+    'csv': ('text/csv', '.csv'),
+    'jsonl': ('application/x-ndjson', '.jsonl'),
+    'anki': ('text/plain', '.txt'),
+}
+ANKI_HEADER = '#separator:tab\n#html:false\n#notetype:Basic\n#columns:Front\tBack\tDeck\n#deck column:3\n'
+
+def iter_batches(conn, list_id=None, batch_size=BATCH_SIZE):
+    # Yields lists of (question, answer, list_name) in list and card order - every list, or just list_id
+    last_list, last_position = (list_id, -1) if list_id is not None else (-1, -1)
+    while True:
+        if list_id is not None:
+            rows = conn.execute('''
+            SELECT flashcards.list_id, flashcards.position, flashcards.question, flashcards.answer, flashcard_lists.list_name
+            FROM flashcards JOIN flashcard_lists ON flashcard_lists.list_id = flashcards.list_id
+            WHERE flashcards.list_id = ? AND flashcards.position > ?
+            ORDER BY flashcards.position LIMIT ?
+            ''', (list_id, last_position, batch_size)).fetchall()
+        else:
+            rows = conn.execute('''
+            SELECT flashcards.list_id, flashcards.position, flashcards.question, flashcards.answer, flashcard_lists.list_name
+            FROM flashcards JOIN flashcard_lists ON flashcard_lists.list_id = flashcards.list_id
+            WHERE (flashcards.list_id, flashcards.position) > (?, ?)
+            ORDER BY flashcards.list_id, flashcards.position LIMIT ?
+            ''', (last_list, last_position, batch_size)).fetchall()
+        if not rows:
+            return
+        yield [(question, answer, list_name) for _, _, question, answer, list_name in rows]
+        if len(rows) < batch_size:
+            return
+        last_list, last_position = rows[-1][0], rows[-1][1]
+
+def format_batch(cards, fmt):
+    if fmt == 'jsonl':
+        return ''.join(json.dumps({'question': question, 'answer': answer, 'list': list_name}, ensure_ascii=False) + '\n' for question, answer, list_name in cards)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter='\t' if fmt == 'anki' else ',', lineterminator='\n') # Fields with separators, quotes or newlines are quoted
+    writer.writerows(cards)
+    return buffer.getvalue()
+
+def export_deck(conn, fmt='csv', list_id=None, batch_size=BATCH_SIZE):
+    # Yields the export as text, a batch at a time
+    if fmt == 'csv':
+        yield 'question,answer,list\n'
+    elif fmt == 'anki':
+        yield ANKI_HEADER
+    exported = 0
+    for cards in iter_batches(conn, list_id, batch_size):
+        exported += len(cards)
+        yield format_batch(cards, fmt)
+    logging.info(f"Exported {exported} cards from {f'list {list_id}' if list_id is not None else 'every list'} as {fmt}")
+
+def export_filename(fmt, list_name=None, list_id=None, ascii_only=False):
+    # A download name, e.g. 'JLPT_N5.csv', 'ひらがな.csv' or 'kanacard_all_lists.jsonl'.
+    # ascii_only gives the fallback for headers, which must be latin-1: names with kana (or anything else non-ASCII) become 'list-<id>.csv'
+    stem = ''.join(character if character.isalnum() or character in '-_' else '_' for character in list_name).strip('_') if list_name else ''
+    if ascii_only and not stem.isascii():
+        stem = f'list-{list_id}' if list_id is not None else ''
+    return (stem or 'kanacard_all_lists') + FORMATS[fmt][1]
+
+def content_disposition(fmt, list_name=None, list_id=None):
+    # Keyword arguments for headers.set('Content-Disposition', 'attachment', ...): an ASCII filename, plus the real one RFC 5987 encoded when they differ
+    filename = export_filename(fmt, list_name, list_id)
+    fallback = export_filename(fmt, list_name, list_id, ascii_only=True)
+    if filename == fallback:
+        return {'filename': filename}
+    return {'filename': fallback, 'filename*': f"UTF-8''{quote(filename, safe='')}"}
+
+def find_list(conn, list_id=None, list_name=None):
+    # Returns (list_id, list_name), or None if there's no such list
+    if list_id is not None:
+        return conn.execute('SELECT list_id, list_name FROM flashcard_lists WHERE list_id = ?', (list_id,)).fetchone()
+    return conn.execute('SELECT list_id, list_name FROM flashcard_lists WHERE list_name = ?', (list_name,)).fetchone()
+
+def write_export(conn, path, fmt, list_id=None):
+    # Writes to a temporary file next to 'path' and renames it into place, so a cron job never leaves a half-written export behind
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.export-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            for chunk in export_deck(conn, fmt, list_id):
+                f.write(chunk)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export flashcard lists as CSV, JSON Lines or an Anki import file.')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--all', action='store_true', help='Export every list')
+    group.add_argument('--list-id', type=int, help='Export the list with this id')
+    group.add_argument('--list-name', help='Export the list with this name')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='csv', help='Output format (default: %(default)s)')
+    parser.add_argument('--output', help='File to write (default: standard output)')
+    parser.add_argument('--database', default=db.settings['DATABASE'], help='Path to the SQLite database (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    conn = db.connect(args.database)
+    try:
+        list_id = None
+        if not args.all:
+            found = find_list(conn, args.list_id, args.list_name)
+            if found is None:
+                print(f'No such list: {args.list_id if args.list_id is not None else args.list_name}', file=sys.stderr)
+                return 1
+            list_id = found[0]
+        if args.output:
+            write_export(conn, args.output, args.format, list_id)
+        else:
+            for chunk in export_deck(conn, args.format, list_id):
+                sys.stdout.write(chunk)
+    finally:
+        conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+# This file contains the bulk deck importer - used by the list import route and from the command line
+# Files are read one row at a time and inserted in chunks, so memory use stays the same no matter how big the deck is.
+#   python deck_import.py jlpt_n5.csv --list-name "JLPT N5"
+# Supported formats (one card per row/item):
+#   CSV / TSV  - question, answer columns. A 'question,answer' header row is skipped.
+#   JSON Lines - one {"question": ..., "answer": ...} object (or [question, answer] pair) per line
+#   JSON       - an array of those objects/pairs
+import argparse # For the command line interface
+import csv # For CSV/TSV parsing
+import io # For wrapping binary uploads as text
+import json # For JSON parsing
+import os # For file names
+import sys # For exit codes
+import logging # For logging
+import db # For database connections
+import search # For normalising card text
+from forms import QUESTION_MAX_LENGTH, ANSWER_MAX_LENGTH # Same limits as the add list form
+
+CHUNK_SIZE = 500 # Cards per executemany/transaction - keeps each write lock short
+MAX_REPORTED_ERRORS = 50 # Only the first few row errors are kept; the rest are just counted
+FORMATS = {'.csv': 'csv', '.txt': 'tsv', '.tsv': 'tsv', '.jsonl': 'jsonl', '.json': 'json'}
+
+class ImportResult:
+    def __init__(self, list_id=None):
+        self.list_id = list_id
+        self.imported = 0 # Cards inserted
+        self.error_count = 0 # Rows rejected
+        self.errors = [] # (row, message) for the first MAX_REPORTED_ERRORS rejected rows
+
+    def add_error(self, row, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((row, message))
+
+def detect_format(filename):
+    return FORMATS.get(os.path.splitext(filename or '')[1].lower(), 'csv')
+
+def validate_card(question, answer):
+    # Returns an error message, or None if the card is valid
+    if not question:
+        return 'question is required'
+    if not answer:
+        return 'answer is required'
+    if len(question) > QUESTION_MAX_LENGTH:
+        return f'question is longer than {QUESTION_MAX_LENGTH} characters'
+    if len(answer) > ANSWER_MAX_LENGTH:
+        return f'answer is longer than {ANSWER_MAX_LENGTH} characters'
+    return None
+
+def card_from_item(item):
+    # JSON items can be {"question": ..., "answer": ...} or [question, answer]
+    if isinstance(item, dict):
+        return item.get('question'), item.get('answer')
+    if isinstance(item, list) and len(item) >= 2:
+        return item[0], item[1]
+    raise ValueError('expected an object with question and answer, or a [question, answer] pair')
+
+def iter_delimited(text, delimiter):
+    reader = csv.reader(text, delimiter=delimiter)
+    for fields in reader:
+        if not fields or not any(field.strip() for field in fields): # Skip blank lines
+            continue
+        if reader.line_num == 1 and [field.strip().lower() for field in fields[:2]] == ['question', 'answer']: # Header row
+            continue
+        if len(fields) < 2:
+            yield reader.line_num, None, 'expected a question and an answer column'
+            continue
+        yield reader.line_num, (fields[0], fields[1]), None
+
+def iter_json_lines(text):
+    for line_number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, card_from_item(json.loads(line)), None
+        except ValueError as e: # JSONDecodeError is a ValueError too
+            yield line_number, None, str(e)
+
+def iter_json_array(text, read_size=64 * 1024):
+    # Decodes a top-level JSON array one item at a time, reading the file in fixed-size blocks
+    decoder = json.JSONDecoder()
+    buffer, pos, eof, started, item_number = '', 0, False, False, 0
+    while True:
+        while pos < len(buffer) and (buffer[pos].isspace() or (started and buffer[pos] == ',')):
+            pos += 1
+        if pos >= len(buffer):
+            if eof:
+                raise ValueError('unexpected end of file - the JSON array is not closed')
+            buffer, pos = buffer[pos:] + text.read(read_size), 0
+            eof = pos >= len(buffer)
+            continue
+        if not started:
+            if buffer[pos] != '[':
+                raise ValueError('JSON decks must be an array of cards')
+            started, pos = True, pos + 1
+            continue
+        if buffer[pos] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+            if end >= len(buffer) and not eof: # Might be a value cut off at the block boundary - read more to be sure
+                raise json.JSONDecodeError('incomplete', buffer, end)
+        except json.JSONDecodeError:
+            if eof:
+                raise ValueError(f'invalid JSON after item {item_number}')
+            more = text.read(read_size)
+            eof = not more
+            buffer, pos = buffer[pos:] + more, 0
+            continue
+        item_number += 1
+        pos = end
+        try:
+            yield item_number, card_from_item(item), None
+        except ValueError as e:
+            yield item_number, None, str(e)
+        if pos > read_size: # Drop what's been decoded so the buffer doesn't grow with the file
+            buffer, pos = buffer[pos:], 0
+
+def iter_cards(stream, fmt):
+    # Yields (row, (question, answer) or None, error or None) for each row of a binary stream
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='') if not isinstance(stream, io.TextIOBase) else stream
+    if fmt == 'tsv':
+        return iter_delimited(text, '\t')
+    if fmt == 'jsonl':
+        return iter_json_lines(text)
+    if fmt == 'json':
+        return iter_json_array(text)
+    return iter_delimited(text, ',')
+
+def insert_chunk(conn, list_id, chunk):
+    with conn: # One transaction per chunk - other writers get a turn in between
+        conn.executemany('INSERT INTO flashcards (list_id, question, answer, position) VALUES (?, ?, ?, ?)', [(list_id, question, answer, position) for position, question, answer in chunk])
+        db.bump_student_lists(conn, list_id) # Nobody is assigned to a list while it's being imported, but the counts stay right if that changes
+
+def import_deck(conn, list_name, stream, fmt='csv', chunk_size=CHUNK_SIZE, on_chunk=None):
+    # Creates a new list and streams the cards from 'stream' into it. Returns an ImportResult.
+    # on_chunk(result, count) is called after each chunk is committed - import jobs use it to report progress (see jobs.py)
+    with conn:
+        list_id = conn.execute('INSERT INTO flashcard_lists (list_name) VALUES (?)', (list_name,)).lastrowid
+    result = ImportResult(list_id)
+    chunk = []
+    try:
+        for row, card, error in iter_cards(stream, fmt):
+            if card is not None:
+                question, answer = (search.normalise(str(value)).strip() if value is not None else '' for value in card)
+                error = validate_card(question, answer)
+            if error:
+                result.add_error(row, error)
+                continue
+            chunk.append((result.imported + len(chunk), question, answer)) # Positions follow the file order
+            if len(chunk) >= chunk_size:
+                insert_chunk(conn, list_id, chunk)
+                result.imported += len(chunk)
+                if on_chunk is not None:
+                    on_chunk(result, len(chunk))
+                chunk = []
+    except (ValueError, UnicodeDecodeError, csv.Error) as e: # The file itself is unreadable from this point on
+        result.add_error('file', str(e))
+    if chunk: # The valid rows read before the end (or before the file went bad)
+        insert_chunk(conn, list_id, chunk)
+        result.imported += len(chunk)
+        if on_chunk is not None:
+            on_chunk(result, len(chunk))
+    if result.imported == 0: # Don't leave an empty list behind
+        with conn:
+            conn.execute('DELETE FROM flashcard_lists WHERE list_id = ?', (list_id,))
+        result.list_id = None
+    logging.info(f"Imported {result.imported} cards into list {list_name} ({result.error_count} rows rejected)")
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Import a flashcard deck from a CSV, TSV or JSON file.')
+    parser.add_argument('file', help='Deck file to import')
+    parser.add_argument('--list-name', help='Name of the new list (default: the file name)')
+    parser.add_argument('--format', choices=sorted(set(FORMATS.values())), help='File format (default: from the file extension)')
+    parser.add_argument('--database', default=db.settings['DATABASE'], help='Path to the SQLite database (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    list_name = args.list_name or os.path.splitext(os.path.basename(args.file))[0]
+    conn = db.connect(args.database)
+    try:
+        with open(args.file, 'rb') as f:
+            result = import_deck(conn, list_name, f, args.format or detect_format(args.file))
+    finally:
+        conn.close()
+    for row, message in result.errors:
+        print(f'row {row}: {message}', file=sys.stderr)
+    if result.error_count > len(result.errors):
+        print(f'... and {result.error_count - len(result.errors)} more rejected rows', file=sys.stderr)
+    print(f"Imported {result.imported} cards into '{list_name}' ({result.error_count} rows rejected)")
+    return 0 if result.imported else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,7 +6,7 @@ import logging
 def register_error_handlers(app):
     @app.errorhandler(404)
     def page_not_found(e):
-        logging.error(f'Page not found: {request.url}')
+        logging.warning(f'Page not found: {request.url}', extra={'sample': 'not_found'}) # Sampled - crawlers and typos can produce a lot of these
         return render_template('404.html'), 404
 
     @app.errorhandler(500)
@@ -1,6 +1,7 @@
 # Description: This file contains the form classes for the login, registration, flashcard, list, and user management forms.
 
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired, FileAllowed
 from wtforms import StringField, PasswordField, SubmitField, TextAreaField, SelectField, HiddenField, FieldList, FormField
 from wtforms.validators import DataRequired, Length, Email, Regexp
 
@@ -10,35 +11,50 @@ class LoginForm(FlaskForm):
     password = PasswordField('Password', validators=[DataRequired(), Length(min=1, max=255)])
     submit = SubmitField('Login')
 
+# Password policy - shared with the roster provisioning script (roster.py)
+PASSWORD_MIN_LENGTH = 8
+PASSWORD_RULES = [
+    (r'^(?=.*[A-Z])', "Password must contain at least one uppercase letter."),
+    (r'^(?=.*[a-z])', "Password must contain at least one lowercase letter."),
+    (r'^(?=.*\d)', "Password must contain at least one number."),
+    (r'^(?=.*[@$%*?&])', "Password must contain at least one special character."),
+]
+
 # Define the registration form
 class RegisterForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired(), Length(min=1, max=255)])
     password = PasswordField('Password', 
                             validators=[
                                 DataRequired(),
-                                Length(min=8, message='Password must be at least 8 characters long'),
-                                Regexp(r'^(?=.*[A-Z])', message="Password must contain at least one uppercase letter."),
-                                Regexp(r'^(?=.*[a-z])', message="Password must contain at least one lowercase letter."),
-                                Regexp(r'^(?=.*\d)', message="Password must contain at least one number."),
-                                Regexp(r'^(?=.*[@$%*?&])', message="Password must contain at least one special character."),
-                                ]
+                                Length(min=PASSWORD_MIN_LENGTH, message=f'Password must be at least {PASSWORD_MIN_LENGTH} characters long'),
+                                ] + [Regexp(pattern, message=message) for pattern, message in PASSWORD_RULES]
                             )
     first_name = StringField('First Name', validators=[DataRequired(), Length(min=1, max=255)])
     last_name = StringField('Last Name', validators=[DataRequired(), Length(min=1, max=255)])
     email = StringField('Email', validators=[DataRequired(), Email(), Length(min=1, max=255)])
     submit = SubmitField('Register')
 
+# Flashcard length limits - shared with the bulk importer (deck_import.py)
+QUESTION_MAX_LENGTH = 255
+ANSWER_MAX_LENGTH = 500
+
 # Defining the Adding List form (Two Parts)
 # Defining the Dynamically-Added Flashcard Forms
 class FlashcardForm(FlaskForm):
-    question=StringField('Question', validators=[DataRequired(), Length(min=1, max=255)])
-    answer=StringField('Answer', validators=[DataRequired(), Length(min=1, max=500)])
+    question=StringField('Question', validators=[DataRequired(), Length(min=1, max=QUESTION_MAX_LENGTH)])
+    answer=StringField('Answer', validators=[DataRequired(), Length(min=1, max=ANSWER_MAX_LENGTH)])
 
 # Defining the List Form (the list name)
 class ListForm(FlaskForm):
     list_name = StringField('List Name', validators=[DataRequired()])
     flashcards = FieldList(FormField(FlashcardForm), min_entries=1)
 
+# Define the list import form (a whole deck from a CSV, TSV or JSON file)
+class ImportListForm(FlaskForm):
+    list_name = StringField('List Name', validators=[DataRequired(), Length(min=1, max=255)])
+    deck_file = FileField('Deck File', validators=[FileRequired(), FileAllowed(['csv', 'tsv', 'txt', 'json', 'jsonl'], 'Deck files must be CSV, TSV or JSON.')])
+    submit = SubmitField('Import List')
+
 # Define the user edit form 
 class UserEditForm(FlaskForm):
     edit_index = HiddenField('Edit Index', validators=[DataRequired()])
@@ -67,11 +83,21 @@ class AssignListForm(FlaskForm):
     listname = StringField('List Name', validators=[DataRequired(), Length(min=1, max=255)])
     submit = SubmitField('Assign List')
 
+# Define the bulk assign form (many students and/or many lists at once)
+class BulkAssignForm(FlaskForm):
+    usernames = TextAreaField('Student Usernames', validators=[DataRequired()])
+    listnames = TextAreaField('List Names', validators=[DataRequired()])
+    submit = SubmitField('Assign Lists')
+
 # Define the MFA verification form 
 class MFAVerificationForm(FlaskForm):
     verification_code = StringField('Verification Code', validators=[DataRequired(), Length(min=6, max=6)])
     submit = SubmitField('Verify')
 
+# Define the shuffle mode form - turns shuffling a list on or off
+class ShuffleForm(FlaskForm):
+    submit = SubmitField('Shuffle')
+
 # Define the Logout form 
 class LogoutForm(FlaskForm):
     submit = SubmitField('Logout')
\ No newline at end of file
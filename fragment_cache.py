@@ -0,0 +1,83 @@
+# This file contains the fragment cache for the admin tables
+# Lists and users change rarely, but the management pages re-rendered every row on every load. Rendered table bodies (and the page they came from)
+# are cached here, shared by every admin and request in the process, keyed by the table's version - triggers bump the version on any change to the
+# table (see migrate_db.py), whichever route or process made it, so a cached fragment is never stale.
+# Only the rows are cached - the forms, and their CSRF tokens, are rendered fresh on every request.
+# Memory is bounded by FRAGMENT_CACHE_MAX_BYTES, evicting the least recently used fragments first.
+import threading # For the cache lock
+from collections import OrderedDict # For the LRU cache
+
+# Settings - can be overridden through the app config (see init_app)
+settings = {
+    'FRAGMENT_CACHE_MAX_BYTES': 4 * 1024 * 1024, # Rendered HTML kept per process
+}
+
+_lock = threading.Lock()
+_cache = OrderedDict() # (name, version, key) -> (value, size)
+_latest = {} # name -> newest version seen - older fragments are dropped as soon as a newer version turns up
+_size = 0
+stats = {
+    'hits': 0,
+    'misses': 0,
+    'evictions': 0, # Fragments pushed out to stay under FRAGMENT_CACHE_MAX_BYTES
+    'stale': 0, # Fragments dropped because their table changed
+}
+
+def table_version(conn, name):
+    row = conn.execute('SELECT version FROM table_versions WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else 0
+
+def _remove(cache_key):
+    global _size
+    _size -= _cache.pop(cache_key)[1]
+
+def get(name, version, key):
+    # Returns the cached value, or None
+    with _lock:
+        entry = _cache.get((name, version, key))
+        if entry is None:
+            stats['misses'] += 1
+            return None
+        _cache.move_to_end((name, version, key))
+        stats['hits'] += 1
+        return entry[0]
+
+def put(name, version, key, value, size):
+    # size is roughly how much memory value takes - the length of the rendered HTML
+    global _size
+    if size > settings['FRAGMENT_CACHE_MAX_BYTES']:
+        return
+    with _lock:
+        if version < _latest.get(name, version): # Rendered from data that has already changed
+            return
+        if version > _latest.get(name, version):
+            for cache_key in [cache_key for cache_key in _cache if cache_key[0] == name and cache_key[1] < version]:
+                _remove(cache_key)
+                stats['stale'] += 1
+        _latest[name] = version
+        if (name, version, key) in _cache:
+            _remove((name, version, key))
+        _cache[(name, version, key)] = (value, size)
+        _size += size
+        while _size > settings['FRAGMENT_CACHE_MAX_BYTES']:
+            _remove(next(iter(_cache)))
+            stats['evictions'] += 1
+
+def clear():
+    global _size
+    with _lock:
+        _cache.clear()
+        _latest.clear()
+        _size = 0
+
+def get_stats():
+    with _lock:
+        counters = dict(stats)
+        counters['entries'] = len(_cache)
+        counters['bytes'] = _size
+    return counters
+
+def init_app(app):
+    # Reads the cache settings from the app config
+    for key, value in settings.items():
+        settings[key] = app.config.setdefault(key, value)
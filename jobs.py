@@ -0,0 +1,422 @@
+# This file contains the background job runner - long admin operations run by worker threads instead of inside a request
+# Deleting a big list in one statement cascades to every card, review and assignment in a single transaction, holding SQLite's write lock for seconds
+# while every student waits. Jobs do the same work in chunks - one short transaction each, with a pause in between so other writers get the lock.
+# Jobs are rows in the jobs table, so they survive restarts and any worker process can run them: submit() queues one, a worker thread claims it,
+# records its progress after every chunk and stops between chunks if it has been cancelled. The admin pages poll /admin_dashboard/jobs for progress.
+# Job kinds:
+#   delete_list - a list with its cards, reviews and assignments
+#   delete_user - a user with their reviews, study events and assignments
+#   import_deck - a deck file uploaded to the import route (see deck_import.py)
+import atexit # For stopping the workers on shutdown
+import json # For job parameters
+import os # For detecting forked workers, and removing uploads
+import secrets # For worker process tokens
+import shutil # For saving uploads
+import socket # For naming the process that owns a job
+import sqlite3 # For database errors
+import tempfile # For the upload folder
+import threading # For the worker threads
+import time # For timestamps and pauses
+import logging # For logging
+import db # For database connections
+import deck_import # For import jobs
+
+# Settings - can be overridden through the app config (see init_app)
+settings = {
+    'JOBS_WORKERS': 2, # Worker threads per process - SQLite has one writer, so more rarely helps
+    'JOBS_CHUNK_SIZE': 500, # Most rows deleted or inserted per transaction
+    'JOBS_CHUNK_PAUSE': 0.05, # Seconds between chunks - lets requests waiting for the write lock go first
+    'JOBS_POLL_INTERVAL': 2.0, # Seconds between checks for queued jobs (submit() wakes this process's workers straight away)
+    'JOBS_HEARTBEAT_INTERVAL': 10, # Seconds between heartbeats for the jobs a process is running - sent from a timer thread, so a slow chunk still sends them
+    'JOBS_STALE_AFTER': 60, # Seconds without a heartbeat before a running job is taken to belong to a process that died
+    'JOBS_UPLOAD_DIR': None, # Where uploaded decks wait for their import job - defaults to a folder in the system temp directory
+}
+
+_lock = threading.Lock()
+_threads = []
+_pid = None
+_owner = None # 'host:pid:token' - written on the jobs this process claims. The token tells a restarted process apart from one that reused the pid.
+_wake = threading.Event()
+_stopping = threading.Event()
+_exit_hook = False # Whether shutdown() is registered to run at exit - once per process, however many apps are created
+stats = {
+    'submitted': 0, # Jobs queued by this process
+    'done': 0, # Jobs this process finished
+    'failed': 0,
+    'cancelled': 0,
+    'requeued': 0, # Jobs put back in the queue - interrupted by a shutdown, or found abandoned by a dead process
+    'chunks': 0, # Transactions written by jobs
+}
+
+class JobCancelled(Exception):
+    pass
+
+class JobInterrupted(Exception):
+    # The process is shutting down - the job goes back in the queue (or fails, if it can't be resumed)
+    pass
+
+class JobLost(Exception):
+    # The job no longer belongs to this process (it was taken to be abandoned and handed on) - stop without touching it
+    pass
+
+class Job:
+    # A running job, as seen by its kind's function
+    def __init__(self, conn, job_id, kind, params, owner):
+        self.conn = conn
+        self.job_id = job_id
+        self.kind = kind
+        self.params = params
+        self.owner = owner
+        self.progress = 0
+
+    def set_total(self, total):
+        with self.conn:
+            if not self.conn.execute("UPDATE jobs SET total = ?, progress = 0 WHERE job_id = ? AND owner = ? AND status = 'running'", (total, self.job_id, self.owner)).rowcount:
+                raise JobLost()
+        self.progress = 0
+
+    def advance(self, amount):
+        # Called after each chunk is committed: records progress, gives other writers a turn, and stops the job if it's been cancelled
+        self.progress += amount
+        _record('chunks')
+        with self.conn:
+            row = self.conn.execute("UPDATE jobs SET progress = ? WHERE job_id = ? AND owner = ? AND status = 'running' RETURNING cancel_requested",
+                                    (self.progress, self.job_id, self.owner)).fetchone()
+        if row is None:
+            raise JobLost()
+        if row[0]:
+            raise JobCancelled()
+        if _stopping.is_set():
+            raise JobInterrupted()
+        time.sleep(settings['JOBS_CHUNK_PAUSE'])
+
+## JOB KINDS ##
+
+def delete_list_chunks(conn, list_id, chunk_size):
+    # Deletes a list a chunk at a time, yielding the rows deleted by each transaction.
+    # Cards go first, while the list's students are still assigned: each card's reviews cascade (a row for each student who has graded it), and each
+    # chunk bumps the assigned students' lists_version once. Unassigning the students first would be worse - each list_students delete removes that
+    # student's reviews for the whole list in one go.
+    while True:
+        with conn:
+            deleted = conn.execute('DELETE FROM flashcards WHERE card_id IN (SELECT card_id FROM flashcards WHERE list_id = ? ORDER BY position LIMIT ?)',
+                                   (list_id, chunk_size)).rowcount
+            if deleted:
+                db.bump_student_lists(conn, list_id)
+        if not deleted:
+            break
+        yield deleted
+    while True:
+        with conn:
+            deleted = conn.execute('DELETE FROM list_students WHERE rowid IN (SELECT rowid FROM list_students WHERE list_id = ? LIMIT ?)', (list_id, chunk_size)).rowcount
+        if not deleted:
+            break
+        yield deleted
+    with conn:
+        conn.execute('DELETE FROM flashcard_lists WHERE list_id = ?', (list_id,)) # Nothing left to cascade to
+    yield 1
+
+def delete_list(job, list_id):
+    conn = job.conn
+    list_name = conn.execute('SELECT list_name FROM flashcard_lists WHERE list_id = ?', (list_id,)).fetchone()
+    if list_name is None:
+        return f'List {list_id} was already deleted'
+    cards, students = conn.execute('''
+    SELECT (SELECT COUNT(*) FROM flashcards WHERE list_id = ?), (SELECT COUNT(*) FROM list_students WHERE list_id = ?)
+    ''', (list_id, list_id)).fetchone()
+    job.set_total(cards + students + 1) # ...and the list itself
+    for deleted in delete_list_chunks(conn, list_id, settings['JOBS_CHUNK_SIZE']):
+        job.advance(deleted)
+    return f'Deleted list {list_name[0]} ({cards} cards)'
+
+def delete_user_chunks(conn, user_id, chunk_size):
+    # Deletes a user a chunk at a time, yielding the rows deleted by each transaction: their reviews and study history, then their assignments
+    # (which have no reviews left to remove), then the user - cascading to the student record and any sessions
+    student = conn.execute('SELECT student_id FROM students WHERE user_id = ?', (user_id,)).fetchone()
+    steps = [('DELETE FROM study_events WHERE event_id IN (SELECT event_id FROM study_events WHERE user_id = ? LIMIT ?)', user_id)]
+    if student is not None:
+        steps[:0] = [('DELETE FROM card_reviews WHERE rowid IN (SELECT rowid FROM card_reviews WHERE student_id = ? LIMIT ?)', student[0])]
+        steps.append(('DELETE FROM list_students WHERE rowid IN (SELECT rowid FROM list_students WHERE student_id = ? LIMIT ?)', student[0]))
+    for sql, key in steps:
+        while True:
+            with conn:
+                deleted = conn.execute(sql, (key, chunk_size)).rowcount
+            if not deleted:
+                break
+            yield deleted
+    with conn:
+        conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
+    yield 1
+
+def delete_user(job, user_id):
+    conn = job.conn
+    username = conn.execute('SELECT username FROM users WHERE id = ?', (user_id,)).fetchone()
+    if username is None:
+        return f'User {user_id} was already deleted'
+    job.set_total(conn.execute('''
+    SELECT (SELECT COUNT(*) FROM study_events WHERE user_id = :user_id)
+         + (SELECT COUNT(*) FROM card_reviews JOIN students ON students.student_id = card_reviews.student_id WHERE students.user_id = :user_id)
+         + (SELECT COUNT(*) FROM list_students JOIN students ON students.student_id = list_students.student_id WHERE students.user_id = :user_id)
+         + 1 -- The user row itself
+    ''', {'user_id': user_id}).fetchone()[0])
+    for deleted in delete_user_chunks(conn, user_id, settings['JOBS_CHUNK_SIZE']):
+        job.advance(deleted)
+    return f'Deleted user {username[0]}'
+
+def import_deck(job, path, list_name, fmt):
+    # Imports an uploaded deck. A cancelled import takes the cards it already added with it. The upload is removed by remove_upload() once the job is over.
+    imported = {}
+    def on_chunk(result, count):
+        imported['list_id'] = result.list_id
+        job.advance(count)
+    try:
+        with open(path, 'rb') as f:
+            result = deck_import.import_deck(job.conn, list_name, f, fmt, settings['JOBS_CHUNK_SIZE'], on_chunk=on_chunk)
+    except JobCancelled:
+        if 'list_id' in imported:
+            for _ in delete_list_chunks(job.conn, imported['list_id'], settings['JOBS_CHUNK_SIZE']):
+                time.sleep(settings['JOBS_CHUNK_PAUSE'])
+        raise
+    if not result.imported:
+        raise ValueError(f'No cards were imported - the list was not created ({result.error_count} rows rejected)')
+    skipped = ''.join(f'; row {row}: {message}' for row, message in result.errors[:5])
+    return f'Imported {result.imported} cards into {list_name} ({result.error_count} rows rejected{skipped})'
+
+def remove_upload(path, **params):
+    # Cleanup for import jobs, however they end - done, failed, cancelled (even before they start) or abandoned
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+JOB_KINDS = { # kind -> (function, whether an interrupted job can simply be run again, cleanup once it's over or None)
+    'delete_list': (delete_list, True, None),
+    'delete_user': (delete_user, True, None),
+    'import_deck': (import_deck, False, remove_upload), # Running it again would import the cards twice
+}
+
+## QUEUE ##
+
+def _record(key, amount=1):
+    with _lock:
+        stats[key] += amount
+
+def _cleanup(kind, params):
+    cleanup = JOB_KINDS.get(kind, (None, False, None))[2]
+    if cleanup is not None:
+        try:
+            cleanup(**json.loads(params))
+        except (OSError, TypeError, ValueError) as e:
+            logging.warning(f'Cleanup for a {kind} job failed: {e}')
+
+def _start_workers():
+    # Starts the workers (and their heartbeat) on first use - and again in a forked worker process, since threads don't survive a fork
+    global _threads, _pid, _owner
+    if _pid == os.getpid():
+        return
+    with _lock:
+        if _pid == os.getpid():
+            return
+        _stopping.clear()
+        _owner = f'{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}'
+        _threads = [threading.Thread(target=_run, name=f'job-worker-{number}', daemon=True) for number in range(settings['JOBS_WORKERS'])]
+        if _threads:
+            _threads.append(threading.Thread(target=_heartbeat, name='job-heartbeat', daemon=True))
+        for thread in _threads:
+            thread.start()
+        _pid = os.getpid()
+
+def submit(kind, params, description, created_by=None, conn=None):
+    # Queues a job and returns its id. The job runs on this process's workers unless another process gets to it first.
+    if kind not in JOB_KINDS:
+        raise ValueError(f'Unknown job kind: {kind}')
+    conn = conn or db.get_db_connection()
+    with conn:
+        job_id = conn.execute('INSERT INTO jobs (kind, params, description, created_by, created_at) VALUES (?, ?, ?, ?, ?)',
+                              (kind, json.dumps(params), description, created_by, time.time())).lastrowid
+    _record('submitted')
+    logging.info(f'Queued job {job_id}: {description}')
+    _start_workers()
+    _wake.set()
+    return job_id
+
+def save_upload(file_storage):
+    # Copies an uploaded file somewhere it outlives the request, for an import job to read. Returns the path.
+    directory = settings['JOBS_UPLOAD_DIR'] or os.path.join(tempfile.gettempdir(), 'kanacard-uploads')
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, prefix='import-')
+    with os.fdopen(fd, 'wb') as f:
+        shutil.copyfileobj(file_storage.stream, f)
+    return path
+
+def cancel(job_id, conn=None):
+    # Asks a job to stop. A queued job is cancelled straight away; a running one stops after its current chunk. Returns False if it had already finished.
+    conn = conn or db.get_db_connection()
+    now = time.time()
+    with conn:
+        queued = conn.execute("UPDATE jobs SET status = 'cancelled', message = 'Cancelled', finished_at = ? WHERE job_id = ? AND status = 'queued' RETURNING kind, params",
+                              (now, job_id)).fetchone()
+        if queued is None:
+            return conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ? AND status = 'running'", (job_id,)).rowcount > 0
+    _record('cancelled')
+    _cleanup(*queued)
+    return True
+
+def _job_dict(row):
+    job_id, kind, description, status, progress, total, message, created_at, started_at, finished_at, cancel_requested = row
+    return {
+        'job_id': job_id, 'kind': kind, 'description': description, 'status': status, 'progress': progress, 'total': total,
+        'percent': 100 if status == 'done' else (min(100, round(100 * progress / total)) if total else None),
+        'message': message, 'created_at': created_at, 'started_at': started_at, 'finished_at': finished_at, 'cancel_requested': bool(cancel_requested),
+    }
+
+JOB_COLUMNS = 'job_id, kind, description, status, progress, total, message, created_at, started_at, finished_at, cancel_requested'
+
+def get_job(job_id, conn=None):
+    conn = conn or db.get_db_connection()
+    row = conn.execute(f'SELECT {JOB_COLUMNS} FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+    return _job_dict(row) if row else None
+
+def list_jobs(active_only=False, limit=20, conn=None):
+    # The most recent jobs, newest first
+    conn = conn or db.get_db_connection()
+    if active_only:
+        rows = conn.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE status IN ('queued', 'running') ORDER BY job_id DESC LIMIT ?", (limit,)).fetchall()
+    else:
+        rows = conn.execute(f'SELECT {JOB_COLUMNS} FROM jobs ORDER BY job_id DESC LIMIT ?', (limit,)).fetchall()
+    return [_job_dict(row) for row in rows]
+
+## WORKERS ##
+
+def _heartbeat():
+    # Marks this process's running jobs as alive every few seconds, from its own thread - so a job stuck in a long chunk (waiting for the write lock,
+    # a big import batch) isn't mistaken for an abandoned one. Only a process that has stopped (or stopped running Python) goes quiet.
+    conn = db.connect()
+    try:
+        while not _stopping.wait(settings['JOBS_HEARTBEAT_INTERVAL']):
+            try:
+                with conn:
+                    conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND status = 'running'", (time.time(), _owner))
+            except sqlite3.Error as e: # Try again next time - there's plenty of slack before a job counts as stale
+                logging.warning(f'Job heartbeat failed: {e}')
+    finally:
+        conn.close()
+
+def _recover_stale(conn):
+    # Jobs whose owner has stopped sending heartbeats - the process died: deletes go back in the queue (they pick up where they stopped), imports fail
+    stale_before = time.time() - settings['JOBS_STALE_AFTER']
+    stale = conn.execute("SELECT job_id, kind, params, owner FROM jobs WHERE status = 'running' AND heartbeat_at < ? AND owner IS NOT ?", (stale_before, _owner)).fetchall()
+    for job_id, kind, params, owner in stale:
+        _requeue(conn, job_id, kind, params, owner, f'Abandoned by a stopped worker ({owner})', stale_before)
+
+def _requeue(conn, job_id, kind, params, owner, reason, stale_before=None):
+    # Puts a running job back in the queue, or fails it if it can't be resumed. Only if 'owner' still has it - and, for abandoned jobs, has still
+    # not sent a heartbeat since stale_before - so a job is never handed on while its owner is alive.
+    resumable = JOB_KINDS.get(kind, (None, False, None))[1]
+    condition = "job_id = ? AND status = 'running' AND owner IS ?" + (' AND heartbeat_at < ?' if stale_before is not None else '')
+    arguments = (job_id, owner) + ((stale_before,) if stale_before is not None else ())
+    with conn:
+        if resumable:
+            changed = conn.execute(f"UPDATE jobs SET status = 'queued', owner = NULL, progress = 0, heartbeat_at = NULL WHERE {condition}", arguments).rowcount
+        else:
+            changed = conn.execute(f"UPDATE jobs SET status = 'failed', message = ?, finished_at = ? WHERE {condition}",
+                                   (f'{reason} - any cards imported so far are in the list', time.time()) + arguments).rowcount
+    if changed:
+        _record('requeued' if resumable else 'failed')
+        logging.warning(f"Job {job_id} ({kind}): {reason} - {'queued again' if resumable else 'failed'}")
+        if not resumable:
+            _cleanup(kind, params)
+
+def _claim(conn):
+    # Takes the oldest queued job, or returns None. Checks with a read first, so idle workers don't take the write lock every poll.
+    if conn.execute("SELECT job_id FROM jobs WHERE status = 'queued' ORDER BY job_id LIMIT 1").fetchone() is None:
+        return None
+    now = time.time()
+    with conn:
+        return conn.execute('''
+        UPDATE jobs SET status = 'running', owner = ?, started_at = ?, heartbeat_at = ?
+        WHERE job_id = (SELECT job_id FROM jobs WHERE status = 'queued' ORDER BY job_id LIMIT 1)
+        RETURNING job_id, kind, params
+        ''', (_owner, now, now)).fetchone() # Another worker may have got there first - then there's nothing to return
+
+def _finish(conn, job, status, message):
+    with conn:
+        finished = conn.execute("UPDATE jobs SET status = ?, message = ?, finished_at = ? WHERE job_id = ? AND owner = ? AND status = 'running'",
+                                (status, message, time.time(), job.job_id, job.owner)).rowcount
+    if not finished: # Handed on while this worker was finishing - the new owner will record the outcome
+        raise JobLost()
+    _record(status)
+    _cleanup(job.kind, json.dumps(job.params))
+
+def _execute(conn, job_id, kind, params):
+    job = Job(conn, job_id, kind, json.loads(params), _owner)
+    function = JOB_KINDS[kind][0]
+    logging.info(f'Job {job_id} ({kind}) started')
+    try:
+        try:
+            message = function(job, **job.params)
+        except JobCancelled:
+            _finish(conn, job, 'cancelled', 'Cancelled')
+            logging.info(f'Job {job_id} ({kind}) cancelled after {job.progress} rows')
+        except JobInterrupted:
+            _requeue(conn, job_id, kind, params, job.owner, 'Interrupted by a shutdown')
+        except JobLost:
+            raise
+        except Exception as e: # The job failed, not the worker - record it and carry on
+            _finish(conn, job, 'failed', str(e))
+            logging.error(f'Job {job_id} ({kind}) failed: {e}')
+        else:
+            _finish(conn, job, 'done', message)
+            logging.info(f'Job {job_id} ({kind}) finished: {message}')
+    except JobLost:
+        logging.warning(f'Job {job_id} ({kind}) was handed on to another worker - this one has stopped running it')
+
+def _run():
+    # A worker thread: claims queued jobs one at a time, and now and then looks for jobs abandoned by a dead process
+    conn = db.connect()
+    next_recovery = 0
+    try:
+        while not _stopping.is_set():
+            try:
+                if time.monotonic() >= next_recovery:
+                    _recover_stale(conn)
+                    next_recovery = time.monotonic() + settings['JOBS_STALE_AFTER']
+                claimed = _claim(conn)
+                if claimed is not None:
+                    _execute(conn, *claimed)
+                    continue
+            except sqlite3.Error as e: # e.g. the database is locked - try again next poll
+                logging.warning(f'Job worker error: {e}')
+            _wake.wait(settings['JOBS_POLL_INTERVAL'])
+            _wake.clear()
+    finally:
+        conn.close()
+
+def shutdown():
+    # Stops the workers: running jobs stop after their current chunk and go back in the queue for the next process to pick up
+    global _threads, _pid
+    if not _threads or _pid != os.getpid():
+        return
+    _stopping.set()
+    _wake.set()
+    for thread in _threads:
+        thread.join(timeout=db.settings['DATABASE_BUSY_TIMEOUT'] + settings['JOBS_CHUNK_PAUSE'])
+    with _lock:
+        _threads, _pid = [], None
+
+def get_stats():
+    with _lock:
+        counters = dict(stats)
+    counters['workers'] = sum(thread.is_alive() and thread.name.startswith('job-worker') for thread in _threads) if _pid == os.getpid() else 0
+    return counters
+
+def init_app(app):
+    # Reads the job settings from the app config. The workers start with the first request each process serves (not here - with gunicorn --preload
+    # the app is built before the fork), so jobs queued before a restart are picked up without waiting for a new one.
+    for key, value in settings.items():
+        settings[key] = app.config.setdefault(key, value)
+    app.before_request(_start_workers)
+    global _exit_hook
+    if not _exit_hook:
+        atexit.register(shutdown)
+        _exit_hook = True
@@ -0,0 +1,152 @@
+# This file contains the logging setup for the application
+# Log calls on the request thread only put the record on an in-memory queue (QueueHandler). A background listener thread formats the records as
+# JSON lines and writes them to a rotating log file, so requests never wait on disk writes.
+# Every record logged during a request carries the request's id, and each request ends with one access record (method, path, status, latency, queries).
+# Noisy events (card views, 404s) are sampled: log calls tag them with extra={'sample': '<name>'} and only 1 in LOG_SAMPLE_EVERY[name] is kept.
+import atexit # For flushing the log queue on shutdown
+import itertools # For sampling counters
+import json # For structured log records
+import logging # For logging
+import logging.handlers # For the queue handler/listener and rotating files
+import os # For the log file path and forked workers
+import queue # For the log queue
+import threading # For the stats lock
+import time # For request latency
+import uuid # For request ids
+from flask import g, request, has_request_context # For request ids and access records
+
+DEFAULT_LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.log')
+LOG_LEVELS = {'development': 'DEBUG', 'testing': 'WARNING', 'production': 'INFO'} # Default level per environment (KANACARD_ENV)
+
+# Settings - can be overridden through the app config (see init_app)
+settings = {
+    'LOG_ENV': os.environ.get('KANACARD_ENV', 'production'),
+    'LOG_LEVEL': None, # Overrides the environment's level, e.g. 'DEBUG'
+    'LOG_FILE': os.environ.get('KANACARD_LOG_FILE', DEFAULT_LOG_FILE),
+    'LOG_ROTATION': 'size', # 'size' (rotate at LOG_MAX_BYTES), or a TimedRotatingFileHandler 'when', e.g. 'midnight'
+    'LOG_MAX_BYTES': 10 * 1024 * 1024,
+    'LOG_BACKUP_COUNT': 5, # Rotated files kept
+    'LOG_QUEUE_SIZE': 10000, # Records waiting to be written before new ones are dropped
+    'LOG_SAMPLE_EVERY': {'card_view': 10, 'not_found': 10}, # Keep 1 in N of these events
+}
+
+_lock = threading.Lock()
+stats = {'dropped': 0} # Records dropped because the queue was full
+_listener = None
+_handler = None
+_process_hooks = False # Whether the exit and fork hooks are registered - once per process, however many apps are created
+
+class JSONFormatter(logging.Formatter):
+    # One JSON object per line
+    FIELDS = ('request_id', 'method', 'path', 'status', 'latency_ms', 'queries', 'query_ms', 'sampled_every')
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class RequestIdFilter(logging.Filter):
+    # Tags records with the id of the request they were logged in (runs on the request thread, before the record is queued)
+    def filter(self, record):
+        if not hasattr(record, 'request_id') and has_request_context():
+            record.request_id = g.get('request_id')
+        return True
+
+class SamplingFilter(logging.Filter):
+    # Keeps 1 in N records for each sampled event name, and marks the ones kept so counts can be scaled back up
+    def __init__(self, sample_every):
+        super().__init__()
+        self.sample_every = sample_every
+        self.counters = {name: itertools.count() for name in sample_every}
+
+    def filter(self, record):
+        name = getattr(record, 'sample', None)
+        every = self.sample_every.get(name, 1)
+        if every <= 1:
+            return True
+        record.sampled_every = every
+        return next(self.counters[name]) % every == 0
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # A full queue drops the record (and counts it) rather than blocking the request or printing an error per record
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with _lock:
+                stats['dropped'] += 1
+
+def file_handler():
+    if settings['LOG_ROTATION'] == 'size':
+        handler = logging.handlers.RotatingFileHandler(settings['LOG_FILE'], maxBytes=settings['LOG_MAX_BYTES'], backupCount=settings['LOG_BACKUP_COUNT'], encoding='utf-8')
+    else:
+        handler = logging.handlers.TimedRotatingFileHandler(settings['LOG_FILE'], when=settings['LOG_ROTATION'], backupCount=settings['LOG_BACKUP_COUNT'], encoding='utf-8')
+    handler.setFormatter(JSONFormatter())
+    return handler
+
+def _start_listener():
+    # A fresh queue and listener thread - also used in forked workers, since the parent's listener thread doesn't survive the fork
+    global _listener
+    _handler.queue = queue.Queue(maxsize=settings['LOG_QUEUE_SIZE'])
+    _listener = logging.handlers.QueueListener(_handler.queue, file_handler(), respect_handler_level=True)
+    _listener.start()
+
+def stop():
+    # Writes out everything still queued and stops the listener thread
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def configure():
+    # Replaces the root logger's handlers with the queue handler. Safe to call more than once.
+    global _handler
+    root = logging.getLogger()
+    level = settings['LOG_LEVEL'] or LOG_LEVELS.get(settings['LOG_ENV'], 'INFO')
+    root.setLevel(level)
+    stop()
+    if _handler is not None:
+        root.removeHandler(_handler)
+    _handler = DroppingQueueHandler(queue.Queue(maxsize=settings['LOG_QUEUE_SIZE']))
+    _handler.addFilter(RequestIdFilter())
+    _handler.addFilter(SamplingFilter(settings['LOG_SAMPLE_EVERY']))
+    root.addHandler(_handler)
+    _start_listener()
+
+def start_request():
+    g.request_id = request.headers.get('X-Request-ID', '')[:64] or uuid.uuid4().hex[:16] # Keep a proxy's id if it sent one
+    g.request_start = time.perf_counter()
+
+def end_request(response):
+    latency_ms = round((time.perf_counter() - g.get('request_start', time.perf_counter())) * 1000, 2)
+    logging.log(
+        logging.DEBUG if request.endpoint == 'static' else logging.INFO, # Static files are only worth logging when debugging
+        f'{request.method} {request.path} {response.status_code}',
+        extra={'method': request.method, 'path': request.path, 'status': response.status_code, 'latency_ms': latency_ms,
+               'queries': g.get('query_count'), 'query_ms': round(g.get('query_seconds', 0.0) * 1000, 2) if 'query_seconds' in g else None}, # Query totals come from metrics.py
+    )
+    response.headers['X-Request-ID'] = g.get('request_id', '')
+    return response
+
+def init_app(app):
+    # Reads the logging settings from the app config, starts the listener and registers the request hooks
+    for key, value in settings.items():
+        settings[key] = app.config.setdefault(key, value)
+    configure()
+    app.before_request(start_request)
+    app.after_request(end_request)
+    global _process_hooks
+    if not _process_hooks: # os.register_at_fork has no way to unregister, so repeated create_app() calls would pile up listeners in every child
+        atexit.register(stop)
+        os.register_at_fork(after_in_child=lambda: _start_listener() if _listener is not None else None)
+        _process_hooks = True
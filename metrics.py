@@ -0,0 +1,157 @@
+# This file contains the app's instrumentation - request latency, status codes and SQL query counts/time, served as Prometheus text at /metrics
+# Queries are counted by an instrumented sqlite3 connection class (installed into db.py), so every query made through get_db_connection() is timed
+# and added to the current request's totals. Queries slower than METRICS_SLOW_QUERY_SECONDS are logged with their SQL.
+import hmac # For checking the scrape token
+import sqlite3 # For the instrumented connection
+import threading # For the metrics lock
+import time # For timing
+import logging # For slow query logging
+from flask import g, request, has_app_context, has_request_context # For per-request totals
+import db # For installing the instrumented connection
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # Seconds
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+# Settings - can be overridden through the app config (see init_app)
+settings = {
+    'METRICS_SLOW_QUERY_SECONDS': 0.1, # Queries slower than this are logged with their SQL
+    'METRICS_TOKEN': None, # Lets a scraper in with 'Authorization: Bearer <token>' - otherwise /metrics is for logged in admins only
+    'METRICS_ALLOWED_IPS': (), # Scraper addresses let in without the token. Loopback isn't trusted by default - behind a proxy every request comes from it.
+}
+
+_lock = threading.Lock()
+
+class Histogram:
+    # A Prometheus histogram, split by one label
+    def __init__(self, name, help_text, label, buckets):
+        self.name, self.help_text, self.label, self.buckets = name, help_text, label, buckets
+        self.series = {} # label value -> [bucket counts..., sum, count]
+
+    def observe(self, label_value, value):
+        with _lock:
+            series = self.series.setdefault(label_value, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with _lock:
+            series = {key: list(value) for key, value in self.series.items()}
+        for label_value, counts in sorted(series.items()):
+            label = f'{self.label}="{escape_label(label_value)}"'
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {counts[-1]}')
+            lines.append(f'{self.name}_sum{{{label}}} {counts[-2]}')
+            lines.append(f'{self.name}_count{{{label}}} {counts[-1]}')
+        return lines
+
+class Counter:
+    # A Prometheus counter, split by a tuple of labels
+    def __init__(self, name, help_text, labels):
+        self.name, self.help_text, self.labels = name, help_text, labels
+        self.values = {}
+
+    def inc(self, label_values, amount=1):
+        with _lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with _lock:
+            values = dict(self.values)
+        for label_values, value in sorted(values.items()):
+            labels = ','.join(f'{label}="{escape_label(value_)}"' for label, value_ in zip(self.labels, label_values))
+            lines.append(f'{self.name}{{{labels}}} {value}')
+        return lines
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+request_latency = Histogram('kanacard_request_seconds', 'Request latency by endpoint', 'endpoint', LATENCY_BUCKETS)
+request_queries = Histogram('kanacard_request_queries', 'SQL queries per request by endpoint', 'endpoint', QUERY_COUNT_BUCKETS)
+request_query_time = Histogram('kanacard_request_query_seconds', 'Time spent in SQL queries per request by endpoint', 'endpoint', LATENCY_BUCKETS)
+responses = Counter('kanacard_responses_total', 'Responses by endpoint and status code', ('endpoint', 'status'))
+slow_queries = Counter('kanacard_slow_queries_total', 'Queries slower than METRICS_SLOW_QUERY_SECONDS, by endpoint', ('endpoint',))
+
+## QUERY INSTRUMENTATION ##
+
+def record_query(sql, seconds):
+    # Adds a query to the current request's totals (queries outside a request, e.g. from background threads, are only checked for slowness)
+    if has_app_context():
+        g.query_count = g.get('query_count', 0) + 1
+        g.query_seconds = g.get('query_seconds', 0.0) + seconds
+    if seconds >= settings['METRICS_SLOW_QUERY_SECONDS']:
+        endpoint = request.endpoint if has_request_context() else None
+        slow_queries.inc((endpoint or 'none',))
+        logging.warning(f"Slow query ({seconds * 1000:.1f} ms) in {endpoint or 'background'}: {' '.join(sql.split())}")
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+class InstrumentedConnection(sqlite3.Connection):
+    # conn.execute() doesn't go through Cursor.execute, so both need wrapping
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+## REQUEST HOOKS ##
+
+def start_request():
+    g.metrics_start = time.perf_counter()
+    g.query_count, g.query_seconds = 0, 0.0
+
+def end_request(response):
+    endpoint = request.endpoint or 'unmatched' # Endpoint names, not paths - one series per route however many ids are in the URLs
+    request_latency.observe(endpoint, time.perf_counter() - g.get('metrics_start', time.perf_counter()))
+    request_queries.observe(endpoint, g.get('query_count', 0))
+    request_query_time.observe(endpoint, g.get('query_seconds', 0.0))
+    responses.inc((endpoint, str(response.status_code)))
+    return response
+
+def render(sources=None):
+    # Prometheus text exposition. sources maps a name prefix to a function returning a dict of numbers, e.g. {'password': password_hashing.get_stats}
+    lines = []
+    for metric in (request_latency, request_queries, request_query_time, responses, slow_queries):
+        lines += metric.render()
+    for prefix, get_stats in (sources or {}).items():
+        for key, value in sorted(get_stats().items()):
+            name = f'kanacard_{prefix}_{key}'
+            lines += [f'# TYPE {name} gauge', f'{name} {value}']
+    return '\n'.join(lines) + '\n'
+
+def scrape_allowed():
+    # Whether the current request is from a configured scraper - by token, or by an address on the allowlist
+    token = settings['METRICS_TOKEN']
+    authorization = request.headers.get('Authorization', '')
+    if token and authorization.startswith('Bearer ') and hmac.compare_digest(authorization[len('Bearer '):].encode(), token.encode()):
+        return True
+    return request.remote_addr in settings['METRICS_ALLOWED_IPS']
+
+def init_app(app):
+    # Reads the metrics settings from the app config, installs the instrumented connection and registers the request hooks
+    for key, value in settings.items():
+        settings[key] = app.config.setdefault(key, value)
+    db.set_connection_factory(InstrumentedConnection)
+    app.before_request(start_request)
+    app.after_request(end_request)
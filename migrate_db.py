@@ -1,18 +1,519 @@
-import re
+# This file contains the database migration runner for the application
+# Migrations are numbered and applied in order, and each applied version is recorded in the schema_migrations table so it only ever runs once per database.
+# Run this once per deploy, before starting the web workers:
+#   python migrate_db.py              - apply any pending migrations
+#   python migrate_db.py --dry-run    - run the pending migrations inside a transaction, print the SQL, then roll back
+#   python migrate_db.py --status     - list applied and pending migrations
+#   python migrate_db.py --check      - check (with EXPLAIN QUERY PLAN) that the app's hot queries use their indexes
+import argparse # For the command line interface
+import sqlite3 # For database errors
+import sys # For exit codes
+import unicodedata # For normalising existing card text
+from datetime import datetime, timezone # For recording when a migration was applied
+import db # For database connections
+import pagination # For the admin table queries that --check explains
+import scheduler # For the review queries that --check explains
+import search # For the search queries that --check explains
 
-def test_password(password):
-    patterns = {
-        'uppercase': r'[A-Z]',
-        'lowercase': r'[a-z]',
-        'number': r'[0-9]',
-        'special': r'[@$%*?&]'
-    }
+# Schema
+# | users     | students       | flashcard_lists | list_students  | flashcards  |
+# |-----------|----------------|-----------------|----------------|-------------|
+# | id   (P)  | student_id (P) | list_id (P)     | list_id (F)    | card_id (P) |
+# | username  | user_id (F)    | list_name       | student_id (F) | list_id (F) |
+# | password  | lists_version  | version         |                | question    |
+# | f_name    | lists_updated_at |               |                | answer      |
+# | l_name    |                |                 |                | position    |
+# | email     |                |                 |                |             |
+# | admin     |                |                 |                |             |
+# | mfa_secret|                |                 |                |             |
+# |-----------|----------------|-----------------|----------------|-------------|
 
-    results = {}
-    for key, pattern in patterns.items():
-        results[key] = bool(re.search(pattern, password))
+class MigrationError(Exception):
+    pass
 
-    return results
+def column_exists(c, table, column):
+    return column in [row[1] for row in c.execute(f"PRAGMA table_info({table})")]
 
-password = 'Password1@'
-print(test_password(password))
\ No newline at end of file
+## MIGRATIONS ##
+# Each migration is a function that takes a cursor. They all run inside the runner's transaction - don't commit in them.
+# Never edit a migration that has been deployed - add a new one instead.
+
+def baseline_schema(c):
+    # The original tables. IF NOT EXISTS, so databases created before migrations existed are adopted as-is.
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        password TEXT NOT NULL,
+        f_name TEXT NOT NULL,
+        l_name TEXT NOT NULL,
+        email TEXT NOT NULL,
+        admin BOOLEAN DEFAULT FALSE,
+        mfa_secret TEXT
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS students (
+        student_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER UNIQUE NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS flashcard_lists (
+        list_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        list_name TEXT NOT NULL
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS list_students (
+        list_id INTEGER NOT NULL,
+        student_id INTEGER NOT NULL,
+        PRIMARY KEY (list_id, student_id),
+        FOREIGN KEY (list_id) REFERENCES flashcard_lists(list_id) ON DELETE CASCADE,
+        FOREIGN KEY (student_id) REFERENCES students(student_id) ON DELETE CASCADE
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS flashcards (
+        card_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        list_id INTEGER NOT NULL,
+        question TEXT NOT NULL,
+        answer TEXT NOT NULL,
+        FOREIGN KEY (list_id) REFERENCES flashcard_lists(list_id) ON DELETE CASCADE
+    )
+    ''')
+
+def flashcard_positions(c):
+    # Ordered per-list card positions (0..n-1) - list_card seeks straight to one card with the (list_id, position) index
+    if not column_exists(c, 'flashcards', 'position'):
+        c.execute('ALTER TABLE flashcards ADD COLUMN position INTEGER NOT NULL DEFAULT 0')
+        c.execute('''
+        UPDATE flashcards SET position = numbered.position
+        FROM (
+            SELECT card_id, ROW_NUMBER() OVER (PARTITION BY list_id ORDER BY card_id) - 1 AS position
+            FROM flashcards
+        ) AS numbered
+        WHERE flashcards.card_id = numbered.card_id
+        ''') # Number existing cards in the order they were inserted
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_flashcards_list_position ON flashcards (list_id, position)')
+
+def secondary_indexes(c):
+    # Lookups that were full table scans. flashcards(list_id) is already covered by idx_flashcards_list_position, since list_id is its first column.
+    c.execute('CREATE INDEX IF NOT EXISTS idx_list_students_student ON list_students (student_id, list_id)') # Student dashboard - the primary key only covers lookups by list_id
+    c.execute('CREATE INDEX IF NOT EXISTS idx_flashcard_lists_name ON flashcard_lists (list_name)') # assign_lists and register look lists up by name
+
+def unique_usernames(c):
+    # login, register and assign_lists all look users up by username - make it indexed and unique
+    duplicates = c.execute('SELECT username FROM users GROUP BY username HAVING COUNT(*) > 1').fetchall()
+    if duplicates:
+        raise MigrationError(f"Duplicate usernames must be renamed before usernames can be made unique: {', '.join(row[0] for row in duplicates)}")
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username ON users (username)')
+
+def flashcard_search(c):
+    # Full text search over questions and answers. The trigram tokenizer matches any 3+ character substring, which suits Japanese (no spaces between words).
+    # External content table - the text lives only in flashcards, and the triggers keep the index in step with every insert/update/delete.
+    c.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS flashcards_fts USING fts5 (
+        question, answer,
+        content = 'flashcards', content_rowid = 'card_id',
+        tokenize = 'trigram'
+    )
+    ''')
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS flashcards_fts_insert AFTER INSERT ON flashcards BEGIN
+        INSERT INTO flashcards_fts (rowid, question, answer) VALUES (new.card_id, new.question, new.answer);
+    END
+    ''')
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS flashcards_fts_delete AFTER DELETE ON flashcards BEGIN
+        INSERT INTO flashcards_fts (flashcards_fts, rowid, question, answer) VALUES ('delete', old.card_id, old.question, old.answer);
+    END
+    ''')
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS flashcards_fts_update AFTER UPDATE OF question, answer ON flashcards BEGIN
+        INSERT INTO flashcards_fts (flashcards_fts, rowid, question, answer) VALUES ('delete', old.card_id, old.question, old.answer);
+        INSERT INTO flashcards_fts (rowid, question, answer) VALUES (new.card_id, new.question, new.answer);
+    END
+    ''')
+    c.execute("INSERT INTO flashcards_fts (flashcards_fts) VALUES ('rebuild')") # Index the cards that already exist
+
+def student_list_versions(c):
+    # A per-student version of "the lists I've been assigned" - the student dashboard's ETag, so a repeat visit is a 304 without querying the lists.
+    # Bumped by triggers whenever an assignment is added/removed (assign_lists, deleting a list or user) or a list is renamed.
+    if not column_exists(c, 'students', 'lists_version'):
+        c.execute('ALTER TABLE students ADD COLUMN lists_version INTEGER NOT NULL DEFAULT 0')
+        c.execute('ALTER TABLE students ADD COLUMN lists_updated_at INTEGER NOT NULL DEFAULT 0') # Unix time - the dashboard's Last-Modified
+        c.execute("UPDATE students SET lists_updated_at = CAST(strftime('%s', 'now') AS INTEGER)")
+    bump = "UPDATE students SET lists_version = lists_version + 1, lists_updated_at = CAST(strftime('%s', 'now') AS INTEGER)"
+    c.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS list_students_version_insert AFTER INSERT ON list_students BEGIN
+        {bump} WHERE student_id = new.student_id;
+    END
+    ''')
+    c.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS list_students_version_delete AFTER DELETE ON list_students BEGIN
+        {bump} WHERE student_id = old.student_id;
+    END
+    ''')
+    c.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS flashcard_lists_version_rename AFTER UPDATE OF list_name ON flashcard_lists BEGIN
+        {bump} WHERE student_id IN (SELECT student_id FROM list_students WHERE list_id = new.list_id);
+    END
+    ''')
+    # An assigned list's cards changing is bumped by the writer, once per statement or chunk - see db.bump_student_lists
+
+def flashcard_list_versions(c):
+    # A per-list version, bumped whenever the list is renamed or any of its cards change - the ETag for the deck API's chunks
+    if not column_exists(c, 'flashcard_lists', 'version'):
+        c.execute('ALTER TABLE flashcard_lists ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+    bump = 'UPDATE flashcard_lists SET version = version + 1'
+    c.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS flashcard_lists_version_update AFTER UPDATE OF list_name ON flashcard_lists BEGIN
+        {bump} WHERE list_id = new.list_id;
+    END
+    ''')
+    c.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS flashcards_list_version_insert AFTER INSERT ON flashcards BEGIN
+        {bump} WHERE list_id = new.list_id;
+    END
+    ''')
+    c.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS flashcards_list_version_update AFTER UPDATE OF question, answer, position, list_id ON flashcards BEGIN
+        {bump} WHERE list_id IN (old.list_id, new.list_id);
+    END
+    ''')
+    c.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS flashcards_list_version_delete AFTER DELETE ON flashcards BEGIN
+        {bump} WHERE list_id = old.list_id;
+    END
+    ''')
+
+def card_reviews(c):
+    # Spaced repetition state for every card a student has graded - see scheduler.py. The (student_id, due_at) index is the review queue.
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS card_reviews (
+        student_id INTEGER NOT NULL,
+        card_id INTEGER NOT NULL,
+        due_at INTEGER NOT NULL,
+        repetitions INTEGER NOT NULL DEFAULT 0,
+        interval_days INTEGER NOT NULL DEFAULT 0,
+        ease REAL NOT NULL DEFAULT 2.5,
+        lapses INTEGER NOT NULL DEFAULT 0,
+        last_reviewed_at INTEGER,
+        PRIMARY KEY (student_id, card_id),
+        FOREIGN KEY (student_id) REFERENCES students(student_id) ON DELETE CASCADE,
+        FOREIGN KEY (card_id) REFERENCES flashcards(card_id) ON DELETE CASCADE
+    )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_card_reviews_due ON card_reviews (student_id, due_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_card_reviews_card ON card_reviews (card_id)') # Deleting a card cascades here - without this every delete scans the table
+    # Rows are created on a student's first grade (see scheduler.py) - nothing is written when a list is assigned or gains cards
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS list_students_reviews_delete AFTER DELETE ON list_students BEGIN
+        DELETE FROM card_reviews WHERE student_id = old.student_id AND card_id IN (SELECT card_id FROM flashcards WHERE list_id = old.list_id);
+    END
+    ''') # Unassigned lists drop out of the student's queue
+
+def study_events(c):
+    # Card views, flips and answers - written in batches by study_events.py
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS study_events (
+        event_id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        list_id INTEGER NOT NULL,
+        card_index INTEGER NOT NULL,
+        event_type TEXT NOT NULL,
+        occurred_at REAL NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+    )
+    ''') # No foreign key on list_id - the study history outlives the list. INTEGER PRIMARY KEY without AUTOINCREMENT keeps inserts append-only and cheap.
+    c.execute('CREATE INDEX IF NOT EXISTS idx_study_events_user ON study_events (user_id, occurred_at)') # Per-student history, and the cascade when a user is deleted
+
+def sessions(c):
+    # Server-side sessions (see session_store.py) - the cookie only carries the session id
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        data TEXT NOT NULL,
+        expires_at REAL NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+    ) WITHOUT ROWID
+    ''') # user_id is NULL until the visitor logs in. Deleting a user deletes their sessions.
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id)') # Invalidating a user's sessions, and the cascade
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)') # Sweeping expired sessions
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS sessions_user_updated AFTER UPDATE OF username, f_name, l_name, email, admin ON users
+    BEGIN
+        DELETE FROM sessions WHERE user_id = NEW.id;
+    END
+    ''') # Sessions hold a copy of the user's details and role - editing them signs the user out, whichever process made the change.
+    # Not password or mfa_secret: MFA setup and password rehashing update those halfway through logging in.
+
+def table_versions(c):
+    # A version number per admin table, bumped by triggers on every change that shows up in the table - the fragment cache's key (see fragment_cache.py)
+    c.execute('CREATE TABLE IF NOT EXISTS table_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID')
+    c.execute("INSERT OR IGNORE INTO table_versions (name) VALUES ('users'), ('flashcard_lists')")
+    for table, columns in (('users', 'username, f_name, l_name, email, admin'), ('flashcard_lists', 'list_name')):
+        # Only the columns the admin tables show - MFA setup, password rehashing and flashcard_lists.version (bumped on every card change) don't count
+        for event in ('INSERT', f'UPDATE OF {columns}', 'DELETE'):
+            c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_{event.split()[0].lower()}_table_version AFTER {event} ON {table}
+            BEGIN
+                UPDATE table_versions SET version = version + 1 WHERE name = '{table}';
+            END
+            ''')
+
+def jobs(c):
+    # Background jobs - long admin operations (deleting big lists and users, imports) run in chunks by worker threads, see jobs.py
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS jobs (
+        job_id INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL,
+        params TEXT NOT NULL,
+        description TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        progress INTEGER NOT NULL DEFAULT 0,
+        total INTEGER,
+        message TEXT,
+        created_by INTEGER,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL,
+        heartbeat_at REAL,
+        cancel_requested INTEGER NOT NULL DEFAULT 0
+    )
+    ''') # params is JSON. No foreign key on created_by - the job history outlives the admin who started it.
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, job_id)') # Workers claiming the next queued job, and the admin pages' active jobs
+
+def shuffle_seeds(c):
+    # Shuffle mode - a student's seed for each assigned list, from which their shuffled order is worked out (see shuffle.py). NULL = in list order.
+    if not column_exists(c, 'list_students', 'shuffle_seed'):
+        c.execute('ALTER TABLE list_students ADD COLUMN shuffle_seed INTEGER')
+
+def deleted_users(c):
+    # Deleting a user disables the account straight away - the rows that depend on it are removed later by a background job (see jobs.py).
+    # Until the job gets to it, login and MFA treat a user with deleted_at set as if they didn't exist.
+    if not column_exists(c, 'users', 'deleted_at'):
+        c.execute('ALTER TABLE users ADD COLUMN deleted_at REAL')
+
+def job_owners(c):
+    # The process running each job ('host:pid:token', see jobs.py) - only jobs whose owner has stopped sending heartbeats are handed on
+    if not column_exists(c, 'jobs', 'owner'):
+        c.execute('ALTER TABLE jobs ADD COLUMN owner TEXT')
+
+def lazy_card_reviews(c):
+    # For databases migrated before 0008 stopped seeding review state: its insert triggers wrote a row per student and card on every assignment,
+    # holding the write lock for seconds on a big list. Rows that were never graded say nothing a new card doesn't.
+    c.execute('DROP TRIGGER IF EXISTS list_students_reviews_insert')
+    c.execute('DROP TRIGGER IF EXISTS flashcards_reviews_insert')
+    c.execute('DELETE FROM card_reviews WHERE last_reviewed_at IS NULL')
+
+def new_card_cursors(c):
+    # Per-assignment cursor for the new cards in a list - every card before new_cursor has been seen by the student (see scheduler.py)
+    if not column_exists(c, 'list_students', 'new_cursor'):
+        c.execute('ALTER TABLE list_students ADD COLUMN new_cursor INTEGER NOT NULL DEFAULT 0')
+    c.execute('''
+    UPDATE list_students SET new_cursor = COALESCE(
+        (SELECT position FROM flashcards
+         WHERE list_id = list_students.list_id
+           AND NOT EXISTS (SELECT 1 FROM card_reviews WHERE student_id = list_students.student_id AND card_id = flashcards.card_id)
+         ORDER BY position LIMIT 1),
+        (SELECT COALESCE(MAX(position) + 1, 0) FROM flashcards WHERE list_id = list_students.list_id)
+    )
+    WHERE EXISTS (SELECT 1 FROM card_reviews WHERE student_id = list_students.student_id)
+    ''') # Students who have graded cards already
+
+def chunked_student_list_versions(c):
+    # For databases migrated before 0006 stopped creating them: card changes bump the assigned students' lists_version once per statement or chunk,
+    # from the writer (db.bump_student_lists) - these row triggers updated every assigned student for every card: 3M updates for a 10k card import into a list with 300 students
+    c.execute('DROP TRIGGER IF EXISTS flashcards_version_insert')
+    c.execute('DROP TRIGGER IF EXISTS flashcards_version_delete')
+
+def normalised_card_text(c):
+    # Searches NFKC-normalise the query, and cards are now normalised when they're written (search.normalise) - bring the existing ones into line so a
+    # half-width ｶﾀｶﾅ card is found by a full-width query. Only the rows that change are rewritten (which updates their FTS entries through its trigger).
+    last_card_id = 0
+    while True:
+        rows = c.execute('SELECT card_id, question, answer FROM flashcards WHERE card_id > ? ORDER BY card_id LIMIT 1000', (last_card_id,)).fetchall()
+        if not rows:
+            break
+        changed = [
+            (unicodedata.normalize('NFKC', question), unicodedata.normalize('NFKC', answer), card_id) for card_id, question, answer in rows
+            if unicodedata.normalize('NFKC', question) != question or unicodedata.normalize('NFKC', answer) != answer
+        ]
+        c.executemany('UPDATE flashcards SET question = ?, answer = ? WHERE card_id = ?', changed)
+        last_card_id = rows[-1][0]
+
+MIGRATIONS = [
+    (1, 'baseline schema', baseline_schema),
+    (2, 'flashcard positions', flashcard_positions),
+    (3, 'secondary indexes', secondary_indexes),
+    (4, 'unique usernames', unique_usernames),
+    (5, 'flashcard search', flashcard_search),
+    (6, 'student list versions', student_list_versions),
+    (7, 'flashcard list versions', flashcard_list_versions),
+    (8, 'card reviews', card_reviews),
+    (9, 'study events', study_events),
+    (10, 'sessions', sessions),
+    (11, 'table versions', table_versions),
+    (12, 'jobs', jobs),
+    (13, 'shuffle seeds', shuffle_seeds),
+    (14, 'deleted users', deleted_users),
+    (15, 'job owners', job_owners),
+    (16, 'lazy card reviews', lazy_card_reviews),
+    (17, 'new card cursors', new_card_cursors),
+    (18, 'chunked student list versions', chunked_student_list_versions),
+    (19, 'normalised card text', normalised_card_text),
+]
+
+## RUNNER ##
+
+def ensure_version_table(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TEXT NOT NULL
+    )
+    ''')
+
+def applied_versions(conn):
+    ensure_version_table(conn)
+    return {row[0] for row in conn.execute('SELECT version FROM schema_migrations')}
+
+def pending_migrations(conn):
+    applied = applied_versions(conn)
+    return [m for m in MIGRATIONS if m[0] not in applied]
+
+def migrate(conn=None, dry_run=False, echo=print):
+    # Applies every pending migration in one transaction. Returns the list of (version, name) that were (or, for a dry run, would be) applied.
+    own_conn = conn is None
+    conn = conn or db.connect()
+    previous_isolation = conn.isolation_level
+    conn.isolation_level = None # Manage the transaction explicitly - sqlite3 would otherwise commit before DDL statements
+    if dry_run:
+        conn.set_trace_callback(lambda sql: echo(f'    {sql.strip()};'))
+    try:
+        conn.execute('BEGIN IMMEDIATE') # Take the write lock up front, so two deploys can't apply the same migration
+        pending = pending_migrations(conn) # Read inside the lock - another process may have just migrated
+        c = conn.cursor()
+        for version, name, apply in pending:
+            echo(f'{"Would apply" if dry_run else "Applying"} migration {version:04d}: {name}')
+            apply(c)
+            c.execute('INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)', (version, name, datetime.now(timezone.utc).isoformat()))
+        if dry_run:
+            conn.execute('ROLLBACK')
+        else:
+            conn.execute('COMMIT')
+        return [(version, name) for version, name, _ in pending]
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.set_trace_callback(None)
+        conn.isolation_level = previous_isolation
+        if own_conn:
+            conn.close()
+
+def status(conn):
+    applied = {row[0]: row[1] for row in conn.execute('SELECT version, applied_at FROM schema_migrations')} if 'schema_migrations' in table_names(conn) else {}
+    return [(version, name, applied.get(version)) for version, name, _ in MIGRATIONS]
+
+def table_names(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+## QUERY PLAN CHECKS ##
+# The app's hot lookups, and the index each one must use. --check fails if SQLite would scan a table instead (scanning a subquery's rows is fine).
+# Queries the modules build are taken from them rather than copied here, so a change to one is checked as it's actually run.
+QUERY_PLAN_CHECKS = [
+    ('login', 'SELECT id, password, mfa_secret FROM users WHERE username = ?', ('x',), 'idx_users_username'),
+    ('register', 'SELECT COUNT(*) FROM users WHERE username = ?', ('x',), 'idx_users_username'),
+    ('assign_lists list lookup', 'SELECT list_id FROM flashcard_lists WHERE list_name = ?', ('x',), 'idx_flashcard_lists_name'),
+    ('student_dashboard version', 'SELECT student_id, lists_version, lists_updated_at FROM students WHERE user_id = ?', (1,), 'sqlite_autoindex_students_1'),
+    ('student_dashboard', 'SELECT list_id FROM list_students WHERE student_id = ?', (1,), 'idx_list_students_student'),
+    ('list_card', 'SELECT question, answer FROM flashcards WHERE list_id = ? AND position = ?', (1, 0), 'idx_flashcards_list_position'),
+    ('list_card count', 'SELECT MAX(position) FROM flashcards WHERE list_id = ?', (1,), 'idx_flashcards_list_position'),
+    ('deck API chunk', 'SELECT position, question, answer FROM flashcards WHERE list_id = ? AND position >= ? AND position < ? ORDER BY position', (1, 0, 200), 'idx_flashcards_list_position'),
+    ('deck API shuffled chunk', 'SELECT position, question, answer FROM flashcards WHERE list_id = ? AND position IN (?, ?, ?)', (1, 5, 0, 9), 'idx_flashcards_list_position'),
+    ('shuffle seed', 'SELECT shuffle_seed FROM list_students WHERE list_id = ? AND student_id = ?', (1, 1), 'sqlite_autoindex_list_students_1'),
+    ('deck export batch', 'SELECT list_id, position, question, answer FROM flashcards WHERE (list_id, position) > (?, ?) ORDER BY list_id, position LIMIT 1000', (0, -1), 'idx_flashcards_list_position'),
+    ('search scope size', search.SCOPE_SIZE_QUERY, (1,), 'idx_flashcards_list_position'),
+    ('search scope scan', search.SCAN_QUERY.format(scope=search.SCOPE, conditions=search.like_conditions(['x'])[0]),
+     [1, search.MAX_SCOPE_SCAN] + search.like_conditions(['x'])[1] + [search.MAX_RESULTS], 'idx_flashcards_list_position'),
+    ('search scan end', search.SCAN_END_QUERY.format(scope=search.SCOPE), (1, search.MAX_SCAN), 'idx_flashcards_list_position'),
+    ('review queue', scheduler.DUE_REVIEWS_QUERY, {'student_id': 1, 'now': 0, 'limit': scheduler.SESSION_SIZE}, 'idx_card_reviews_due'),
+    ('review queue new cards', scheduler.NEW_CARDS_QUERY, {'student_id': 1, 'limit': scheduler.SESSION_SIZE}, 'idx_flashcards_list_position'),
+    ('review cursor', scheduler.NEXT_NEW_POSITION_QUERY, {'student_id': 1, 'list_id': 1, 'position': 0}, 'idx_flashcards_list_position'),
+    ('review count', scheduler.DUE_COUNT_QUERY, {'student_id': 1, 'now': 0}, 'idx_card_reviews_due'),
+    ('user_management page by username', *pagination.page_query('users', ['id', 'username', 'f_name', 'l_name', 'email', 'admin'], 'id', 'username', cursor=('x', 1),
+                                                                prefix_column='username', prefix='x', where='deleted_at IS NULL'), 'idx_users_username'),
+    ('list_management page by name', *pagination.page_query('flashcard_lists', ['list_id', 'list_name'], 'list_id', 'list_name', cursor=('x', 1),
+                                                            prefix_column='list_name', prefix='x'), 'idx_flashcard_lists_name'),
+    ('session lookup', 'SELECT data, user_id, expires_at FROM sessions WHERE session_id = ?', ('x',), 'PRIMARY KEY'),
+    ('session sweep', 'DELETE FROM sessions WHERE expires_at <= ?', (0,), 'idx_sessions_expires'),
+    ('admin table version', 'SELECT version FROM table_versions WHERE name = ?', ('users',), 'PRIMARY KEY'),
+    ('next queued job', "SELECT job_id FROM jobs WHERE status = 'queued' ORDER BY job_id LIMIT 1", (), 'idx_jobs_status'),
+    ('job list delete chunk', 'SELECT card_id FROM flashcards WHERE list_id = ? ORDER BY position LIMIT 500', (1,), 'idx_flashcards_list_position'),
+    ('job user delete chunk', 'SELECT rowid FROM card_reviews WHERE student_id = ? LIMIT 500', (1,), 'idx_card_reviews_due'),
+    ('username typeahead', *pagination.prefix_query('users', 'username', 'x', where='deleted_at IS NULL'), 'idx_users_username'),
+    ('list name typeahead', *pagination.prefix_query('flashcard_lists', 'list_name', 'x'), 'idx_flashcard_lists_name'),
+]
+
+def check_query_plans(conn, echo=print):
+    # Returns the names of the checks that failed
+    failures = []
+    for name, sql, params, index in QUERY_PLAN_CHECKS:
+        try:
+            steps = [row[-1] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+        except sqlite3.Error as e: # e.g. a column added by a pending migration
+            steps = [f'error: {e}']
+        plan = ' | '.join(steps)
+        subqueries = {step.split()[1] for step in steps if step.startswith(('MATERIALIZE ', 'CO-ROUTINE '))} | {'CONSTANT'}
+        scans = [step for step in steps if step.startswith('SCAN ') and index not in step and step.split()[1] not in subqueries]
+        ok = index in plan and not scans and 'AUTOMATIC' not in plan
+        echo(f"{'ok  ' if ok else 'FAIL'} {name}: {plan}")
+        if not ok:
+            failures.append(name)
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Apply database migrations for KanaCard.')
+    parser.add_argument('--database', default=db.settings['DATABASE'], help='Path to the SQLite database (default: %(default)s)')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--dry-run', action='store_true', help='Show the pending migrations and their SQL without applying them')
+    group.add_argument('--status', action='store_true', help='List applied and pending migrations')
+    group.add_argument('--check', action='store_true', help='Check that the hot queries use their indexes')
+    args = parser.parse_args(argv)
+
+    conn = db.connect(args.database)
+    try:
+        if args.status:
+            for version, name, applied_at in status(conn):
+                print(f"{version:04d} {name:<30} {applied_at or 'pending'}")
+            return 0
+        if args.check:
+            return 1 if check_query_plans(conn) else 0
+        try:
+            applied = migrate(conn, dry_run=args.dry_run)
+        except MigrationError as e:
+            print(f'Migration failed, nothing was applied: {e}', file=sys.stderr)
+            return 1
+        if not applied:
+            print('Database is up to date.')
+        elif args.dry_run:
+            print(f'Dry run - {len(applied)} migration(s) rolled back.')
+        else:
+            print(f'Applied {len(applied)} migration(s).')
+        return 0
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+# This file contains keyset ("seek") pagination for the admin tables, and the prefix search used by the admin typeahead
+# Each page starts from the sort key of the last row on the previous page (WHERE (sort, id) > (?, ?)) instead of an OFFSET, so every page costs
+# the same index seek no matter how far into the table it is.
+import base64 # For encoding page cursors
+import json # For encoding page cursors
+
+PAGE_SIZE = 50 # Rows per admin table page
+TYPEAHEAD_LIMIT = 10 # Suggestions per typeahead lookup
+
+def encode_cursor(row, sort_index, id_index):
+    return base64.urlsafe_b64encode(json.dumps([row[sort_index], row[id_index]]).encode()).decode()
+
+def decode_cursor(cursor):
+    # Returns (sort value, id), or None for a missing or malformed cursor
+    try:
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return sort_value, int(row_id)
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+def prefix_range(prefix):
+    # 'ab' -> ('ab', 'ac'): col >= 'ab' AND col < 'ac' matches every value starting with 'ab', and can use the column's index
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def page_query(table, columns, id_column, sort_column, descending=False, cursor=None, backwards=False, prefix_column=None, prefix=None, page_size=PAGE_SIZE, where=None):
+    # The SQL and params for a page starting after cursor (a decoded (sort value, id)) - fetch_page runs it, and migrate_db.py --check explains it
+    conditions, params = [where] if where else [], []
+    if prefix and prefix_column:
+        low, high = prefix_range(prefix)
+        conditions.append(f'{prefix_column} >= ? AND {prefix_column} < ?')
+        params += [low, high]
+
+    reverse = descending != backwards
+    if cursor is not None:
+        operator = '<' if reverse else '>'
+        if sort_column == id_column:
+            conditions.append(f'{id_column} {operator} ?')
+            params.append(cursor[1])
+        else:
+            conditions.append(f'({sort_column}, {id_column}) {operator} (?, ?)')
+            params += list(cursor)
+
+    direction = 'DESC' if reverse else 'ASC'
+    order = f'{id_column} {direction}' if sort_column == id_column else f'{sort_column} {direction}, {id_column} {direction}'
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    return f"SELECT {', '.join(columns)} FROM {table} {where} ORDER BY {order} LIMIT ?", params + [page_size + 1]
+
+def fetch_page(conn, table, columns, id_column, sort_column, descending=False, after=None, before=None, prefix_column=None, prefix=None, page_size=PAGE_SIZE, where=None):
+    # table/columns (and where, a fixed SQL condition such as 'deleted_at IS NULL') come from the route (never from the request).
+    # sort_column must be id_column or an indexed column.
+    # Returns {'rows', 'next', 'prev'} where next/prev are cursors for the neighbouring pages (None at either end).
+    sort_index, id_index = columns.index(sort_column), columns.index(id_column)
+    cursor = decode_cursor(after or before or '')
+    backwards = cursor is not None and before is not None # Fetching the page before 'before' - read in reverse order, then flip
+    sql, params = page_query(table, columns, id_column, sort_column, descending, cursor, backwards, prefix_column, prefix, page_size, where)
+    rows = conn.execute(sql, params).fetchall()
+
+    has_more = len(rows) > page_size # One extra row tells us whether there's another page in this direction
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+    if not rows:
+        return {'rows': [], 'next': None, 'prev': None}
+    first, last = encode_cursor(rows[0], sort_index, id_index), encode_cursor(rows[-1], sort_index, id_index)
+    if backwards:
+        return {'rows': rows, 'next': last, 'prev': first if has_more else None}
+    return {'rows': rows, 'next': last if has_more else None, 'prev': first if cursor is not None else None}
+
+def prefix_query(table, column, prefix, limit=TYPEAHEAD_LIMIT, where=None):
+    # The SQL and params for prefix_search (where is an extra fixed SQL condition, as for fetch_page)
+    low, high = prefix_range(prefix)
+    return f"SELECT DISTINCT {column} FROM {table} WHERE {column} >= ? AND {column} < ?{' AND ' + where if where else ''} ORDER BY {column} LIMIT ?", [low, high, limit]
+
+def prefix_search(conn, table, column, prefix, limit=TYPEAHEAD_LIMIT, where=None):
+    # The first few values of an indexed column that start with prefix, in order
+    if not prefix:
+        return []
+    return [row[0] for row in conn.execute(*prefix_query(table, column, prefix, limit, where))]
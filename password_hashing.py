@@ -0,0 +1,101 @@
+# This file contains password hashing and verification
+# Checking a password hash is deliberately slow (the KDF is CPU bound), so logins verify passwords on a small dedicated thread pool instead of the request thread.
+# Admission control: at most PASSWORD_VERIFY_WORKERS checks run at once and at most PASSWORD_VERIFY_QUEUE more wait. Anything beyond that is refused
+# straight away (VerifierBusy - the login route answers 503) rather than letting a login storm tie up every web worker.
+import threading # For the admission limit and stats lock
+import time # For measuring hash time
+import logging # For logging
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError # For the verification pool
+from werkzeug.security import generate_password_hash, check_password_hash # For hashing passwords
+
+# Settings - can be overridden through the app config (see init_app)
+settings = {
+    'PASSWORD_HASH_METHOD': 'scrypt:32768:8:1', # KDF and cost for new hashes. Changing it rehashes each user's password at their next login.
+    'PASSWORD_VERIFY_WORKERS': 2, # Password checks that can run at once
+    'PASSWORD_VERIFY_QUEUE': 16, # Password checks that can wait for a worker before logins are refused
+    'PASSWORD_VERIFY_TIMEOUT': 10.0, # Seconds a login waits for its check before giving up
+}
+
+class VerifierBusy(Exception):
+    pass
+
+_lock = threading.Lock()
+_executor = None
+_slots = None # Counts admitted checks (running + waiting)
+stats = {
+    'verifications': 0, # Password checks completed
+    'rejected': 0, # Logins refused because the queue was full (or the check timed out)
+    'rehashed': 0, # Hashes upgraded to PASSWORD_HASH_METHOD at login
+    'running': 0, # Checks running right now
+    'queued': 0, # Checks waiting for a worker right now
+    'hash_seconds_total': 0.0, # Time spent hashing
+    'hash_seconds_max': 0.0, # Slowest single check
+}
+
+def hash_password(password):
+    return generate_password_hash(password, method=settings['PASSWORD_HASH_METHOD'])
+
+def needs_rehash(password_hash):
+    # Hashes look like 'scrypt:32768:8:1$salt$hash' - the part before the first $ is the method and its cost parameters
+    return password_hash.split('$', 1)[0] != settings['PASSWORD_HASH_METHOD']
+
+def _get_pool():
+    global _executor, _slots
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings['PASSWORD_VERIFY_WORKERS'], thread_name_prefix='password-verify')
+            _slots = threading.BoundedSemaphore(settings['PASSWORD_VERIFY_WORKERS'] + settings['PASSWORD_VERIFY_QUEUE'])
+        return _executor, _slots
+
+def _record(key, amount=1):
+    with _lock:
+        stats[key] += amount
+
+def _check(password_hash, password):
+    # Runs on the pool. Returns (matches, new hash or None).
+    _record('queued', -1)
+    _record('running')
+    start = time.perf_counter()
+    try:
+        matches = check_password_hash(password_hash, password)
+        new_hash = hash_password(password) if matches and needs_rehash(password_hash) else None # Upgrade while we have the plain text password
+        if new_hash:
+            _record('rehashed')
+        return matches, new_hash
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            stats['running'] -= 1
+            stats['verifications'] += 1
+            stats['hash_seconds_total'] += elapsed
+            stats['hash_seconds_max'] = max(stats['hash_seconds_max'], elapsed)
+
+def verify_password(password_hash, password):
+    # Returns (matches, new hash or None). Raises VerifierBusy if too many checks are already running or waiting.
+    executor, slots = _get_pool()
+    if not slots.acquire(blocking=False):
+        _record('rejected')
+        raise VerifierBusy('Too many password checks in progress')
+    _record('queued')
+    try:
+        future = executor.submit(_check, password_hash, password)
+        future.add_done_callback(lambda _: slots.release()) # The slot is held until the check actually finishes, even if we stop waiting
+    except Exception:
+        _record('queued', -1)
+        slots.release()
+        raise
+    try:
+        return future.result(timeout=settings['PASSWORD_VERIFY_TIMEOUT'])
+    except FutureTimeoutError:
+        _record('rejected')
+        logging.warning('Password check timed out waiting for the verification pool')
+        raise VerifierBusy('Password check timed out')
+
+def get_stats():
+    with _lock:
+        return dict(stats)
+
+def init_app(app):
+    # Reads the hashing settings from the app config
+    for key, value in settings.items():
+        settings[key] = app.config.setdefault(key, value)
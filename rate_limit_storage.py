@@ -0,0 +1,119 @@
+# This file contains a rate limit storage backend for flask-limiter that keeps its counters in a small SQLite database
+# flask-limiter's default storage is in-memory, so every worker process counts separately (the real limit becomes the limit x workers) and the counts
+# reset whenever a worker restarts. This storage is shared by every process on the machine and needs no extra services.
+# Counters live in their own database file (not database.db), so counting requests never waits on the app's own write lock.
+#   RATELIMIT_STORAGE_URI = 'kanacard+sqlite:///absolute/path/to/ratelimits.db'
+# Each hit is one UPSERT ... RETURNING statement - a single short write transaction.
+import os # For the default path and forked workers
+import sqlite3 # For the counter database
+import threading # For per-thread connections
+import time # For expiry times
+from limits.storage import Storage # Base class - subclasses register their URI scheme with limits
+from limits.storage.base import SlidingWindowCounterSupport, TimestampedSlidingWindow # For the sliding window counter strategy
+
+SCHEME = 'kanacard+sqlite'
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ratelimits.db')
+SWEEP_EVERY = 1000 # Hits between deleting expired counters
+
+def default_uri():
+    return f"{SCHEME}:///{os.path.abspath(os.environ.get('KANACARD_RATELIMIT_DATABASE', DEFAULT_PATH)).lstrip('/')}"
+
+class SQLiteStorage(Storage, SlidingWindowCounterSupport, TimestampedSlidingWindow):
+    STORAGE_SCHEME = [SCHEME]
+
+    def __init__(self, uri, wrap_exceptions=False, timeout=5.0, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self.path = '/' + uri.split('://', 1)[1].lstrip('/')
+        self.timeout = float(timeout)
+        self._local = threading.local()
+        self._hits = 0
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, count INTEGER NOT NULL, expires_at REAL NOT NULL) WITHOUT ROWID')
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _connection(self):
+        # One connection per thread (and per process - connections can't be shared across a fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False) # Autocommit - each statement is its own transaction
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = OFF') # Losing the last few counts in a power cut is fine
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _sweep(self, conn, now):
+        self._hits += 1
+        if self._hits % SWEEP_EVERY == 0:
+            conn.execute('DELETE FROM counters WHERE expires_at <= ?', (now,))
+
+    def _incr(self, conn, key, expiry, amount, now):
+        # Adds to a counter (restarting it if it has expired) and returns the new count
+        self._sweep(conn, now)
+        return conn.execute('''
+        INSERT INTO counters (key, count, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT (key) DO UPDATE SET
+            count = CASE WHEN expires_at <= ? THEN excluded.count ELSE count + excluded.count END,
+            expires_at = CASE WHEN expires_at <= ? THEN excluded.expires_at ELSE expires_at END
+        RETURNING count
+        ''', (key, amount, now + expiry, now, now)).fetchone()[0]
+
+    def incr(self, key, expiry, amount=1):
+        return self._incr(self._connection(), key, expiry, amount, time.time())
+
+    def get(self, key):
+        row = self._connection().execute('SELECT count FROM counters WHERE key = ? AND expires_at > ?', (key, time.time())).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key):
+        now = time.time()
+        row = self._connection().execute('SELECT expires_at FROM counters WHERE key = ? AND expires_at > ?', (key, now)).fetchone()
+        return row[0] if row else now
+
+    def check(self):
+        try:
+            self._connection().execute('SELECT 1')
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        return self._connection().execute('DELETE FROM counters').rowcount
+
+    def clear(self, key):
+        self._connection().execute('DELETE FROM counters WHERE key = ?', (key,))
+
+    ## SLIDING WINDOW COUNTER ##
+    # The count is the current window's hits plus the previous window's, weighted by how much of it is still inside the sliding window.
+
+    def _window(self, conn, key, expiry, now):
+        previous_key, current_key = self.sliding_window_keys(key, expiry, now)
+        counts = dict(conn.execute('SELECT key, count FROM counters WHERE key IN (?, ?) AND expires_at > ?', (previous_key, current_key, now)).fetchall())
+        previous_count, current_count = counts.get(previous_key, 0), counts.get(current_key, 0)
+        previous_ttl = (1 - (((now - expiry) / expiry) % 1)) * expiry if previous_count else 0.0
+        current_ttl = (1 - ((now / expiry) % 1)) * expiry + expiry
+        return previous_key, current_key, previous_count, previous_ttl, current_count, current_ttl
+
+    def acquire_sliding_window_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        now = time.time()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE') # Read and increment as one step - no other process can take the last slot in between
+        try:
+            _, current_key, previous_count, previous_ttl, current_count, _ = self._window(conn, key, expiry, now)
+            if int(previous_count * previous_ttl / expiry + current_count) + amount > limit:
+                return False
+            self._incr(conn, current_key, 2 * expiry, amount, now) # The current window is still counted while it's the previous one
+            return True
+        finally:
+            conn.execute('COMMIT')
+
+    def get_sliding_window(self, key, expiry):
+        return self._window(self._connection(), key, expiry, time.time())[2:]
+
+    def clear_sliding_window(self, key, expiry):
+        previous_key, current_key = self.sliding_window_keys(key, expiry, time.time())
+        self._connection().execute('DELETE FROM counters WHERE key IN (?, ?)', (previous_key, current_key))
@@ -0,0 +1,140 @@
+# This file contains the roster provisioning script - creates student accounts in bulk, e.g. at the start of term
+#   python roster.py year10.csv --report year10_credentials.csv
+# The roster is a CSV with a header row: username, first_name, last_name, email and (optionally) password.
+# Students without a password get a generated one. The credentials report lists each student's username, password and outcome -
+# it contains plain text passwords, so hand it out and delete it.
+# Password hashing (password_hashing.py) is CPU bound, so it's spread across a process pool. Each chunk of students is then written (users, students and the
+# default "Introduction" list) in one transaction.
+import argparse # For the command line interface
+import csv # For reading the roster and writing the report
+import json # For passing lists of usernames to SQLite
+import os # For the report's file permissions
+import re # For the password policy
+import secrets # For generating passwords
+import string # For generating passwords
+import sys # For exit codes
+import logging # For logging
+from concurrent.futures import ProcessPoolExecutor # For hashing passwords in parallel
+from markupsafe import escape # Stored the same way register stores them
+from email_validator import validate_email, EmailNotValidError # Same check as the register form's Email() validator
+import db # For database connections
+from password_hashing import hash_password # Same KDF settings as the app
+from forms import PASSWORD_MIN_LENGTH, PASSWORD_RULES # Same password policy as the register form
+
+CHUNK_SIZE = 200 # Students per transaction
+DEFAULT_LIST_NAME = 'Introduction' # Every new student gets this list, as in register
+GENERATED_PASSWORD_LENGTH = 12
+PASSWORD_SPECIALS = '@$%*?&'
+
+def generate_password():
+    # A random password that meets the register form's password policy (one of each character class)
+    alphabet = string.ascii_letters + string.digits + PASSWORD_SPECIALS
+    required = [secrets.choice(string.ascii_uppercase), secrets.choice(string.ascii_lowercase), secrets.choice(string.digits), secrets.choice(PASSWORD_SPECIALS)]
+    password = required + [secrets.choice(alphabet) for _ in range(GENERATED_PASSWORD_LENGTH - len(required))]
+    secrets.SystemRandom().shuffle(password)
+    return ''.join(password)
+
+def validate_student(row):
+    # Returns an error message, or None if the roster row can be provisioned
+    for field in ('username', 'first_name', 'last_name', 'email'):
+        if not row.get(field):
+            return f'{field} is required'
+        if len(row[field]) > 255:
+            return f'{field} is longer than 255 characters'
+    try:
+        validate_email(row['email'], check_deliverability=False)
+    except EmailNotValidError as e:
+        return f'invalid email: {e}'
+    if row.get('password'):
+        if len(row['password']) < PASSWORD_MIN_LENGTH:
+            return f'Password must be at least {PASSWORD_MIN_LENGTH} characters long'
+        for pattern, message in PASSWORD_RULES:
+            if not re.search(pattern, row['password']):
+                return message
+    return None
+
+def read_roster(f, chunk_size=CHUNK_SIZE):
+    # Yields the roster in chunks of (line number, row) so the whole file is never in memory
+    reader = csv.DictReader(f)
+    chunk = []
+    for row in reader:
+        chunk.append((reader.line_num, {key.strip().lower(): (value or '').strip() for key, value in row.items() if key}))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def existing_usernames(conn, usernames):
+    return {row[0] for row in conn.execute('SELECT username FROM users JOIN json_each(?) AS wanted ON users.username = wanted.value', (json.dumps(usernames),))}
+
+def write_students(conn, students):
+    # students: (username, password hash, f_name, l_name, email). One transaction for the whole chunk.
+    usernames = json.dumps([student[0] for student in students])
+    with conn:
+        conn.executemany('INSERT INTO users (username, password, f_name, l_name, email, admin) VALUES (?, ?, ?, ?, ?, 0)', students)
+        conn.execute('INSERT INTO students (user_id) SELECT users.id FROM users JOIN json_each(?) AS new ON users.username = new.value', (usernames,))
+        conn.execute('''
+        INSERT OR IGNORE INTO list_students (list_id, student_id)
+        SELECT (SELECT list_id FROM flashcard_lists WHERE list_name = ? ORDER BY list_id LIMIT 1), students.student_id
+        FROM students
+        JOIN users ON users.id = students.user_id
+        JOIN json_each(?) AS new ON users.username = new.value
+        WHERE EXISTS (SELECT 1 FROM flashcard_lists WHERE list_name = ?)
+        ''', (DEFAULT_LIST_NAME, usernames, DEFAULT_LIST_NAME))
+
+def provision(conn, roster_file, report_file, workers=None, chunk_size=CHUNK_SIZE):
+    # Provisions every valid student in the roster and writes the credentials report. Returns (created, skipped).
+    report = csv.writer(report_file)
+    report.writerow(['username', 'password', 'status'])
+    created = skipped = 0
+    seen = set() # Usernames earlier in this roster
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for chunk in read_roster(roster_file, chunk_size):
+            accepted = []
+            taken = existing_usernames(conn, [str(escape(row.get('username', ''))) for _, row in chunk])
+            for line_number, row in chunk:
+                username = str(escape(row.get('username', '')))
+                error = validate_student(row)
+                if not error and (username in taken or username in seen):
+                    error = 'username is already taken'
+                if error:
+                    report.writerow([row.get('username', ''), '', f'skipped (line {line_number}): {error}'])
+                    skipped += 1
+                    continue
+                seen.add(username)
+                accepted.append((username, row.get('password') or generate_password(), row))
+            if not accepted:
+                continue
+
+            hashes = pool.map(hash_password, [password for _, password, _ in accepted], chunksize=max(1, len(accepted) // ((workers or os.cpu_count() or 1) * 4)))
+            students = [(username, password_hash, str(escape(row['first_name'])), str(escape(row['last_name'])), str(escape(row['email'])))
+                        for (username, _, row), password_hash in zip(accepted, hashes)]
+            write_students(conn, students)
+            for username, password, _ in accepted:
+                report.writerow([username, password, 'created'])
+            created += len(accepted)
+            logging.info(f'Provisioned {created} students from roster so far')
+    return created, skipped
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Create student accounts in bulk from a roster CSV.')
+    parser.add_argument('roster', help='Roster CSV (username, first_name, last_name, email, optional password)')
+    parser.add_argument('--report', required=True, help='Where to write the credentials report (CSV, contains passwords)')
+    parser.add_argument('--workers', type=int, default=None, help='Hashing processes (default: one per CPU)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Students per transaction (default: %(default)s)')
+    parser.add_argument('--database', default=db.settings['DATABASE'], help='Path to the SQLite database (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    conn = db.connect(args.database)
+    report_fd = os.open(args.report, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600) # Only the owner can read the passwords
+    try:
+        with open(args.roster, newline='', encoding='utf-8-sig') as roster_file, open(report_fd, 'w', newline='', encoding='utf-8') as report_file:
+            created, skipped = provision(conn, roster_file, report_file, args.workers, args.chunk_size)
+    finally:
+        conn.close()
+    print(f'Created {created} students, skipped {skipped}. Credentials written to {args.report}')
+    return 0 if created or not skipped else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
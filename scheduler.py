@@ -0,0 +1,140 @@
+# This file contains the spaced repetition scheduler (SM-2) - used by the review routes
+# A student's review state for a card (card_reviews - see migrate_db.py) is created the first time they grade it. Until then the card is new, and due
+# straight away. Assigning a list or adding cards writes nothing here, so a bulk assignment doesn't hold the write lock for a row per student and card.
+# A session is the reviews that are due (a range scan of the (student_id, due_at) index), topped up with new cards in deck order. Each assignment keeps
+# a cursor (list_students.new_cursor) - every card before it has been seen - so finding new cards walks the (list_id, position) index from there
+# instead of from the start of the list. Cards are only ever added at the end of a list, so nothing unseen appears behind a cursor.
+import time # For due times
+
+SESSION_SIZE = 20 # Cards per review session
+MAX_SESSION_SIZE = 200
+DEFAULT_EASE = 2.5 # SM-2's starting ease factor
+MIN_EASE = 1.3 # SM-2's lowest ease factor
+PASSING_GRADE = 3 # Grades run 0-5: 0-2 = forgotten, 3 = recalled with difficulty, 4 = recalled, 5 = easy
+MAX_GRADE = 5
+RELEARN_DELAY = 10 * 60 # Seconds until a forgotten card comes back, so it's seen again in the same session
+DAY = 24 * 60 * 60
+
+class ReviewNotFound(Exception):
+    pass
+
+def next_state(repetitions, interval_days, ease, grade):
+    # SM-2: returns (repetitions, interval in days, ease) after a review with the given grade
+    if grade < PASSING_GRADE: # Forgotten - start the card's repetitions again, without changing its ease
+        return 0, 0, ease
+    if repetitions == 0:
+        interval_days = 1
+    elif repetitions == 1:
+        interval_days = 6
+    else:
+        interval_days = round(interval_days * ease)
+    ease = max(MIN_EASE, ease + 0.1 - (MAX_GRADE - grade) * (0.08 + (MAX_GRADE - grade) * 0.02))
+    return repetitions + 1, interval_days, ease
+
+DUE_REVIEWS_QUERY = '''
+SELECT flashcards.card_id, flashcards.list_id, flashcard_lists.list_name, flashcards.question, flashcards.answer,
+       due.repetitions, due.interval_days, due.due_at
+FROM (
+    SELECT card_id, repetitions, interval_days, due_at FROM card_reviews
+    WHERE student_id = :student_id AND due_at <= :now
+    ORDER BY due_at
+    LIMIT :limit
+) AS due
+JOIN flashcards ON flashcards.card_id = due.card_id
+JOIN flashcard_lists ON flashcard_lists.list_id = flashcards.list_id
+ORDER BY due.due_at
+'''
+
+# Each list's first new cards, from the student's cursor - the walk only passes cards they graded out of order (e.g. found through search), and stops
+# as soon as it has enough
+NEW_CARDS_QUERY = '''
+SELECT new_card.card_id, new_card.list_id, flashcard_lists.list_name, new_card.question, new_card.answer
+FROM list_students
+JOIN flashcards AS new_card ON new_card.card_id IN (
+    SELECT card_id FROM flashcards
+    WHERE list_id = list_students.list_id AND position >= list_students.new_cursor
+      AND NOT EXISTS (SELECT 1 FROM card_reviews WHERE student_id = list_students.student_id AND card_id = flashcards.card_id)
+    ORDER BY position
+    LIMIT :limit
+)
+JOIN flashcard_lists ON flashcard_lists.list_id = new_card.list_id
+WHERE list_students.student_id = :student_id
+ORDER BY new_card.position, new_card.list_id
+LIMIT :limit
+'''
+
+# The first card at or after a position in the list that the student hasn't seen yet - where their cursor moves to
+NEXT_NEW_POSITION_QUERY = '''
+SELECT COALESCE(
+    (SELECT position FROM flashcards
+     WHERE list_id = :list_id AND position >= :position
+       AND NOT EXISTS (SELECT 1 FROM card_reviews WHERE student_id = :student_id AND card_id = flashcards.card_id)
+     ORDER BY position LIMIT 1),
+    (SELECT COALESCE(MAX(position) + 1, 0) FROM flashcards WHERE list_id = :list_id)
+)
+'''
+
+# Seen cards that are due, plus every new card: the cards in the student's lists (positions run 0..n-1, so MAX(position) + 1 per list comes straight
+# off the index) less the ones they've already seen
+DUE_COUNT_QUERY = '''
+SELECT (SELECT COUNT(*) FROM card_reviews WHERE student_id = :student_id AND due_at <= :now)
+     + (SELECT COALESCE(SUM((SELECT COALESCE(MAX(position) + 1, 0) FROM flashcards WHERE list_id = list_students.list_id)), 0)
+        FROM list_students WHERE student_id = :student_id)
+     - (SELECT COUNT(*) FROM card_reviews
+        CROSS JOIN flashcards ON flashcards.card_id = card_reviews.card_id
+        CROSS JOIN list_students ON list_students.list_id = flashcards.list_id AND list_students.student_id = card_reviews.student_id
+        WHERE card_reviews.student_id = :student_id) -- CROSS JOIN keeps this order: one lookup per card seen, not per card assigned
+'''
+
+def due_cards(conn, student_id, limit=SESSION_SIZE, now=None):
+    # The student's session: reviews that are due, most overdue first, then new cards in deck order (across every list they've been assigned) for any
+    # slots left over - so reviews are never held back by a big pile of unseen cards
+    now = int(now if now is not None else time.time())
+    cards = [
+        {'card_id': row[0], 'list_id': row[1], 'list_name': row[2], 'question': row[3], 'answer': row[4], 'repetitions': row[5], 'interval_days': row[6], 'due_at': row[7]}
+        for row in conn.execute(DUE_REVIEWS_QUERY, {'student_id': student_id, 'now': now, 'limit': limit})
+    ]
+    if len(cards) < limit:
+        cards += [
+            {'card_id': row[0], 'list_id': row[1], 'list_name': row[2], 'question': row[3], 'answer': row[4], 'repetitions': 0, 'interval_days': 0, 'due_at': now}
+            for row in conn.execute(NEW_CARDS_QUERY, {'student_id': student_id, 'limit': limit - len(cards)})
+        ]
+    return cards
+
+def due_count(conn, student_id, now=None):
+    # Reviews due now plus new cards - see DUE_COUNT_QUERY
+    now = int(now if now is not None else time.time())
+    return conn.execute(DUE_COUNT_QUERY, {'student_id': student_id, 'now': now}).fetchone()[0]
+
+def record_review(conn, student_id, card_id, grade, now=None):
+    # Grades a card for a student and schedules its next review. Returns the card's new state.
+    # Raises ReviewNotFound if the card isn't in one of the student's lists.
+    now = int(now if now is not None else time.time())
+    with conn:
+        conn.execute('BEGIN IMMEDIATE') # Read and update the state without another review of the same card in between
+        state = conn.execute('SELECT repetitions, interval_days, ease, lapses FROM card_reviews WHERE student_id = ? AND card_id = ?', (student_id, card_id)).fetchone()
+        new_card = None
+        if state is None: # A new card - its state is created now, if it's in one of the student's lists
+            new_card = conn.execute('''
+            SELECT flashcards.list_id, flashcards.position, list_students.new_cursor
+            FROM flashcards JOIN list_students ON list_students.list_id = flashcards.list_id AND list_students.student_id = ?
+            WHERE flashcards.card_id = ?
+            ''', (student_id, card_id)).fetchone()
+            if new_card is None:
+                raise ReviewNotFound(f'Card {card_id} is not in any of student {student_id}\'s lists')
+            state = (0, 0, DEFAULT_EASE, 0)
+        repetitions, interval_days, ease = next_state(state[0], state[1], state[2], grade)
+        lapses = state[3] + (grade < PASSING_GRADE)
+        due_at = now + (interval_days * DAY if grade >= PASSING_GRADE else RELEARN_DELAY)
+        conn.execute('''
+        INSERT INTO card_reviews (student_id, card_id, repetitions, interval_days, ease, lapses, due_at, last_reviewed_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (student_id, card_id) DO UPDATE
+        SET repetitions = excluded.repetitions, interval_days = excluded.interval_days, ease = excluded.ease, lapses = excluded.lapses,
+            due_at = excluded.due_at, last_reviewed_at = excluded.last_reviewed_at
+        ''', (student_id, card_id, repetitions, interval_days, ease, lapses, due_at, now))
+        if new_card is not None and new_card[1] == new_card[2]: # The card at the cursor - move it past this card and any seen out of order after it
+            list_id, position = new_card[0], new_card[1]
+            next_position = conn.execute(NEXT_NEW_POSITION_QUERY, {'list_id': list_id, 'position': position + 1, 'student_id': student_id}).fetchone()[0]
+            conn.execute('UPDATE list_students SET new_cursor = ? WHERE list_id = ? AND student_id = ?', (next_position, list_id, student_id))
+    return {'card_id': card_id, 'repetitions': repetitions, 'interval_days': interval_days, 'ease': round(ease, 2), 'lapses': lapses, 'due_at': due_at}
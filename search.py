@@ -0,0 +1,131 @@
+# This file contains flashcard search - used by the /search route
+# Searches go through the flashcards_fts trigram index (see migrate_db.py), ranked by bm25 and scoped to the lists the student has been assigned.
+# Kana handling: card text (when it's written - see normalise) and queries are both NFKC-normalised (half-width katakana -> full-width, full-width
+# latin -> ASCII), so either form finds the other, and each term matches both its hiragana and katakana spelling.
+# The index finds matches across every list, so a student with a few lists is searched the other way round: their cards are read off the
+# (list_id, position) index and matched with LIKE - a common term doesn't mean ranking every match in the table to keep the handful in scope.
+# The trigram index can only match terms of 3+ characters, so queries with only shorter terms (common in Japanese) are matched with LIKE too. Unless
+# that's the whole of a small scope, the scan stops after MAX_SCAN cards, so a short term that matches nothing can't read the whole table - the
+# results say whether the scan was complete.
+import re # For highlighting LIKE matches
+import unicodedata # For normalising card text and queries
+from markupsafe import escape, Markup # For safely highlighting matches
+
+MAX_RESULTS = 50
+MAX_SCOPE_SCAN = 100000 # Students with up to this many cards are searched by scanning them
+MAX_SCAN = 20000 # Most cards a short-term search of a bigger scope (or an admin's) scans before it gives up
+MIN_TRIGRAM_LENGTH = 3 # Shortest term the trigram index can match
+HIGHLIGHT_START, HIGHLIGHT_END = '\x02', '\x03' # Placeholders swapped for <mark> tags once the text has been escaped
+
+def to_hiragana(text):
+    return ''.join(chr(ord(ch) - 0x60) if 'ァ' <= ch <= 'ヶ' else ch for ch in text)
+
+def to_katakana(text):
+    return ''.join(chr(ord(ch) + 0x60) if 'ぁ' <= ch <= 'ゖ' else ch for ch in text)
+
+def kana_variants(term):
+    return list(dict.fromkeys([term, to_hiragana(term), to_katakana(term)])) # Dedupes, keeping order
+
+def normalise(text):
+    # The form card text is stored and searched in - everything that writes a card's question or answer passes it through this first
+    return unicodedata.normalize('NFKC', text)
+
+def parse_query(query):
+    # Splits a query into (long terms for the FTS index, short terms for LIKE)
+    terms = normalise(query).split()
+    return [t for t in terms if len(t) >= MIN_TRIGRAM_LENGTH], [t for t in terms if len(t) < MIN_TRIGRAM_LENGTH]
+
+def fts_phrase(term):
+    return '"' + term.replace('"', '""') + '"' # A quoted FTS5 string - operators and punctuation in the query are searched for literally
+
+def build_match(terms):
+    # Every term must match, in either kana spelling: ("ねこ" OR "ネコ") AND ...
+    return ' AND '.join('(' + ' OR '.join(fts_phrase(variant) for variant in kana_variants(term)) + ')' for term in terms)
+
+def like_pattern(term):
+    return '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def like_conditions(terms):
+    # Every term must be in the question or answer, in either kana spelling. Returns (SQL, params).
+    conditions, params = [], []
+    for term in terms:
+        variants = kana_variants(term)
+        conditions.append('(' + ' OR '.join("(card.question LIKE ? ESCAPE '\\' OR card.answer LIKE ? ESCAPE '\\')" for _ in variants) + ')')
+        for variant in variants:
+            params += [like_pattern(variant), like_pattern(variant)]
+    return ' AND '.join(conditions), params
+
+def mark_terms(text, terms):
+    # Highlights LIKE matches the way highlight() in the FTS query does - case-insensitively, longest match first
+    variants = sorted({variant for term in terms for variant in kana_variants(term)}, key=len, reverse=True)
+    return re.sub('|'.join(map(re.escape, variants)), lambda match: HIGHLIGHT_START + match.group(0) + HIGHLIGHT_END, text, flags=re.IGNORECASE)
+
+# The scan path's queries - migrate_db.py --check explains these same strings
+SCOPE = 'WHERE list_id IN (SELECT list_id FROM list_students WHERE student_id = ?)' # The cards in a student's lists
+SCOPE_SIZE_QUERY = '''
+SELECT COALESCE(SUM((SELECT COALESCE(MAX(position) + 1, 0) FROM flashcards WHERE list_id = list_students.list_id)), 0)
+FROM list_students WHERE student_id = ?
+'''
+SCAN_QUERY = '''
+SELECT card.card_id, card.list_id, flashcard_lists.list_name, card.position, card.question, card.answer
+FROM (
+    SELECT card_id, list_id, position, question, answer FROM flashcards {scope}
+    ORDER BY list_id, position
+    LIMIT ?
+) AS card
+CROSS JOIN flashcard_lists ON flashcard_lists.list_id = card.list_id -- CROSS JOIN keeps the scan streaming in list order, so it stops at 'limit' matches
+WHERE {conditions}
+LIMIT ?
+''' # Formatted with scope (SCOPE, or '' for every list) and conditions (from like_conditions)
+SCAN_END_QUERY = 'SELECT 1 FROM flashcards {scope} ORDER BY list_id, position LIMIT 1 OFFSET ?' # Whether there are cards past the end of a scan
+
+def scope_size(conn, student_id):
+    # Cards in the student's lists - positions run 0..n-1, so MAX(position) + 1 per list comes straight off the index
+    return conn.execute(SCOPE_SIZE_QUERY, (student_id,)).fetchone()[0]
+
+def highlight(text):
+    # Escapes card text, then turns the match placeholders into <mark> tags
+    return Markup(str(escape(text)).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>'))
+
+def search_cards(conn, query, student_id=None, limit=MAX_RESULTS):
+    # Returns (up to 'limit' matching cards, best first; whether every card in scope was searched).
+    # student_id limits the search to that student's assigned lists (None = every list, for admins).
+    long_terms, short_terms = parse_query(query)
+    if not long_terms and not short_terms:
+        return [], True
+    scope, scope_params = '', []
+    if student_id is not None:
+        scope, scope_params = SCOPE, [student_id]
+
+    whole_scope = student_id is not None and scope_size(conn, student_id) <= MAX_SCOPE_SCAN # Small enough to scan every card in it
+
+    if long_terms and not whole_scope: # Ranked search through the index
+        conditions, params = like_conditions(short_terms)
+        if student_id is not None:
+            conditions = ' AND '.join(filter(None, [conditions, 'card.list_id IN (SELECT list_id FROM list_students WHERE student_id = ?)']))
+            params += scope_params
+        sql = f'''
+        SELECT card.card_id, card.list_id, flashcard_lists.list_name, card.position,
+               highlight(flashcards_fts, 0, ?, ?), highlight(flashcards_fts, 1, ?, ?)
+        FROM flashcards_fts
+        JOIN flashcards AS card ON card.card_id = flashcards_fts.rowid
+        JOIN flashcard_lists ON flashcard_lists.list_id = card.list_id
+        WHERE flashcards_fts MATCH ? {' AND ' + conditions if conditions else ''}
+        ORDER BY flashcards_fts.rank
+        LIMIT ?
+        '''
+        params = [HIGHLIGHT_START, HIGHLIGHT_END, HIGHLIGHT_START, HIGHLIGHT_END, build_match(long_terms)] + params + [limit]
+        rows, complete = conn.execute(sql, params).fetchall(), True
+    else: # A small scope, or only short terms - scan the cards in scope in list order, via the (list_id, position) index
+        conditions, params = like_conditions(long_terms + short_terms)
+        rows = [
+            row[:4] + (mark_terms(row[4], long_terms + short_terms), mark_terms(row[5], long_terms + short_terms))
+            for row in conn.execute(SCAN_QUERY.format(scope=scope, conditions=conditions),
+                                    scope_params + [MAX_SCOPE_SCAN if whole_scope else MAX_SCAN] + params + [limit])
+        ]
+        complete = whole_scope or len(rows) == limit or conn.execute(SCAN_END_QUERY.format(scope=scope), scope_params + [MAX_SCAN]).fetchone() is None # Nothing past the end of the scan
+
+    return [
+        {'card_id': row[0], 'list_id': row[1], 'list_name': row[2], 'card_index': row[3], 'question': highlight(row[4]), 'answer': highlight(row[5])}
+        for row in rows
+    ], complete
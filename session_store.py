@@ -0,0 +1,191 @@
+# This file contains the server-side session store for the application
+# Flask's default session is a signed cookie holding everything in the session, so every request ships (and re-verifies) the user's details, and a
+# deleted user stays signed in until their cookie expires. Here the cookie only holds a random session id. The session itself lives in the sessions
+# table, fronted by a small in-process LRU cache so most requests don't touch the database at all.
+# Invalidation: deleting a user cascades to their sessions, and editing a user deletes them (a trigger - see migrate_db.py). invalidate_user() also drops
+# them from this process's cache straight away; other worker processes notice within SESSION_CACHE_TTL seconds.
+# Expired sessions are deleted in bulk every SESSION_SWEEP_INTERVAL seconds.
+import secrets # For session ids
+import sqlite3 # For database errors
+import threading # For the cache lock
+import time # For expiry times
+import logging # For logging
+from collections import OrderedDict # For the LRU cache
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer # For plugging into Flask
+from werkzeug.datastructures import CallbackDict # For tracking changes to the session
+from db import get_db_connection, savepoint # Per-thread, reused database connections
+
+# Settings - can be overridden through the app config (see init_app)
+settings = {
+    'SESSION_CACHE_SIZE': 1024, # Sessions kept in memory per process
+    'SESSION_CACHE_TTL': 5.0, # Seconds a cached session is trusted before it's re-read - the most a change made by another process can go unnoticed
+    'SESSION_TOUCH_INTERVAL': 60.0, # Seconds between pushing back a session's expiry on requests that don't change it - saves a write per request
+    'SESSION_SWEEP_INTERVAL': 60.0, # Seconds between deleting expired sessions
+}
+
+_lock = threading.Lock()
+_cache = OrderedDict() # session_id -> (data, user_id, expires_at, cached_at)
+_last_sweep = 0.0
+stats = {
+    'hits': 0, # Sessions served from the cache
+    'misses': 0, # Sessions read from the database
+    'evictions': 0, # Sessions pushed out of a full cache
+    'writes': 0, # Sessions created, changed or touched
+    'swept': 0, # Expired sessions deleted
+}
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, session_id=None, user_id=None, expires_at=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.session_id = session_id # None until the session is first saved
+        self.user_id = user_id # The user the session belonged to when it was loaded
+        self.was_logged_in = bool(self.get('logged_in'))
+        self.expires_at = expires_at
+        self.modified = False
+
+def _user_of(session):
+    return session.get('user_id') or session.get('pending_user') # Sessions halfway through MFA belong to the user too
+
+## CACHE ##
+
+def _cache_get(session_id):
+    with _lock:
+        entry = _cache.get(session_id)
+        if entry is None or entry[3] + settings['SESSION_CACHE_TTL'] < time.time():
+            stats['misses'] += 1
+            return None
+        _cache.move_to_end(session_id)
+        stats['hits'] += 1
+        return entry
+
+def _cache_put(session_id, data, user_id, expires_at):
+    with _lock:
+        _cache[session_id] = (data, user_id, expires_at, time.time()) # Serialised data - each request gets its own copy to change
+        _cache.move_to_end(session_id)
+        while len(_cache) > settings['SESSION_CACHE_SIZE']:
+            _cache.popitem(last=False)
+            stats['evictions'] += 1
+
+def _cache_delete(session_id):
+    with _lock:
+        _cache.pop(session_id, None)
+
+def invalidate_user(user_id):
+    # Signs a user out everywhere - call after editing or deleting them
+    with _lock:
+        for session_id in [key for key, entry in _cache.items() if entry[1] == user_id]:
+            del _cache[session_id]
+    conn = get_db_connection()
+    with savepoint(conn, 'invalidate_user'): # The connection is shared with the route - don't commit anything it has left open
+        conn.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+
+## STORAGE ##
+
+def _load(session_id):
+    entry = _cache_get(session_id)
+    if entry is None:
+        row = get_db_connection().execute('SELECT data, user_id, expires_at FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        if row is None:
+            _cache_delete(session_id)
+            return None
+        _cache_put(session_id, *row)
+        entry = row
+    data, user_id, expires_at = entry[:3]
+    if expires_at <= time.time():
+        return None
+    return ServerSideSession(session_json_serializer.loads(data), session_id, user_id, expires_at)
+
+def _sweep(conn, now):
+    global _last_sweep
+    with _lock:
+        if now - _last_sweep < settings['SESSION_SWEEP_INTERVAL']:
+            return
+        _last_sweep = now
+    swept = conn.execute('DELETE FROM sessions WHERE expires_at <= ?', (now,)).rowcount
+    with _lock:
+        stats['swept'] += swept
+    if swept:
+        logging.debug(f'Swept {swept} expired sessions')
+
+class SQLiteSessionInterface(SessionInterface):
+    serializer = session_json_serializer
+
+    def open_session(self, app, request):
+        session_id = request.cookies.get(self.get_cookie_name(app))
+        if session_id:
+            try:
+                session = _load(session_id)
+            except sqlite3.Error as e:
+                logging.error(f'Database error: {e} on loading a session')
+                session = None
+            if session is not None:
+                return session
+        return ServerSideSession()
+
+    def save_session(self, app, session, response):
+        name, domain, path = self.get_cookie_name(app), self.get_cookie_domain(app), self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+        now = time.time()
+        expires_at = now + app.permanent_session_lifetime.total_seconds() # Idle timeout, whether or not the cookie itself is permanent
+        user_id = _user_of(session)
+        conn = get_db_connection()
+        route_transaction = conn.in_transaction # Left open by the route - end_request will roll it back, and this write with it
+        try:
+            with savepoint(conn, 'save_session'): # Runs before end_request - a transaction the route left open must still be rolled back, not committed here
+                _sweep(conn, now)
+                if not session:
+                    # Emptied (e.g. logged out) - forget it. Sessions that were never saved don't need a cookie at all.
+                    if session.session_id is not None:
+                        conn.execute('DELETE FROM sessions WHERE session_id = ?', (session.session_id,))
+                        _cache_delete(session.session_id)
+                        response.delete_cookie(name, domain=domain, path=path, secure=self.get_cookie_secure(app), httponly=self.get_cookie_httponly(app), samesite=self.get_cookie_samesite(app))
+                    return
+                if session.session_id is not None and (user_id != session.user_id or bool(session.get('logged_in')) != session.was_logged_in):
+                    # Logged in (or out) - give the session a new id, so an id seen before login is no use afterwards
+                    conn.execute('DELETE FROM sessions WHERE session_id = ?', (session.session_id,))
+                    _cache_delete(session.session_id)
+                    session.session_id = None
+                data = self.serializer.dumps(dict(session))
+                if session.session_id is None:
+                    session.session_id = secrets.token_urlsafe(32)
+                    conn.execute('INSERT INTO sessions (session_id, user_id, data, expires_at) VALUES (?, ?, ?, ?)', (session.session_id, user_id, data, expires_at))
+                elif session.modified:
+                    # UPDATE, not an upsert - a session invalidated during this request stays deleted
+                    if not conn.execute('UPDATE sessions SET data = ?, expires_at = ? WHERE session_id = ?', (data, expires_at, session.session_id)).rowcount:
+                        _cache_delete(session.session_id)
+                        return
+                elif expires_at - session.expires_at >= settings['SESSION_TOUCH_INTERVAL']:
+                    if not conn.execute('UPDATE sessions SET expires_at = ? WHERE session_id = ?', (expires_at, session.session_id)).rowcount:
+                        _cache_delete(session.session_id)
+                        return
+                else:
+                    return # Unchanged and recently touched - nothing to write
+        except sqlite3.Error as e:
+            logging.error(f'Database error: {e} on saving a session')
+            return
+        with _lock:
+            stats['writes'] += 1
+        if route_transaction: # Not saved yet - the next request reads whatever is left in the database
+            _cache_delete(session.session_id)
+        else:
+            _cache_put(session.session_id, data, user_id, expires_at)
+        if self.should_set_cookie(app, session) or session.modified:
+            response.set_cookie(
+                name, session.session_id, expires=self.get_expiration_time(app, session), domain=domain, path=path,
+                secure=self.get_cookie_secure(app), httponly=self.get_cookie_httponly(app), samesite=self.get_cookie_samesite(app),
+            )
+
+def get_stats():
+    with _lock:
+        counters = dict(stats)
+        counters['cached'] = len(_cache)
+    return counters
+
+def init_app(app):
+    # Reads the session settings from the app config and replaces Flask's cookie sessions
+    for key, value in settings.items():
+        settings[key] = app.config.setdefault(key, value)
+    app.session_interface = SQLiteSessionInterface()
@@ -0,0 +1,57 @@
+# This file contains shuffle mode for studying - each student's own order for each of their lists
+# A shuffled list isn't stored anywhere: the student's assignment keeps a random seed (list_students.shuffle_seed, NULL = in order), and the seed
+# defines a permutation of the list's positions. Card n of the shuffled deck is worked out on its own - a few rounds of a keyed Feistel network over
+# the positions - so serving any card, or a chunk of them, costs the same index lookups as the ordered deck, whatever the size of the list.
+# The permutation depends on the list's length too, so adding or removing cards gives the student a fresh shuffle.
+import secrets # For new seeds
+
+ROUNDS = 4 # Feistel rounds - 4 is plenty to make the order look random
+MASK64 = (1 << 64) - 1
+
+def new_seed():
+    return secrets.randbits(63) # Fits a signed SQLite INTEGER
+
+def _half_bits(total):
+    # Bits in each half of the Feistel network's block - the smallest block (4 ** bits values) that covers every position
+    return max(1, ((total - 1).bit_length() + 1) // 2)
+
+def _round(seed, round_number, value, mask):
+    # The round function: a splitmix64 hash of the seed, round and half-block
+    x = (seed ^ (round_number * 0x9E3779B97F4A7C15) ^ value) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return (x ^ (x >> 31)) & mask
+
+def _encrypt(seed, value, bits):
+    mask = (1 << bits) - 1
+    left, right = value >> bits, value & mask
+    for round_number in range(ROUNDS):
+        left, right = right, left ^ _round(seed, round_number, right, mask)
+    return (left << bits) | right
+
+def _decrypt(seed, value, bits):
+    mask = (1 << bits) - 1
+    left, right = value >> bits, value & mask
+    for round_number in reversed(range(ROUNDS)):
+        left, right = right ^ _round(seed, round_number, left, mask), left
+    return (left << bits) | right
+
+def position(seed, card_index, total):
+    # The position (in list order) of the card shown at card_index - or card_index itself if the list isn't shuffled
+    if seed is None or not 0 <= card_index < total:
+        return card_index
+    bits = _half_bits(total)
+    value = _encrypt(seed, card_index, bits)
+    while value >= total: # Cycle-walking: the block is up to 4x bigger than the list, so keep going until we land back inside it
+        value = _encrypt(seed, value, bits)
+    return value
+
+def card_index(seed, position, total):
+    # The reverse of position() - where a card (e.g. a search result) comes up in the student's shuffled deck
+    if seed is None or not 0 <= position < total:
+        return position
+    bits = _half_bits(total)
+    value = _decrypt(seed, position, bits)
+    while value >= total:
+        value = _decrypt(seed, value, bits)
+    return value
@@ -9,6 +9,152 @@ document.addEventListener("DOMContentLoaded", function () { // Wait for the DOM
     });
 });
 
+// Study Events
+// Card views and flips are batched and sent to the server every few seconds (and when the page is closed), rather than one request each
+var STUDY_EVENT_INTERVAL = 10000; // Milliseconds between sends
+var studyEvents = [];
+function recordStudyEvent(type, listId, cardIndex) {
+    studyEvents.push({ type: type, list_id: listId, card_index: cardIndex, at: Date.now() / 1000 });
+}
+
+function sendStudyEvents() {
+    if (!studyEvents.length) {
+        return;
+    }
+    var batch = studyEvents.splice(0, 100); // The server takes up to 100 per request
+    var token = document.querySelector('meta[name="csrf-token"]');
+    fetch('/api/v1/events', {
+        method: 'POST',
+        credentials: 'same-origin',
+        keepalive: true, // Lets the last batch go out while the page is closing
+        headers: { 'Content-Type': 'application/json', 'X-CSRFToken': token ? token.content : '' },
+        body: JSON.stringify({ events: batch })
+    }).then(function (response) {
+        if (response.status === 503) {
+            studyEvents = batch.concat(studyEvents); // The server is busy - keep them for the next send
+        }
+    }).catch(function () {});
+}
+setInterval(sendStudyEvents, STUDY_EVENT_INTERVAL);
+window.addEventListener('pagehide', sendStudyEvents);
+
+// Local Deck Navigation
+// Loads the deck from the study API in chunks and flips through it in the page, instead of a page load per card.
+// The Previous/Next links still point at the per-card pages, so if the API can't be reached they work as before.
+var PREFETCH_MARGIN = 20; // Start loading the next chunk this many cards before the end of the loaded ones
+document.addEventListener("DOMContentLoaded", function () {
+    var flashcard = document.querySelector('.flashcard[data-deck-url]');
+    if (!flashcard || !window.fetch || !window.history.pushState) {
+        return; // Not a study page, or an old browser - keep the plain links
+    }
+    var deck = {
+        url: flashcard.dataset.deckUrl,
+        chunkSize: parseInt(flashcard.dataset.chunkSize, 10),
+        total: parseInt(flashcard.dataset.totalCards, 10),
+        index: parseInt(flashcard.dataset.cardIndex, 10),
+        listId: parseInt(flashcard.dataset.listId, 10),
+        cards: {}, // Card index -> {position, question, answer} - the index is the student's order, which is a shuffle of the positions in shuffle mode
+        chunks: {} // Chunk offset -> the fetch loading it
+    };
+    var links = {};
+    document.querySelectorAll('[data-study-nav]').forEach(function (link) {
+        links[link.dataset.studyNav] = link;
+    });
+    var pageUrl = function (index) { // The card's own page - /student_list/<list_id>/<card_index>
+        return links.restart.getAttribute('href').replace(/\d+$/, index);
+    };
+
+    function loadChunk(offset) {
+        if (!deck.chunks[offset]) {
+            deck.chunks[offset] = fetch(deck.url + '?offset=' + offset + '&limit=' + deck.chunkSize, { credentials: 'same-origin' }) // The browser revalidates with the ETag, so a reload is a 304
+                .then(function (response) {
+                    if (!response.ok) {
+                        throw new Error('Deck request failed: ' + response.status);
+                    }
+                    return response.json();
+                })
+                .then(function (chunk) {
+                    deck.total = chunk.total;
+                    chunk.cards.forEach(function (card) {
+                        deck.cards[card.index] = card;
+                    });
+                })
+                .catch(function (error) {
+                    delete deck.chunks[offset]; // Let a later attempt try again
+                    throw error;
+                });
+        }
+        return deck.chunks[offset];
+    }
+
+    function chunkOffset(index) {
+        return index - (index % deck.chunkSize);
+    }
+
+    function prefetch(index) {
+        var next = chunkOffset(index) + deck.chunkSize;
+        if (index + PREFETCH_MARGIN >= next && next < deck.total) {
+            loadChunk(next).catch(function () {}); // Only a head start - showCard retries if it's needed
+        }
+    }
+
+    function render(index) {
+        var card = deck.cards[index];
+        deck.index = index;
+        flashcard.classList.remove('flipped');
+        flashcard.querySelector('.flashcard-title').textContent = 'Flashcard ' + (index + 1) + ' of ' + deck.total;
+        flashcard.querySelector('.flashcard-question').textContent = card.question;
+        flashcard.querySelector('.flashcard-answer').textContent = card.answer;
+        links.previous.href = pageUrl(Math.max(index - 1, 0));
+        links.next.href = pageUrl(index + 1);
+        links.previous.classList.toggle('d-none', index === 0);
+        links.next.classList.toggle('d-none', index >= deck.total - 1);
+        links.restart.classList.toggle('d-none', index !== deck.total - 1);
+        links.quit.classList.toggle('d-none', index !== deck.total - 1);
+        prefetch(index);
+    }
+
+    function showCard(index, push) {
+        var loaded = deck.cards[index] ? Promise.resolve() : loadChunk(chunkOffset(index));
+        return loaded.then(function () {
+            if (!deck.cards[index]) {
+                throw new Error('Card ' + index + ' is not in this deck');
+            }
+            render(index);
+            recordStudyEvent('view', deck.listId, deck.cards[index].position); // The server records views of the pages it serves itself. Events record the card's position in the list
+            if (push) {
+                window.history.pushState({ cardIndex: index }, '', pageUrl(index)); // Keeps the address bar (and refresh) on the current card
+            }
+        });
+    }
+
+    flashcard.addEventListener('click', function () {
+        if (flashcard.classList.contains('flipped')) {
+            recordStudyEvent('flip', deck.listId, deck.cards[deck.index] ? deck.cards[deck.index].position : parseInt(flashcard.dataset.cardPosition, 10)); // Before its chunk loads, the card is the one the page was served with
+        }
+    });
+
+    ['previous', 'next', 'restart'].forEach(function (name) {
+        links[name].addEventListener('click', function (event) {
+            var target = name === 'previous' ? deck.index - 1 : name === 'next' ? deck.index + 1 : 0;
+            event.preventDefault();
+            showCard(target, true).catch(function () {
+                window.location.href = links[name].href; // Fall back to the card's own page
+            });
+        });
+    });
+
+    window.addEventListener('popstate', function (event) { // Back/forward between cards
+        var index = event.state && typeof event.state.cardIndex === 'number' ? event.state.cardIndex : parseInt(flashcard.dataset.cardIndex, 10);
+        showCard(index, false).catch(function () {
+            window.location.reload();
+        });
+    });
+
+    window.history.replaceState({ cardIndex: deck.index }, '', window.location.href);
+    loadChunk(chunkOffset(deck.index)).then(function () { prefetch(deck.index); }).catch(function () {}); // Load the rest of this chunk in the background
+});
+
 // MODALS //
 
 // Ideally, polymorphism would work here. However, it isn't, so we're doing this instead
@@ -209,6 +355,105 @@ function searchUserTable() {
     }
 }
 
+// TYPEAHEAD FUNCTIONALITY //
+
+// Fills an input's datalist with matching usernames/list names from the server as the user types
+var typeaheadTimers = {};
+function typeahead(input, field) {
+    clearTimeout(typeaheadTimers[input.id]); // Debounce - only look up once typing pauses
+    typeaheadTimers[input.id] = setTimeout(function () {
+        var prefix = input.value.trim();
+        var datalist = document.getElementById(input.getAttribute('list'));
+        if (!prefix) {
+            datalist.innerHTML = '';
+            return;
+        }
+        fetch('/admin_dashboard/typeahead?field=' + encodeURIComponent(field) + '&q=' + encodeURIComponent(prefix), { credentials: 'same-origin' })
+            .then(function (response) { return response.ok ? response.json() : []; })
+            .then(function (names) {
+                datalist.innerHTML = ''; // Replace the old suggestions
+                names.forEach(function (name) {
+                    var option = document.createElement('option');
+                    option.value = name;
+                    datalist.appendChild(option);
+                });
+            });
+    }, 200); // After 200ms without typing
+}
+
+// BACKGROUND JOBS //
+
+// Shows the progress of queued and running jobs (list/user deletes, imports) on the admin pages, polling until they've all finished
+var JOB_POLL_INTERVAL = 2000; // Milliseconds between polls
+var shownJobs = {}; // Job id -> its list item, for jobs shown on this page
+
+function renderJob(job) {
+    var item = shownJobs[job.job_id];
+    if (!item) {
+        item = document.createElement('li');
+        item.className = 'list-group-item list-group-item-dark';
+        item.innerHTML = '<div class="d-flex justify-content-between align-items-center"><span class="job-description"></span>' +
+            '<button type="button" class="btn btn-sm btn-outline-danger job-cancel">Cancel</button></div>' +
+            '<div class="progress mt-2"><div class="progress-bar" role="progressbar"></div></div><small class="job-status"></small>';
+        item.querySelector('.job-cancel').addEventListener('click', function () { cancelJob(job.job_id); });
+        document.getElementById('job-list').appendChild(item);
+        shownJobs[job.job_id] = item;
+    }
+    item.querySelector('.job-description').textContent = job.description; // textContent - list and user names are user input
+    var bar = item.querySelector('.progress-bar');
+    bar.style.width = (job.percent === null ? 0 : job.percent) + '%';
+    bar.classList.toggle('bg-success', job.status === 'done');
+    bar.classList.toggle('bg-danger', job.status === 'failed' || job.status === 'cancelled');
+    var status = job.status === 'running' ? (job.cancel_requested ? 'Cancelling' : 'Running') + ' - ' + job.progress + (job.total ? ' of ' + job.total : '') + ' rows'
+        : job.status === 'queued' ? 'Waiting to start' : (job.message || job.status);
+    item.querySelector('.job-status').textContent = status;
+    item.querySelector('.job-cancel').style.display = (job.status === 'queued' || job.status === 'running') && !job.cancel_requested ? '' : 'none';
+}
+
+function cancelJob(jobId) {
+    var token = document.querySelector('meta[name="csrf-token"]');
+    fetch('/admin_dashboard/jobs/' + jobId + '/cancel', {
+        method: 'POST',
+        credentials: 'same-origin',
+        headers: { 'X-CSRFToken': token ? token.content : '' }
+    }).then(function (response) { return response.json(); })
+        .then(function (job) { if (job.job_id) { renderJob(job); } })
+        .catch(function () {});
+}
+
+function pollJobs() {
+    var panel = document.getElementById('job-panel');
+    fetch(panel.dataset.jobsUrl, { credentials: 'same-origin' })
+        .then(function (response) { return response.ok ? response.json() : { jobs: [] }; })
+        .then(function (data) {
+            var active = {};
+            data.jobs.forEach(function (job) {
+                active[job.job_id] = true;
+                renderJob(job);
+            });
+            // Jobs that are no longer active have finished - fetch each one's result once
+            var finished = Object.keys(shownJobs).filter(function (jobId) { return !active[jobId] && !shownJobs[jobId].dataset.finished; });
+            return Promise.all(finished.map(function (jobId) {
+                shownJobs[jobId].dataset.finished = 'true';
+                return fetch('/admin_dashboard/jobs/' + jobId, { credentials: 'same-origin' })
+                    .then(function (response) { return response.json(); })
+                    .then(function (job) { if (job.job_id) { renderJob(job); } });
+            })).then(function () {
+                panel.style.display = Object.keys(shownJobs).length ? '' : 'none';
+                if (data.jobs.length) {
+                    setTimeout(pollJobs, JOB_POLL_INTERVAL);
+                }
+            });
+        })
+        .catch(function () { setTimeout(pollJobs, JOB_POLL_INTERVAL * 5); }); // e.g. rate limited - back off
+}
+
+document.addEventListener("DOMContentLoaded", function () {
+    if (document.getElementById('job-panel')) {
+        pollJobs();
+    }
+});
+
 // ALERT FUNCTIONALITY //
 
 // Alert Dismissal
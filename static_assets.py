@@ -0,0 +1,72 @@
+# This file contains the serving side of the static asset build (see build_static.py)
+# With a built manifest, url_for('static', filename='style.css') gives the content-hashed copy in static/dist/. Hashed files never change, so they're
+# served with a year-long immutable Cache-Control - repeat visits don't even revalidate them - and as the smallest precompressed version
+# (brotli or gzip) the browser accepts. Without a manifest (build_static.py hasn't been run) everything falls back to the original files.
+import json # For reading the manifest
+import mimetypes # For the type of precompressed files
+import os # For the manifest path
+import logging # For logging
+from flask import request, send_from_directory, url_for # For serving the built files
+
+DIST = 'dist' # Build output, inside the static folder
+MANIFEST = 'manifest.json'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+# Settings - can be overridden through the app config (see init_app)
+settings = {
+    'STATIC_MANIFEST': None, # Path to the build manifest - defaults to static/dist/manifest.json in the app's static folder
+}
+
+manifest = {'files': {}, 'encodings': {}, 'webp': {}}
+_hashed = {} # Built file name -> its precompressed encodings, smallest first
+
+def load_manifest(path):
+    global manifest, _hashed
+    try:
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        logging.info('No static asset manifest - serving the original static files. Run build_static.py to build one.')
+        return False
+    _hashed = {hashed: manifest['encodings'].get(hashed, []) for hashed in manifest['files'].values()}
+    _hashed.update((version['file'], []) for versions in manifest['webp'].values() for version in versions)
+    return True
+
+def hashed_url_defaults(endpoint, values):
+    # url_for('static', filename=...) -> the hashed copy, when there is one
+    if endpoint == 'static' and values.get('filename') in manifest['files']:
+        values['filename'] = f"{DIST}/{manifest['files'][values['filename']]}"
+
+def webp_srcset(filename):
+    # 'dist/x-640w.webp 640w, ...' for the <source> of a <picture>, or '' if there are no WebP versions of this image
+    return ', '.join(f"{url_for('static', filename=DIST + '/' + version['file'])} {version['width']}w" for version in manifest['webp'].get(filename, []))
+
+def serve_hashed(static_folder):
+    # Serves requests for built files, before Flask's own static view: the smallest encoding the browser accepts, cached for good
+    if request.endpoint != 'static':
+        return None
+    filename = (request.view_args or {}).get('filename', '')
+    prefix = DIST + '/'
+    if not filename.startswith(prefix) or filename[len(prefix):] not in _hashed:
+        return None
+    hashed = filename[len(prefix):]
+    dist_dir = os.path.join(static_folder, DIST)
+    encoding = next((encoding for encoding in _hashed[hashed] if encoding in request.accept_encodings), None)
+    response = send_from_directory(dist_dir, hashed + ENCODING_SUFFIXES[encoding] if encoding else hashed,
+                                   mimetype=mimetypes.guess_type(hashed)[0], max_age=31536000) # The type of the original file, not of its .br/.gz
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if _hashed[hashed]:
+        response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+def init_app(app):
+    # Reads the manifest and hooks the hashed names into url_for and the static route
+    for key, value in settings.items():
+        settings[key] = app.config.setdefault(key, value)
+    load_manifest(settings['STATIC_MANIFEST'] or os.path.join(app.static_folder, DIST, MANIFEST))
+    app.url_defaults(hashed_url_defaults)
+    app.before_request(lambda: serve_hashed(app.static_folder))
+    app.jinja_env.globals['webp_srcset'] = webp_srcset
@@ -0,0 +1,175 @@
+# This file contains the study event buffer - card views, flips and answers recorded while students study
+# Writing a row per event from the request thread would make every worker queue for SQLite's single write lock. Instead, requests drop events into a
+# bounded in-memory queue and a background thread writes them in batches, many rows per transaction.
+# Backpressure: when the queue is full, record() refuses the event (counted as dropped) instead of letting memory grow - the events route answers 503.
+# Pending events are flushed when the process exits normally.
+import atexit # For flushing on shutdown
+import os # For detecting forked workers
+import queue # For the event buffer
+import sqlite3 # For database errors
+import threading # For the flusher thread
+import time # For timestamps and flush timing
+import logging # For logging
+import db # For database connections
+
+EVENT_TYPES = ('view', 'flip', 'answer')
+
+# Settings - can be overridden through the app config (see init_app)
+settings = {
+    'STUDY_EVENTS_QUEUE_SIZE': 10000, # Events that can wait to be written before new ones are refused
+    'STUDY_EVENTS_BATCH_SIZE': 500, # Most events written per transaction
+    'STUDY_EVENTS_FLUSH_INTERVAL': 1.0, # Seconds between flushes when events are trickling in
+    'STUDY_EVENTS_FLUSH_ATTEMPTS': 3, # Times a batch is retried (e.g. the database is locked) before it's dropped
+}
+
+_lock = threading.Lock()
+_queue = None
+_thread = None
+_pid = None
+_stopping = threading.Event()
+_exit_hook = False # Whether shutdown() is registered to run at exit - once per process, however many apps are created
+stats = {
+    'accepted': 0, # Events queued
+    'flushed': 0, # Events written to the database
+    'dropped': 0, # Events refused because the queue was full, or lost to a failed flush
+    'rejected': 0, # Events the database refused - e.g. their user or list was deleted while they were queued
+    'flushes': 0, # Transactions written
+    'flush_errors': 0, # Failed flush attempts
+}
+
+def _record(key, amount=1):
+    with _lock:
+        stats[key] += amount
+
+def _get_queue():
+    # Starts the flusher on first use - and again in a forked worker, since threads don't survive a fork
+    global _queue, _thread, _pid
+    with _lock:
+        if _pid != os.getpid():
+            _queue = queue.Queue(maxsize=settings['STUDY_EVENTS_QUEUE_SIZE'])
+            _stopping.clear()
+            _thread = threading.Thread(target=_run, args=(_queue,), name='study-events-flusher', daemon=True)
+            _thread.start()
+            _pid = os.getpid()
+        return _queue
+
+def record(user_id, list_id, card_index, event_type, occurred_at=None):
+    # Queues one event. Returns False (and counts it as dropped) if the buffer is full.
+    try:
+        _get_queue().put_nowait((user_id, list_id, card_index, event_type, occurred_at if occurred_at is not None else time.time()))
+    except queue.Full:
+        _record('dropped')
+        return False
+    _record('accepted')
+    return True
+
+INSERT_EVENT = 'INSERT INTO study_events (user_id, list_id, card_index, event_type, occurred_at) VALUES (?, ?, ?, ?, ?)'
+
+def _write(conn, batch):
+    with conn:
+        conn.executemany(INSERT_EVENT, batch)
+
+def _write_each(conn, batch):
+    # Writes a batch one event at a time, still in one transaction - a failed INSERT only undoes itself, so every event the database will take is kept.
+    # Returns the number rejected.
+    rejected = 0
+    with conn:
+        for event in batch:
+            try:
+                conn.execute(INSERT_EVENT, event)
+            except sqlite3.IntegrityError:
+                rejected += 1
+    return rejected
+
+def _flush(conn, batch):
+    for attempt in range(1, settings['STUDY_EVENTS_FLUSH_ATTEMPTS'] + 1):
+        try:
+            rejected = 0
+            try:
+                _write(conn, batch)
+            except sqlite3.IntegrityError as e: # Some event can't be written (its user was deleted, say) - retrying the batch won't help, so split it up
+                logging.warning(f'Study event batch rejected ({e}) - writing its events one at a time')
+                rejected = _write_each(conn, batch)
+        except sqlite3.Error as e:
+            _record('flush_errors')
+            logging.warning(f'Study event flush failed (attempt {attempt}): {e}')
+            if attempt < settings['STUDY_EVENTS_FLUSH_ATTEMPTS'] and not _stopping.is_set():
+                time.sleep(settings['STUDY_EVENTS_FLUSH_INTERVAL'])
+            continue
+        with _lock:
+            stats['flushed'] += len(batch) - rejected
+            stats['rejected'] += rejected
+            stats['flushes'] += 1
+        if rejected:
+            logging.warning(f'Dropped {rejected} study events the database rejected')
+        return
+    _record('dropped', len(batch))
+    logging.error(f'Dropped {len(batch)} study events after {settings["STUDY_EVENTS_FLUSH_ATTEMPTS"]} failed flushes')
+
+def _drain(events, limit):
+    # Takes up to 'limit' events off the queue without waiting
+    batch = []
+    while len(batch) < limit:
+        try:
+            batch.append(events.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+def _run(events):
+    # The flusher thread: waits for an event, gives others a moment to arrive, then writes everything queued in as few transactions as possible
+    conn = db.connect()
+    try:
+        while not _stopping.is_set():
+            try:
+                first = events.get(timeout=settings['STUDY_EVENTS_FLUSH_INTERVAL'])
+            except queue.Empty:
+                continue
+            if events.qsize() < settings['STUDY_EVENTS_BATCH_SIZE']:
+                _stopping.wait(settings['STUDY_EVENTS_FLUSH_INTERVAL']) # Let the batch fill up
+            batch = [first] + _drain(events, settings['STUDY_EVENTS_BATCH_SIZE'] - 1)
+            while batch:
+                _flush(conn, batch)
+                batch = _drain(events, settings['STUDY_EVENTS_BATCH_SIZE'])
+    finally:
+        conn.close()
+
+def flush():
+    # Writes everything that's queued right now, from the calling thread. Used at shutdown and by scripts.
+    events = _queue
+    if events is None or _pid != os.getpid() or events.empty():
+        return
+    conn = db.connect()
+    try:
+        batch = _drain(events, settings['STUDY_EVENTS_BATCH_SIZE'])
+        while batch:
+            _flush(conn, batch)
+            batch = _drain(events, settings['STUDY_EVENTS_BATCH_SIZE'])
+    finally:
+        conn.close()
+
+def shutdown():
+    # Stops the flusher, waits for the batch it's writing, then writes whatever is left. Safe to call more than once - the next record() starts a new flusher.
+    global _thread, _pid
+    if _thread is None or _pid != os.getpid():
+        return
+    _stopping.set()
+    _thread.join(timeout=settings['STUDY_EVENTS_FLUSH_INTERVAL'] * settings['STUDY_EVENTS_FLUSH_ATTEMPTS'] + db.settings['DATABASE_BUSY_TIMEOUT'])
+    flush()
+    with _lock:
+        _thread, _pid = None, None
+
+def get_stats():
+    with _lock:
+        counters = dict(stats)
+    counters['pending'] = _queue.qsize() if _queue is not None and _pid == os.getpid() else 0
+    return counters
+
+def init_app(app):
+    # Reads the buffer settings from the app config, and makes sure queued events are written when the process exits
+    for key, value in settings.items():
+        settings[key] = app.config.setdefault(key, value)
+    global _exit_hook
+    if not _exit_hook:
+        atexit.register(shutdown)
+        _exit_hook = True
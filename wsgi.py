@@ -0,0 +1,14 @@
+# This file contains the WSGI entry point for the application
+# Point the server at wsgi:app, e.g. 'gunicorn --preload -w 4 wsgi:app' - with --preload the app is built once and the workers fork from it.
+# Run 'python migrate_db.py' (and 'python build_static.py') once per deploy before starting the server - workers never touch the schema.
+# The environment comes from KANACARD_ENV (development, testing or production - the default), see config.py.
+#   python wsgi.py    - the development server, over HTTPS with cert.pem/key.pem
+from app import create_app # The app factory
+
+app = create_app()
+
+# Making Flask run on SSL
+if __name__ == '__main__':
+    import migrate_db # For schema migrations
+    migrate_db.migrate() # Schema setup runs here (or via 'python migrate_db.py' on deploy), not on every import
+    app.run(debug=app.config['DEBUG'], ssl_context=('cert.pem', 'key.pem'), host="0.0.0.0", port=443)